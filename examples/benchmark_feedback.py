@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+''' Benchmark for `copy` and `feedback` at 1080p.
+    Compares surface-to-surface copies with the previous approach going through
+    `get_image_array` and `image`, and prints the time per frame.
+
+    Run with `python benchmark_feedback.py`
+'''
+import time
+from py5canvas import canvas
+
+width, height = 1920, 1080
+repetitions = 30
+
+
+def legacy_copy(c, sx, sy, sw, sh, dx, dy, dw, dh):
+    # What `copy` used to do
+    img = c.get_image_array()[sy:sy + sh, sx:sx + sw]
+    c.image(img, dx, dy, dw, dh)
+
+
+def legacy_feedback(c):
+    legacy_copy(c, 0, 0, width, height, -10, -10, width + 20, height + 20)
+
+
+def new_feedback(c):
+    c.feedback(scale=(width + 20)/width)
+
+
+def copy_region(c):
+    c.copy(100, 100, 640, 360, 800, 500, 640, 360)
+
+
+def legacy_copy_region(c):
+    legacy_copy(c, 100, 100, 640, 360, 800, 500, 640, 360)
+
+
+def benchmark(func):
+    c = canvas.Canvas(width, height, recording=False)
+    c.background(0)
+    c.fill(255, 0, 0)
+    c.circle(width/2, height/2, 200)
+    func(c) # warm up
+    t = time.perf_counter()
+    for i in range(repetitions):
+        func(c)
+    return (time.perf_counter() - t)/repetitions
+
+
+if __name__ == '__main__':
+    print('%dx%d canvas, %d repetitions'%(width, height, repetitions))
+    print('%-22s %-12s'%('method', 'time (ms)'))
+    for name, func in [('feedback (legacy)', legacy_feedback),
+                       ('feedback', new_feedback),
+                       ('copy region (legacy)', legacy_copy_region),
+                       ('copy region', copy_region)]:
+        print('%-22s %-12.2f'%(name, benchmark(func)*1000))
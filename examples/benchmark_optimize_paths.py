@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+''' Benchmark for the plotter path optimization (see `geom.optimize_paths`).
+    Generates a large number of short random polylines, orders them greedily and with 2-opt refinement,
+    then prints the pen-up travel distance before and after, and the time taken.
+
+    Run with `python benchmark_optimize_paths.py`
+'''
+import time
+import numpy as np
+from py5canvas import geom
+
+width, height = 1000, 1000
+num_paths = 100000
+
+np.random.seed(0)
+paths = []
+for i in range(num_paths):
+    start = np.random.uniform(0, 1, 2)*[width, height]
+    steps = np.random.normal(0, 3, (np.random.randint(2, 6), 2))
+    paths.append(start + np.cumsum(steps, axis=0))
+
+
+if __name__ == '__main__':
+    print('%d random polylines on a %dx%d page'%(num_paths, width, height))
+    print('%-16s %-14s %-10s %-10s'%('ordering', 'travel', 'paths', 'time (s)'))
+    print('%-16s %-14.0f %-10d %-10s'%('original', geom.travel_distance(paths, (0, 0)), len(paths), '-'))
+    for name, kwargs in [('greedy', dict(reverse=False)),
+                         ('greedy+reverse', dict()),
+                         ('2-opt (4)', dict(two_opt=4)),
+                         ('merge (0.5)', dict(two_opt=4, merge_tol=0.5))]:
+        t = time.perf_counter()
+        result = geom.optimize_paths(paths, **kwargs)
+        elapsed = time.perf_counter() - t
+        print('%-16s %-14.0f %-10d %-10.2f'%(name, geom.travel_distance(result, (0, 0)), len(result), elapsed))
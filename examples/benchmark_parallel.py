@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+''' Benchmark for parallel population rendering (see `evaluate_population`).
+    Renders and scores a population of random rectangle genomes against a target image
+    with an increasing number of worker processes, then prints the time per generation
+    and the speedup over a single process.
+
+    Run with `python benchmark_parallel.py`
+'''
+import os
+import time
+import numpy as np
+from py5canvas.parallel import evaluate_population, close_pool
+
+size = (512, 512)
+target_size = (128, 128)
+population_size = 64
+num_rects = 200
+repetitions = 3
+
+np.random.seed(0)
+population = [np.random.uniform(0, 1, num_rects*6) for i in range(population_size)]
+target = np.random.uniform(0, 1, (target_size[1], target_size[0])).astype(np.float32)
+
+
+def render(c, dna, target):
+    c.rect_mode('center')
+    c.no_stroke()
+    for x, y, w, h, rot, opacity in dna.reshape(-1, 6):
+        c.fill(0, opacity*128)
+        c.push()
+        c.translate(x*c.width, y*c.height)
+        c.rotate(rot*np.pi*2)
+        c.rect(0, 0, w*c.width*0.3, h*c.height*0.3)
+        c.pop()
+
+
+def score(c, dna, target):
+    return -np.sum((c.read_downsampled(target_size) - target)**2)
+
+
+def benchmark(workers):
+    evaluate_population(render, population, size, score, workers=workers, args=(target,)) # warm up
+    t = time.perf_counter()
+    for i in range(repetitions):
+        evaluate_population(render, population, size, score, workers=workers, args=(target,))
+    return (time.perf_counter() - t)/repetitions
+
+
+if __name__ == '__main__':
+    cpus = os.cpu_count() or 1
+    print('%d genomes of %d rectangles on a %dx%d canvas, %d CPUs'%(population_size, num_rects, size[0], size[1], cpus))
+    print('%-10s %-16s %-10s'%('workers', 'generation (s)', 'speedup'))
+    workers = 1
+    base = None
+    while True:
+        elapsed = benchmark(workers)
+        base = base or elapsed
+        print('%-10d %-16.3f %-10.2f'%(workers, elapsed, base/elapsed))
+        if workers >= cpus:
+            break
+        workers = min(workers*2, cpus)
+    close_pool()
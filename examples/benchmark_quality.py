@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+''' Benchmark for the rendering quality settings (see `quality`).
+    Draws a dense field of small particles with each antialias mode and a few curve tolerances,
+    then prints the throughput in particles per second.
+
+    Run with `python benchmark_quality.py`
+'''
+import time
+import numpy as np
+from py5canvas import canvas
+
+width, height = 1024, 1024
+num_particles = 20000
+repetitions = 3
+
+np.random.seed(0)
+pos = np.random.uniform(0, 1, (num_particles, 2))*[width, height]
+radius = np.random.uniform(1, 6, num_particles)
+
+
+def draw_particles(c):
+    c.background(0)
+    c.no_stroke()
+    c.fill(255, 128)
+    for p, r in zip(pos, radius):
+        c.circle(p, r)
+
+
+def benchmark(antialias, tolerance):
+    c = canvas.Canvas(width, height, recording=False)
+    c.quality(antialias, tolerance=tolerance)
+    draw_particles(c) # warm up
+    t = time.perf_counter()
+    for i in range(repetitions):
+        draw_particles(c)
+    elapsed = (time.perf_counter() - t)/repetitions
+    return elapsed
+
+
+if __name__ == '__main__':
+    print('%d particles on a %dx%d canvas'%(num_particles, width, height))
+    print('%-10s %-10s %-12s %-16s'%('antialias', 'tolerance', 'time (ms)', 'particles/sec'))
+    for antialias in ['best', 'good', 'fast', 'none']:
+        for tolerance in [0.1, 0.5, 2.0]:
+            elapsed = benchmark(antialias, tolerance)
+            print('%-10s %-10.1f %-12.2f %-16.0f'%(antialias, tolerance, elapsed*1000, num_particles/elapsed))
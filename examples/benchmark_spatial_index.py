@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+''' Benchmark for the spatial indices (see `geom.HashGrid` and `geom.KDTree`).
+    Builds each index for uniformly distributed points, then queries the neighbors of every point
+    within a radius (about 10 neighbors each) and the 8 nearest neighbors, and prints the times.
+    For small sizes a brute force search is included for comparison.
+
+    Run with `python benchmark_spatial_index.py`
+'''
+import time
+import numpy as np
+from py5canvas import geom
+
+width, height = 1000, 1000
+sizes = [10000, 100000, 1000000]
+k = 8
+
+
+def timed(func, *args):
+    t = time.perf_counter()
+    res = func(*args)
+    return res, time.perf_counter() - t
+
+
+def brute_force_radius(points, r):
+    # One row of distances at a time, as sketches usually do
+    return [np.nonzero(np.sum((points - p)**2, axis=1) <= r*r)[0] for p in points]
+
+
+if __name__ == '__main__':
+    np.random.seed(0)
+    print('%-10s %-12s %-10s %-12s %-12s %-12s'%('points', 'index', 'build (s)', 'radius (s)', 'pairs', 'knn (s)'))
+    for n in sizes:
+        points = np.random.uniform(0, 1, (n, 2))*[width, height]
+        # Radius giving about 10 neighbors per point
+        r = np.sqrt(10*width*height/(np.pi*n))
+        for name, index in [('hash grid', geom.HashGrid(r)), ('kd-tree', geom.KDTree())]:
+            _, t_build = timed(index.build, points)
+            (indices, offsets), t_radius = timed(index.query_radius, points, r)
+            _, t_knn = timed(index.query_knn, points, k)
+            print('%-10d %-12s %-10.3f %-12.3f %-12d %-12.3f'%(n, name, t_build, t_radius, len(indices), t_knn))
+        if n <= 10000:
+            res, t_radius = timed(brute_force_radius, points, r)
+            print('%-10d %-12s %-10s %-12.3f %-12d %-12s'%(n, 'brute force', '-', t_radius, sum(len(a) for a in res), '-'))
+
+    # Incremental insertion with a query after each point, as in Poisson disk sampling
+    n = 10000
+    grid = geom.HashGrid(10)
+    points = np.random.uniform(0, 1, (n, 2))*[width, height]
+    t = time.perf_counter()
+    for p in points:
+        grid.query_radius(p, 10)
+        grid.insert(p)
+    print('%d single insertions and queries in the hash grid: %.3f s'%(n, time.perf_counter() - t))
@@ -1,6 +1,7 @@
 '''
 Stress test for the canvas
-A simple genetic algorithm that reconstructs an image with rectangles
+A simple genetic algorithm that reconstructs an image with rectangles.
+The population is rendered and scored in parallel with `evaluate_population`
 '''
 from py5canvas import *
 import numpy as np
@@ -27,7 +28,7 @@ def setup():
         dna = np.random.uniform(0, 1, num_rects*num_parameters)
         population.append(dna)
         fitness.append(0)
-    fitness = np.array(fitness)
+    fitness = np.array(fitness, dtype=float)
 
     frame_rate(0)
 
@@ -46,7 +47,7 @@ def draw():
     # draw the fittest result, but scale to the whole canvas sie
     background(255)
     # image(img, 0, 0)
-    draw_phenotype(population[fittest])
+    draw_phenotype(sketch.canvas, population[fittest])
 
     # if the method is working this should be increasing
     fill(0)
@@ -57,7 +58,6 @@ def draw():
          [20,20])
 
     image(img, 0, 30)
-    canvas_img = get_image_grayscale().resize(target_size) # 0-255 range
 
 # tournament selection
 # selects one chromosome with the best fitness among a set of random chromosomes
@@ -68,7 +68,7 @@ def tournament(population, fitness, size):
     return population[I[np.argmax(T)]]
 
 
-def calc_phenotype(dna):
+def calc_phenotype(dna, width, height):
     num_rects = len(dna) // num_parameters
     rects = []
     j = 0
@@ -86,41 +86,36 @@ def calc_phenotype(dna):
     return rects
 
 
-# draws an individual
-def draw_phenotype(dna):
-    phenotype = calc_phenotype(dna)
-    rect_mode(CENTER)
+# draws an individual into a canvas
+def draw_phenotype(c, dna, target=None):
+    phenotype = calc_phenotype(dna, c.width, c.height)
+    c.rect_mode(CENTER)
     for r in phenotype:
-        no_stroke()
-        fill(0, r['opacity']*0.5)
-        push()
-        translate(r['x'], r['y'])
-        rotate(r['rotation'])
-        rect(0, 0, r['width'], r['height'])
-        pop()
+        c.no_stroke()
+        c.fill(0, r['opacity']*0.5)
+        c.push()
+        c.translate(r['x'], r['y'])
+        c.rotate(r['rotation'])
+        c.rect(0, 0, r['width'], r['height'])
+        c.pop()
 
 
-# computes fitness given a chromosome
-def compute_fitness(dna, get_image=False):
-    background(255)
-    draw_phenotype(dna)
-    # grab the resulting image
-    canvas_img = get_image_grayscale().resize(target_size) # 0-255 range
-    cost = (np.array(canvas_img)/255 - img)**2
-    fitness = -np.sum(cost)
-    if get_image:
-        return fitness, canvas_img
-    else:
-        return fitness
+# computes fitness of a rendered chromosome
+# the target image is passed explicitly, since the worker processes do not see changes to globals
+def compute_fitness(c, dna, target):
+    # grab the resulting image, averaged down to the target size (0-1 range)
+    canvas_img = c.read_downsampled(target_size)
+    cost = (canvas_img - target)**2
+    return -np.sum(cost)
 
 
 # evolve a new generation
 def evolve(population, fitness):
     n = len(population)
 
-    # update fitness
-    for i in range(n):
-        fitness[i] = compute_fitness(population[i])
+    # update fitness, rendering each individual on a canvas with the size of the sketch canvas
+    fitness[:] = evaluate_population(draw_phenotype, population, (width, height), compute_fitness,
+                                     args=(img,))
 
     # and create new generation
     generation = []
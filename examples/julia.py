@@ -1,10 +1,8 @@
 ''' A simple Julia zoom
-    using numpy for computation and matplotlib for colors'''
+    using numpy for computation and a matplotlib colormap for colors'''
 from py5canvas import *
 import numpy as np
-import matplotlib
 
-cmap = matplotlib.cm.get_cmap('jet') #'jet')
 scale_factor = 300
 target = complex(-0.1930840493097, -0.080000106)
 
@@ -40,8 +38,7 @@ def draw():
         inds = np.abs(z) < 2
         img[inds] = img[inds] + 1
 
-    img = cmap(np.mod(img/10, 1))  # fixme
-    image(img, [0, 0], [width, height])
+    image_colormap(np.mod(img/10, 1), 'jet', 0, 1, [0, 0], [width, height])
 
     # zoom in
     scale_factor *= 1.1
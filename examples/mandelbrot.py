@@ -1,10 +1,8 @@
 ''' A simple mandelbrot zoom
-    using numpy for computation and matplotlib for colors'''
+    using numpy for computation and a matplotlib colormap for colors'''
 from py5canvas import *
 import numpy as np
-import matplotlib
 
-cmap = matplotlib.cm.get_cmap('turbo')
 scale = 60.0
 
 def setup():
@@ -31,8 +29,7 @@ def draw():
         norm = np.abs(z)
         diverged = np.where(norm > 2)
         img[diverged] = i
-    img = cmap(np.mod(img/10, 10)/10)  # fixme
-    image(img, [0, 0], [width, height])
+    c.image_colormap(np.mod(img/10, 10)/10, 'turbo', 0, 1, [0, 0], [width, height])
     # zoom in
     scale *= 1.1
 
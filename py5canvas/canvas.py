@@ -18,19 +18,22 @@ import os
 import numpy as np
 import cairo
 import numbers
-import copy, sys, types
+import sys, types
+import re
+import builtins
+import functools
 import ctypes as ct
-from math import fmod, pi, comb
+from math import pi, comb
 from PIL import Image
 import importlib
 import importlib.util
-from contextlib import contextmanager
 from easydict import EasyDict as edict
 import rumore  # Noise utils
 from dataclasses import dataclass
 from typing import Union, Optional
 from fontTools.ttLib import TTFont
 import pdb
+from . import filters
 
 # perlin_loader = importlib.util.find_spec('perlin_noise')
 # if perlin_loader is not None:
@@ -45,38 +48,204 @@ def is_number(x):
     return isinstance(x, numbers.Number)
 
 
-def wrapper(self, fn):
-    def result(*args, **kwargs):
+def wrapper(fn):
+    """Create a method forwarding a call to all the contexts of a `MultiContext`"""
+    def result(self, *args, **kwargs):
         res = None
         self.dirty = True
         for ctx in self.ctxs:  # [::-1]:
             res = getattr(ctx, fn)(*args, **kwargs)
         return res
 
+    result.__name__ = fn
     return result
 
 
 class MultiContext:
     """Workaround for TeeSurface not working on Mac (at least)
     This should enable rendering to multiple surfaces (each with their own context)
+
+    Each context can have an optional base matrix (e.g. the render scale of the canvas surface),
+    which is applied underneath the user transformation so that all contexts share the same
+    user coordinates.
     """
 
     def __init__(self, surf):
         self.surface = surf
         self.dirty = False
         self.ctxs = [cairo.Context(surf)]
-        for key, value in cairo.Context.__dict__.items():
-            if hasattr(value, "__call__"):
-                self.__dict__[key] = wrapper(self, key)
+        self.base_matrices = [None]
+        # Shadow of the Cairo state (source color, operator, line width, cap, join, dash)
+        # so that calls that would not change the state are skipped.
+        # `None` means unknown (e.g. after setting a pattern source)
+        self._shadow = [None] * 6
+        self._shadow_stack = []
+        # Number of skipped calls, by method name
+        self.elided = {}
+
+    def reset(self):
+        """Replace the contexts with a single fresh context for the surface, keeping its base matrix"""
+        self.ctxs = [cairo.Context(self.surface)]
+        self.base_matrices = self.base_matrices[:1]
+        if self.base_matrices[0] is not None:
+            self.ctxs[0].set_matrix(self.base_matrices[0])
+        self._shadow = [None] * 6
+        self._shadow_stack = []
+        self.dirty = False
 
-    def push_context(self, ctx):
+    def push_context(self, ctx, base_matrix=None):
+        # Start from the same state as the other contexts, since redundant state changes are skipped
+        copy_context_state(self.ctxs[0], ctx)
+        user_matrix = self._user_matrix(0)
         self.ctxs.append(ctx)
+        self.base_matrices.append(base_matrix)
+        self._set_user_matrix(len(self.ctxs) - 1, user_matrix)
+
+    def _changed(self, index, value, name):
+        if self._shadow[index] == value:
+            self.elided[name] = self.elided.get(name, 0) + 1
+            return False
+        self._shadow[index] = value
+        return True
+
+    def save(self):
+        self._shadow_stack.append(list(self._shadow))
+        for ctx in self.ctxs:
+            ctx.save()
+
+    def restore(self):
+        for ctx in self.ctxs:
+            ctx.restore()
+        if self._shadow_stack:
+            self._shadow = self._shadow_stack.pop()
+        else:
+            self._shadow = [None] * 6
+
+    def set_source_rgba(self, r, g, b, a=1.0):
+        if self._changed(0, (r, g, b, a), "set_source_rgba"):
+            for ctx in self.ctxs:
+                ctx.set_source_rgba(r, g, b, a)
+
+    def set_source_rgb(self, r, g, b):
+        if self._changed(0, (r, g, b, 1.0), "set_source_rgb"):
+            for ctx in self.ctxs:
+                ctx.set_source_rgb(r, g, b)
+
+    def set_source(self, source):
+        self._shadow[0] = None
+        for ctx in self.ctxs:
+            ctx.set_source(source)
+
+    def set_source_surface(self, surface, x=0.0, y=0.0):
+        self._shadow[0] = None
+        for ctx in self.ctxs:
+            ctx.set_source_surface(surface, x, y)
+
+    def set_operator(self, op):
+        if self._changed(1, op, "set_operator"):
+            for ctx in self.ctxs:
+                ctx.set_operator(op)
+
+    def set_line_width(self, width):
+        if self._changed(2, width, "set_line_width"):
+            for ctx in self.ctxs:
+                ctx.set_line_width(width)
+
+    def set_line_cap(self, cap):
+        if self._changed(3, cap, "set_line_cap"):
+            for ctx in self.ctxs:
+                ctx.set_line_cap(cap)
+
+    def set_line_join(self, join):
+        if self._changed(4, join, "set_line_join"):
+            for ctx in self.ctxs:
+                ctx.set_line_join(join)
+
+    def set_dash(self, dashes, offset=0):
+        if self._changed(5, (tuple(dashes), offset), "set_dash"):
+            for ctx in self.ctxs:
+                ctx.set_dash(dashes, offset)
 
     def pop_context(self):
-        self.ctxs.pop()
+        self.base_matrices.pop()
+        return self.ctxs.pop()
+
+    def remove_context(self, ctx):
+        """Remove a context added with `push_context`, also if other contexts were pushed after it"""
+        index = self.ctxs.index(ctx)
+        del self.ctxs[index]
+        del self.base_matrices[index]
+
+    def set_base_matrix(self, index, matrix):
+        """Set the base matrix of the context at `index`, keeping the current user transformation"""
+        user = self._user_matrix(index)
+        self.base_matrices[index] = matrix
+        self._set_user_matrix(index, user)
+
+    def _user_matrix(self, index):
+        m = self.ctxs[index].get_matrix()
+        base = self.base_matrices[index]
+        if base is None:
+            return m
+        inv = cairo.Matrix(base.xx, base.yx, base.xy, base.yy, base.x0, base.y0)
+        inv.invert()
+        return m.multiply(inv)
+
+    def _set_user_matrix(self, index, matrix):
+        base = self.base_matrices[index]
+        if base is None:
+            self.ctxs[index].set_matrix(matrix)
+        else:
+            self.ctxs[index].set_matrix(matrix.multiply(base))
+
+    def identity_matrix(self):
+        self.dirty = True
+        for ctx, base in zip(self.ctxs, self.base_matrices):
+            if base is None:
+                ctx.identity_matrix()
+            else:
+                ctx.set_matrix(base)
+
+    def set_matrix(self, matrix):
+        self.dirty = True
+        for i in range(len(self.ctxs)):
+            self._set_user_matrix(i, matrix)
+
+    def get_matrix(self):
+        # Consistently with the other wrapped methods, returns the result for the last context
+        return self._user_matrix(-1)
+
+
+# Forwarding methods are generated once for the class rather than for each instance
+for _key, _value in cairo.Context.__dict__.items():
+    if callable(_value) and not _key.startswith("__") and _key not in MultiContext.__dict__:
+        setattr(MultiContext, _key, wrapper(_key))
 
 
 class CanvasState:
+    """Drawing state saved and restored with `push`/`pop` and `push_style`/`pop_style`.
+    States are preallocated in a stack by the canvas and copied in place when pushing."""
+
+    __slots__ = (
+        "c",
+        "cur_fill",
+        "cur_stroke",
+        "_stroke_cap",
+        "_stroke_join",
+        "_text_halign",
+        "_text_valign",
+        "_rect_mode",
+        "_ellipse_mode",
+        "_font",
+        "_text_size",
+        "_text_leading",
+        "_line_width",
+        "_angle_mode",
+        "_antialias",
+        "_tolerance",
+        "_hinting",
+    )
+
     def __init__(self, c):
         self.c = c
 
@@ -94,21 +263,61 @@ class CanvasState:
         self._text_leading = 16
         self._line_width = 1.0
         self._angle_mode = 'radians'
+        self._antialias = "default"
+        self._tolerance = 0.1
+        self._hinting = "default"
+
+    def copy_from(self, other):
+        """Copy all the values of another state (a shallow copy, as with `copy.copy`)"""
+        self.c = other.c
+        self.cur_fill = other.cur_fill
+        self.cur_stroke = other.cur_stroke
+        self._stroke_cap = other._stroke_cap
+        self._stroke_join = other._stroke_join
+        self._text_halign = other._text_halign
+        self._text_valign = other._text_valign
+        self._rect_mode = other._rect_mode
+        self._ellipse_mode = other._ellipse_mode
+        self._font = other._font
+        self._text_size = other._text_size
+        self._text_leading = other._text_leading
+        self._line_width = other._line_width
+        self._angle_mode = other._angle_mode
+        self._antialias = other._antialias
+        self._tolerance = other._tolerance
+        self._hinting = other._hinting
 
     def set(self, prev=None):
-        def should_set(prev, name):
-            if prev is None:
-                return True
-            return prev.__dict__[name] != self.__dict__[name]
-
-        if should_set(prev, "_stroke_cap"):
+        """Apply the state to the Cairo context, only for the values that differ from `prev` (if specified)"""
+        if prev is None or prev._stroke_cap != self._stroke_cap:
             self.c.stroke_cap(self._stroke_cap)
-        if should_set(prev, "_stroke_join"):
+        if prev is None or prev._stroke_join != self._stroke_join:
             self.c.stroke_join(self._stroke_join)
-        if should_set(prev, "_line_width"):
+        if prev is None or prev._line_width != self._line_width:
             self.c.stroke_weight(self._line_width)
-        if should_set(prev, "_text_size"):
-            self.c.text_size(self._text_size)
+        if prev is None or prev._text_size != self._text_size:
+            self.c.ctx.set_font_size(self._text_size)
+        if (prev is None or
+            prev._antialias != self._antialias or
+            prev._tolerance != self._tolerance or
+            prev._hinting != self._hinting):
+            self.c.quality(self._antialias, tolerance=self._tolerance, hinting=self._hinting)
+
+
+class _PopContext:
+    """Reusable context manager returned by `push` methods, calls `pop` when exiting a `with` block"""
+
+    __slots__ = ("pop",)
+
+    def __init__(self, pop):
+        self.pop = pop
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        self.pop()
+        return False
 
 
 def draw_states_properties(*names):
@@ -116,10 +325,10 @@ def draw_states_properties(*names):
         for name in names:
 
             def getter(self, n=name):
-                return getattr(self.draw_states[-1], n)
+                return getattr(self._state, n)
 
             def setter(self, value, n=name):
-                setattr(self.draw_states[-1], n, value)
+                setattr(self._state, n, value)
 
             setattr(cls, name, property(getter, setter))
         return cls
@@ -127,6 +336,82 @@ def draw_states_properties(*names):
     return decorator
 
 
+ANTIALIAS_MODES = {
+    "default": cairo.ANTIALIAS_DEFAULT,
+    "none": cairo.ANTIALIAS_NONE,
+    "fast": cairo.ANTIALIAS_FAST,
+    "good": cairo.ANTIALIAS_GOOD,
+    "best": cairo.ANTIALIAS_BEST,
+}
+
+HINT_STYLES = {
+    "default": cairo.HINT_STYLE_DEFAULT,
+    "none": cairo.HINT_STYLE_NONE,
+    "slight": cairo.HINT_STYLE_SLIGHT,
+    "medium": cairo.HINT_STYLE_MEDIUM,
+    "full": cairo.HINT_STYLE_FULL,
+}
+
+BLEND_MODES = {
+    "clear": cairo.OPERATOR_CLEAR,
+    "source": cairo.OPERATOR_SOURCE,
+    "over": cairo.OPERATOR_OVER,  # This is the default blend mode
+    "in": cairo.OPERATOR_IN,
+    "out": cairo.OPERATOR_OUT,
+    "atop": cairo.OPERATOR_ATOP,
+    "dest": cairo.OPERATOR_DEST,
+    "dest_over": cairo.OPERATOR_DEST_OVER,
+    "dest_in": cairo.OPERATOR_DEST_IN,
+    "dest_out": cairo.OPERATOR_DEST_OUT,
+    "dest_atop": cairo.OPERATOR_DEST_ATOP,
+    "xor": cairo.OPERATOR_XOR,
+    "add": cairo.OPERATOR_ADD,
+    "saturate": cairo.OPERATOR_SATURATE,
+    "multiply": cairo.OPERATOR_MULTIPLY,
+    "screen": cairo.OPERATOR_SCREEN,
+    "overlay": cairo.OPERATOR_OVERLAY,
+    "darken": cairo.OPERATOR_DARKEN,
+    "lighten": cairo.OPERATOR_LIGHTEN,
+    "color_dodge": cairo.OPERATOR_COLOR_DODGE,
+    "color_burn": cairo.OPERATOR_COLOR_BURN,
+    "hard_light": cairo.OPERATOR_HARD_LIGHT,
+    "soft_light": cairo.OPERATOR_SOFT_LIGHT,
+    "difference": cairo.OPERATOR_DIFFERENCE,
+    "exclusion": cairo.OPERATOR_EXCLUSION,
+    "hsl_hue": cairo.OPERATOR_HSL_HUE,
+    "hsl_saturation": cairo.OPERATOR_HSL_SATURATION,
+    "hsl_color": cairo.OPERATOR_HSL_COLOR,
+    "hsl_luminosity": cairo.OPERATOR_HSL_LUMINOSITY,
+}
+
+LINE_CAPS = {
+    "square": cairo.LINE_CAP_BUTT,
+    "round": cairo.LINE_CAP_ROUND,
+    "project": cairo.LINE_CAP_SQUARE,
+}
+
+LINE_JOINS = {
+    "miter": cairo.LINE_JOIN_MITER,
+    "bevel": cairo.LINE_JOIN_BEVEL,
+    "round": cairo.LINE_JOIN_ROUND,
+}
+
+# Raster surface formats, "a8" stores only alpha (coverage) and "rgb24" has no alpha channel
+SURFACE_FORMATS = {
+    "argb32": cairo.FORMAT_ARGB32,
+    "rgb24": cairo.FORMAT_RGB24,
+    "a8": cairo.FORMAT_A8,
+}
+
+IMAGE_FILTERS = {
+    "nearest": cairo.FILTER_NEAREST,
+    "fast": cairo.FILTER_FAST,
+    "bilinear": cairo.FILTER_BILINEAR,
+    "good": cairo.FILTER_GOOD,
+    "best": cairo.FILTER_BEST,
+}
+
+
 @dataclass
 class Font:
     obj: Union[str, object]
@@ -134,7 +419,17 @@ class Font:
     style: str = None
 
 class Gradient:
+    """A gradient fill, created with `linear_gradient`, `linear_gradient_angle` or `radial_gradient`.
+
+    With `units='user'` (default) the gradient geometry is in drawing coordinates,
+    with `units='object'` it is relative to the bounding box of each shape it fills,
+    with `(0, 0)` the top left and `(1, 1)` the bottom right corner, so the same gradient
+    can be reused for shapes with different positions and sizes.
+    """
     def __init__(self, kind, **kw):
+        # Construction arguments, used to serialize the gradient (see `recorder`)
+        self.kind = kind
+        self.params = dict(kw)
         extend_modes = {
             'none': cairo.EXTEND_NONE,
             'pad': cairo.EXTEND_PAD,
@@ -144,6 +439,9 @@ class Gradient:
 
         stops = kw.pop('stops', [])
         extend = extend_modes.get(kw.pop('extend', 'pad'), cairo.EXTEND_PAD)
+        self.units = kw.pop('units', 'user')
+        if self.units not in ('user', 'object'):
+            raise ValueError("units must be 'user' or 'object'")
 
         if kind == 'linear':
             start = kw.get('start', (0, 0))
@@ -171,18 +469,161 @@ class Gradient:
         self.gradient = grad
 
     @classmethod
-    def linear(cls, start, end, stops, extend='pad'):
-        return cls('linear', start=start, end=end, stops=stops, extend=extend)
+    def linear(cls, start, end, stops, extend='pad', units='user'):
+        return cls('linear', start=start, end=end, stops=stops, extend=extend, units=units)
 
     @classmethod
-    def radial(cls, inner, outer, stops, extend='pad'):
-        return cls('radial', inner=inner, outer=outer, stops=stops, extend=extend)
+    def radial(cls, inner, outer, stops, extend='pad', units='user'):
+        return cls('radial', inner=inner, outer=outer, stops=stops, extend=extend, units=units)
+
+
+@functools.lru_cache(maxsize=256)
+def cached_gradient(kind, geometry, stops, extend='pad', units='user'):
+    """Returns a gradient, reusing the same object for the same (hashable) arguments.
+
+    Arguments:
+
+    - `kind` (string): `'linear'` or `'radial'`
+    - `geometry` (tuple): `(x1, y1, x2, y2)` for linear gradients, `(cx0, cy0, r0, cx1, cy1, r1)` for radial gradients
+    - `stops` (tuple): a tuple of `(offset, r, g, b, a)` tuples, with components in the 0-1 range
+    - `extend` (string): one of `'none'`, `'pad'`, `'repeat'`, `'reflect'`
+    - `units` (string): `'user'` or `'object'` (see `Gradient`)
+    """
+    if kind == 'linear':
+        return Gradient.linear(geometry[:2], geometry[2:], stops, extend=extend, units=units)
+    return Gradient.radial(geometry[:3], geometry[3:], stops, extend=extend, units=units)
+
+
+def _select_instances(values, keep, n):
+    """Select per instance values (an array or list with `n` entries) after culling"""
+    if values is None:
+        return None
+    if isinstance(values, np.ndarray):
+        if values.ndim > 0 and len(values) == n:
+            return values[keep]
+        return values
+    return [values[i] for i in keep]
+
+
+# Free canvases created with `create_graphics`, by (width, height, format, recording)
+_graphics_pool = {}
+MAX_POOLED_GRAPHICS = 8
+
+
+def clear_gradient_cache():
+    """Clear the gradients cached by `linear_gradient`, `linear_gradient_angle` and `radial_gradient`"""
+    cached_gradient.cache_clear()
+
+
+class SpriteAtlas:
+    """A set of images packed into a single surface, for drawing many image instances with `draw_sprites`.
+    Use `create_atlas` to create one.
+
+    Attributes:
+
+    - `surface`: the surface containing all the images
+    - `sizes` (array): a `(n, 2)` array with the size of each image
+    - `patterns` (list): a surface pattern for each image
+    """
+
+    def __init__(self, images, padding=1):
+        surfaces = []
+        sizes = []
+        for img in images:
+            surf, size = image_to_surface(img)
+            surfaces.append(surf)
+            sizes.append(size)
+        if not surfaces:
+            raise ValueError("An atlas requires at least one image")
+        pixel_sizes = np.array([[surf.get_width(), surf.get_height()] for surf in surfaces])
+
+        # Shelf packing, tallest images first
+        order = np.argsort(-pixel_sizes[:, 1], kind="stable")
+        padded = pixel_sizes + padding * 2
+        atlas_width = int(max(padded[:, 0].max(), np.ceil(np.sqrt(np.sum(np.prod(padded, axis=1))))))
+        offsets = np.zeros((len(surfaces), 2), dtype=int)
+        x, y, shelf_height = 0, 0, 0
+        for i in order:
+            w, h = padded[i]
+            if x + w > atlas_width:
+                x, y = 0, y + shelf_height
+                shelf_height = 0
+            offsets[i] = (x + padding, y + padding)
+            x += w
+            shelf_height = max(shelf_height, h)
+        atlas_height = int(y + shelf_height)
+
+        self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, atlas_width, atlas_height)
+        ctx = cairo.Context(self.surface)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        for surf, (x, y) in zip(surfaces, offsets):
+            ctx.set_source_surface(surf, int(x), int(y))
+            ctx.paint()
+        self.surface.flush()
+
+        self.sizes = np.array(sizes, dtype=float)
+        # Ratio between image pixels and drawing units (e.g. for Canvas images with a render scale)
+        self.pixel_scales = pixel_sizes / self.sizes
+        self.rects = np.hstack([offsets, pixel_sizes])
+        # Sub-surfaces avoid sampling neighboring images when filtering
+        self.patterns = []
+        for x, y, w, h in self.rects:
+            pattern = cairo.SurfacePattern(self.surface.create_for_rectangle(int(x), int(y), int(w), int(h)))
+            self.patterns.append(pattern)
+
+    def __len__(self):
+        return len(self.patterns)
+
+
+class Color(np.ndarray):
+    """An immutable color, behaving as a numpy array with its components.
+    Components are interpreted according to the color mode and scale of the canvas when the color is used
+    (e.g. with `fill` or `stroke`), and the normalized RGBA values are cached, so using the same color
+    object repeatedly is fast.
+
+    Arguments are the same as for `fill`: a single value for grayscale, two values for grayscale and alpha,
+    three or four values for a color (with alpha).
+    """
+
+    def __new__(cls, *args):
+        if len(args) == 1:
+            if is_number(args[0]):
+                # Assume this is Luminosity and convert to RGB
+                arr = np.ones(3, dtype=np.float32) * args[0]
+            else:
+                # Assume this is either RGB or RGBA
+                arr = np.array(args[0]).astype(np.float32).ravel()
+        elif len(args) == 2:
+            # Assume this is Luminosity and Alpha
+            arr = np.concatenate([np.ones(3) * args[0], [args[1]]]).astype(np.float32)
+        else:
+            arr = np.array(args).astype(np.float32)
+        obj = arr.view(cls)
+        obj.flags.writeable = False
+        obj._rgba = {}
+        return obj
+
+    def __array_finalize__(self, obj):
+        # Arrays derived from a color (e.g. with arithmetic) are not cached
+        self._rgba = None
+
+    def rgba(self, hsv, scale):
+        """Returns the normalized RGBA tuple for a color mode and scale (a tuple)"""
+        if self._rgba is None or self.flags.writeable:
+            return normalize_color(self.tolist(), hsv, scale)
+        key = (hsv, scale)
+        res = self._rgba.get(key)
+        if res is None:
+            res = normalize_color(self.tolist(), hsv, scale)
+            self._rgba[key] = res
+        return res
 
 
 
 @draw_states_properties(
     "cur_fill",
     "cur_stroke",
+    "_stroke_cap",
     "_stroke_join",
     "_text_halign",
     "_text_valign",
@@ -193,6 +634,9 @@ class Gradient:
     "_line_width",
     "_text_leading",
     "_angle_mode",
+    "_antialias",
+    "_tolerance",
+    "_hinting",
 )
 
 class Canvas:
@@ -204,6 +648,8 @@ class Canvas:
     - `width` : (`int`), width of the canvas in pixels
     - `height` : (`int`), height of the canvas in pixels
     - `clear_callback` (optional): function, a callback to be called when the canvas is cleared (for internal use mostly)
+    - `render_scale` (optional): float, scale of the internal raster surface relative to the canvas size (default `1.0`).
+      E.g. with `render_scale=0.5` a `1920x1080` canvas is rasterized at `960x540`, while drawing coordinates remain unchanged.
 
     In a notebook you can create a canvas globally with either of:
 
@@ -223,15 +669,22 @@ class Canvas:
         output_file="",
         recording=True,
         save_background=True,
+        render_scale=1.0,
+        format="argb32",
     ):
         """Constructor"""
         # See https://pycairo.readthedocs.io/en/latest/reference/context.html
-        surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        self._render_scale = render_scale
+        surf = cairo.ImageSurface(surface_format(format), *surface_size(width, height, render_scale))
         # surf = cairo.ImageSurface(cairo.FORMAT_RGB30, width, height)
         ctx = MultiContext(surf)  # cairo.Context(surf)
+        if render_scale != 1.0:
+            # Only the raster surface is scaled, user coordinates remain the same
+            ctx.set_base_matrix(0, cairo.Matrix(render_scale, 0, 0, render_scale, 0, 0))
 
         # Create SVG surface for saving
         self.color_scale = np.ones(4) * 255.0
+        self._color_scale_key = tuple(self.color_scale.tolist())
 
         # This is useful for py5sketch to reset SVG each time background is cleared
         self.clear_callback = clear_callback
@@ -252,9 +705,19 @@ class Canvas:
         self.last_background = background
         self._first_background = True
 
-        # Keep track of draw states
+        # Keep track of draw states, in a stack of preallocated states
+        # where `_state` is the current one (at index `_state_top`)
         self.draw_states = [CanvasState(self)]
-        self.draw_states[-1].set()
+        self._state_top = 0
+        self._state = self.draw_states[0]
+        self._state.set()
+        # Pool the canvas belongs to, if created with `create_graphics`
+        self._pool_key = None
+        # Accumulators used by `read_downsampled`, by output shape
+        self._downsample_buffers = {}
+        self._pop_context = _PopContext(self.pop)
+        self._pop_style_context = _PopContext(self.pop_style)
+        self._pop_matrix_context = _PopContext(self.pop_matrix)
 
         # self.cur_fill = self._scale_color([255.0])
         # self.cur_stroke = None
@@ -295,17 +758,30 @@ class Canvas:
 
         self.output_file = output_file
         self.recording_surface = None
+        self.recording_context = None
         if output_file or recording:
             self.recording_surface = cairo.RecordingSurface(
                 cairo.CONTENT_COLOR_ALPHA, None
             )
-            recording_context = cairo.Context(self.recording_surface)
-            self.ctx.push_context(recording_context)
+            self.recording_context = cairo.Context(self.recording_surface)
+            self.ctx.push_context(self.recording_context)
         else:
             print("Not creating recording context")
 
         self.tension = 0.5
 
+        # Offscreen layers composited on top of the canvas (see `create_layer`)
+        # into a separate output surface, which is what sketches display
+        self.layers = {}
+        self._layer_cache = None
+        self._layer_output = None
+        self._output_surf = None
+
+        # Reusable surface holding a snapshot of the canvas (see `copy` and `feedback`)
+        self._scratch = None
+        # Reusable surface and index buffers for `image_colormap`
+        self._colormap_buffers = None
+
         # self.stroke_cap('round')
         # self.stroke_join('miter')
 
@@ -326,22 +802,23 @@ class Canvas:
         if is_number(scale):
             scale = np.ones(4) * scale
         self.color_scale[: len(scale)] = scale
+        self._color_scale_key = tuple(self.color_scale.tolist())
 
     @property
     def cur_fill(self):
-        return self.draw_states[-1].cur_fill
+        return self._state.cur_fill
 
     @cur_fill.setter
     def cur_fill(self, value):
-        self.draw_states[-1].cur_fill = value
+        self._state.cur_fill = value
 
     @property
     def cur_stroke(self):
-        return self.draw_states[-1].cur_stroke
+        return self._state.cur_stroke
 
     @cur_stroke.setter
     def cur_stroke(self, value):
-        self.draw_states[-1].cur_stroke = value
+        self._state.cur_stroke = value
 
     def _get_stroke_or_fill_color(self):
         """
@@ -381,6 +858,216 @@ class Canvas:
     def surface(self):
         return self.surf
 
+    @property
+    def surface_size(self):
+        """The size in pixels of the raster surface, which differs from the canvas size if the render scale is not 1"""
+        return (self.surf.get_width(), self.surf.get_height())
+
+    @property
+    def surface_format(self):
+        """The pixel format of the raster surface, one of `"argb32"`, `"rgb24"` or `"a8"`"""
+        return format_name(self.surf.get_format())
+
+    @property
+    def render_scale(self):
+        """The scale of the raster surface relative to the canvas size"""
+        return self._render_scale
+
+    def set_render_scale(self, scale):
+        """Set the resolution of the raster surface relative to the canvas size.
+
+        The drawing coordinates do not change, so e.g. with a scale of `0.5` a `800x600` canvas is
+        rasterized at `400x300`, which can then be upscaled for display.
+        The current content of the canvas is preserved (resampled to the new resolution).
+
+        Arguments:
+
+        - `scale` (float): the render scale, `1.0` renders at full resolution
+        """
+        if scale <= 0:
+            raise ValueError("render scale must be positive")
+        if scale == self._render_scale:
+            return
+        old_ctx = self.ctx.ctxs[0]
+        old_surf = self.surf
+        user_matrix = self.ctx._user_matrix(0)
+
+        surf = cairo.ImageSurface(old_surf.get_format(), *surface_size(self._width, self._height, scale))
+        ctx = cairo.Context(surf)
+        # Carry over the current content
+        ctx.scale(surf.get_width() / old_surf.get_width(), surf.get_height() / old_surf.get_height())
+        ctx.set_source_surface(old_surf)
+        ctx.get_source().set_filter(cairo.FILTER_GOOD)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.paint()
+        ctx.identity_matrix()
+        copy_context_state(old_ctx, ctx)
+
+        self.surf = surf
+        self.ctx.surface = surf
+        self.ctx.ctxs[0] = ctx
+        self.ctx.base_matrices[0] = None
+        if scale != 1.0:
+            self.ctx.base_matrices[0] = cairo.Matrix(scale, 0, 0, scale, 0, 0)
+        self.ctx._set_user_matrix(0, user_matrix)
+        self._render_scale = scale
+
+        # Layers must match the surface resolution
+        for layer in self.layers.values():
+            layer.set_render_scale(scale)
+            layer.needs_redraw = True
+        self._layer_cache = None
+        if self._output_surf is not None:
+            self._output_surf = None
+            self.composite_layers()
+
+    def _reset_recording(self):
+        """Replace the recording surface with an empty one, keeping the current drawing state"""
+        if self.recording_surface is None:
+            return
+        i = self.ctx.ctxs.index(self.recording_context)
+        self.recording_surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+        ctx = cairo.Context(self.recording_surface)
+        copy_context_state(self.ctx.ctxs[0], ctx)
+        ctx.set_matrix(self.ctx._user_matrix(0))
+        self.ctx.ctxs[i] = ctx
+        self.recording_context = ctx
+
+    def create_layer(self, name, draw=None):
+        """Create an offscreen layer with the same size as the canvas, or return the existing layer with the same name.
+
+        Layers are transparent canvases that are composited on top of the canvas in creation order
+        at the end of each frame (or when calling `composite_layers`). The result is displayed by the sketch,
+        while the canvas itself only holds what was drawn to it, so e.g. `get_image` and `copy` do not include the layers.
+        A layer keeps its content between frames, so a static layer is drawn only once and is
+        composited from a cached image afterwards. Animated layers should call `layer.clear()`
+        before drawing each frame.
+        If the canvas records its drawing commands (`recording=True`), so do the layers,
+        which are then also included when saving to SVG or PDF.
+
+        Arguments:
+
+        - `name` (string): the name of the layer
+        - `draw` (function, optional): a function that takes the layer as an argument and draws its content.
+          It is called only when the layer needs to be redrawn, e.g. when it is created or after calling `layer.invalidate()`
+
+        Example:
+        ```
+        def draw_backdrop(layer):
+            layer.fill(0, 0, 255)
+            layer.circle(width/2, height/2, 300)
+
+        def setup():
+            create_canvas(512, 512)
+            create_layer('backdrop', draw_backdrop)
+            create_layer('foreground')
+
+        def draw():
+            background(0)
+            fg = get_layer('foreground')
+            fg.clear()
+            fg.circle(mouse_x, mouse_y, 20)
+        ```
+        """
+        if name in self.layers:
+            layer = self.layers[name]
+            if draw is not None and draw is not layer.draw_callback:
+                layer.draw_callback = draw
+                layer.invalidate()
+            return layer
+        layer = Layer(self, name, draw)
+        self.layers[name] = layer
+        self._layer_cache = None
+        return layer
+
+    def get_layer(self, name):
+        """Returns the layer with a given name"""
+        return self.layers[name]
+
+    def remove_layer(self, name):
+        """Removes the layer with a given name"""
+        if name in self.layers:
+            del self.layers[name]
+            self._layer_cache = None
+
+    def composite_layers(self):
+        """Composite the canvas and its layers (in the order they have been created) into the output surface,
+        which is what sketches display (see `get_output_buffer`). The canvas surface is not modified.
+        Layers with a draw function are redrawn first if needed.
+        If no layer has been modified since the last call, the layers are composited from a cached image.
+        Returns the output surface, which is the canvas surface if there are no visible layers.
+        """
+        self._output_surf = None
+        if not self.layers:
+            return self.surf
+        modified = False
+        for layer in self.layers.values():
+            if layer.draw_callback is not None and layer.needs_redraw:
+                layer.clear()
+                layer.draw_callback(layer)
+                layer.needs_redraw = False
+            if layer.ctx.dirty:
+                modified = True
+                layer.ctx.dirty = False
+
+        visible = [layer for layer in self.layers.values() if layer.visible and layer.opacity > 0]
+        if not visible:
+            return self.surf
+
+        if len(visible) == 1:
+            # No need to cache a single layer
+            source = visible[0].surf
+            opacity = visible[0].opacity
+        else:
+            if modified or self._layer_cache is None:
+                if self._layer_cache is None or self._layer_cache.get_width() != self.surf.get_width() or self._layer_cache.get_height() != self.surf.get_height():
+                    self._layer_cache = cairo.ImageSurface(cairo.FORMAT_ARGB32, *self.surface_size)
+                ctx = cairo.Context(self._layer_cache)
+                ctx.set_operator(cairo.OPERATOR_CLEAR)
+                ctx.paint()
+                ctx.set_operator(cairo.OPERATOR_OVER)
+                for layer in visible:
+                    ctx.set_source_surface(layer.surf)
+                    ctx.paint_with_alpha(layer.opacity)
+                self._layer_cache.flush()
+            source = self._layer_cache
+            opacity = 1.0
+
+        # The recording contexts get the layers when saving
+        if self._layer_output is None or self._layer_output.get_format() != self.surf.get_format() or \
+           (self._layer_output.get_width(), self._layer_output.get_height()) != self.surface_size:
+            self._layer_output = cairo.ImageSurface(self.surf.get_format(), *self.surface_size)
+        self.surf.flush()
+        ctx = cairo.Context(self._layer_output)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_surface(self.surf)
+        ctx.paint()
+        ctx.set_operator(cairo.OPERATOR_OVER)
+        ctx.set_source_surface(source)
+        ctx.paint_with_alpha(opacity)
+        self._layer_output.flush()
+        self._output_surf = self._layer_output
+        return self._output_surf
+
+    def get_output_buffer(self):
+        """The pixels displayed by a sketch: the canvas with its layers as of the last call to `composite_layers`,
+        or the canvas pixels if there are no layers"""
+        return self._output_image_surface().get_data()
+
+    def _output_image_surface(self, layers=True):
+        if layers and self._output_surf is not None:
+            return self._output_surf
+        return self.surf
+
+    def _paint_layers_to(self, ctx):
+        for layer in self.layers.values():
+            if layer.visible and layer.recording_surface is not None:
+                ctx.set_source_surface(layer.recording_surface)
+                if layer.opacity < 1:
+                    ctx.paint_with_alpha(layer.opacity)
+                else:
+                    ctx.paint()
+
     def no_fill(self):
         """Do not fill subsequent shapes"""
         self.fill(None)
@@ -401,6 +1088,67 @@ class Canvas:
             print('Use either "nonzero" or "evenodd"')
         self.ctx.set_fill_rule(rules[rule])
 
+    def quality(self, antialias=None, tolerance=None, hinting=None):
+        """Set the rendering quality for subsequent drawing.
+        The quality is saved and restored with `push` and `pop`, so it is possible to
+        render crowded layers quickly while keeping important shapes smooth.
+        If called with no arguments returns the current settings as a dictionary.
+
+        Arguments:
+
+        - `antialias` (string, optional): antialiasing mode, one of "none", "fast", "good", "best" or "default"
+        - `tolerance` (float, optional): the maximum error (in pixels) used when converting curves to line segments.
+          Larger values are faster but less accurate. Cairo's default is `0.1`
+        - `hinting` (string, optional): the hinting used for text, one of "none", "slight", "medium", "full" or "default"
+
+        Examples:
+
+        - `quality("fast", tolerance=0.5)` fast antialiasing and coarse curves
+        - `quality("none")` disables antialiasing
+        """
+        if antialias is None and tolerance is None and hinting is None:
+            return {"antialias": self._antialias,
+                    "tolerance": self._tolerance,
+                    "hinting": self._hinting}
+
+        if antialias is not None:
+            antialias = antialias.lower()
+            if antialias not in ANTIALIAS_MODES:
+                raise ValueError(f"Invalid antialias mode: {antialias}, choose one of {list(ANTIALIAS_MODES.keys())}")
+            self._antialias = antialias
+            self.ctx.set_antialias(ANTIALIAS_MODES[antialias])
+        if tolerance is not None:
+            if tolerance <= 0:
+                raise ValueError("tolerance must be positive")
+            self._tolerance = tolerance
+            self.ctx.set_tolerance(tolerance)
+        if hinting is not None:
+            hinting = hinting.lower()
+            if hinting not in HINT_STYLES:
+                raise ValueError(f"Invalid hinting: {hinting}, choose one of {list(HINT_STYLES.keys())}")
+            self._hinting = hinting
+        if antialias is not None or hinting is not None:
+            # Text follows the same antialiasing as shapes
+            options = cairo.FontOptions()
+            options.set_antialias(ANTIALIAS_MODES[self._antialias])
+            options.set_hint_style(HINT_STYLES[self._hinting])
+            if self._hinting == "none":
+                options.set_hint_metrics(cairo.HINT_METRICS_OFF)
+            self.ctx.set_font_options(options)
+
+    def elided_state_changes(self, reset=False):
+        """Returns a dictionary with the number of Cairo state changes (by method name) that were skipped
+        because they would not have changed the current state, e.g. setting the same fill color repeatedly.
+
+        Arguments:
+
+        - `reset` (bool): if `True` the counters are reset to zero
+        """
+        res = dict(self.ctx.elided)
+        if reset:
+            self.ctx.elided.clear()
+        return res
+
     def angle_mode(self, mode='degrees'):
         mode = mode.lower()
         if not mode in ['degrees', 'radians']:
@@ -445,16 +1193,60 @@ class Canvas:
         return mode == "hsv" or mode == "hsb"
 
     def _apply_colormode(self, clr):
-        # Convert to 0,1 scale
-        col = self._scale_color(clr)
-        # If originally user provided a string return rgba
-        if type(clr[0]) in [str, np.str_]:
-            # print("Color is string")
-            return col
-        # otherwise check if it needs HSV conversion
-        if self._is_hsv():
-            return hsv_to_rgb(col)
-        return col
+        """Convert color arguments (in the current color mode and scale) to a normalized RGBA tuple"""
+        hsv = self._is_hsv()
+        if len(clr) == 1 and isinstance(clr[0], Color):
+            return clr[0].rgba(hsv, self._color_scale_key)
+        key = color_key(clr)
+        if key is None:
+            return normalize_color(clr, hsv, self._color_scale_key)
+        return cached_color(key, hsv, self._color_scale_key)
+
+    def colors(self, values, mode=None):
+        """Convert an array of colors to a list of `Color` objects, which can then be used with `fill` and `stroke`.
+        All the colors are converted at once, which is much faster than converting them one by one,
+        e.g. when coloring many particles by hue.
+
+        Arguments:
+
+        - `values` (array): an `(n, k)` array with one color per row, where `k` is 1 (grayscale), 2 (grayscale and alpha),
+          3 (color) or 4 (color and alpha), using the current color scale
+        - `mode` (string, optional): the color mode of the values (`'rgb'` or `'hsv'`), defaults to the current color mode
+
+        Example:
+        ```
+        n = 100
+        palette = colors(np.stack([np.linspace(0, 255, n), np.full(n, 255), np.full(n, 255)], axis=1), HSB)
+        for i, clr in enumerate(palette):
+            fill(clr)
+            circle(i * 5, height/2, 10)
+        ```
+        """
+        values = np.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, np.newaxis]
+        hsv = self._is_hsv() if mode is None else mode.lower() in ("hsv", "hsb")
+        rgba = normalize_colors(values, hsv, self._color_scale_key).tolist()
+        # Colors store their components in the current color mode, with the converted values cached
+        cur_hsv = self._is_hsv()
+        if hsv != cur_hsv:
+            if cur_hsv:
+                values = rgb_to_hsv(np.array(rgba)) * self.color_scale
+            else:
+                values = np.array(rgba) * self.color_scale
+        key = (cur_hsv, self._color_scale_key)
+        res = []
+        for v, c in zip(values, rgba):
+            clr = Color(v)
+            clr._rgba[key] = tuple(c)
+            res.append(clr)
+        return res
+
+    def _normalize_colors(self, values, n):
+        """Convert per-instance colors (an array or list of colors in the current color mode) to an `(n, 4)` array"""
+        if isinstance(values, np.ndarray) and values.dtype != object:
+            return np.broadcast_to(normalize_colors(values, self._is_hsv(), self._color_scale_key), (n, 4))
+        return np.array([self._apply_colormode((v,)) for v in values])
 
     def red(self, *args):
         """Return the red component of a color.
@@ -575,7 +1367,10 @@ class Canvas:
         else:
             self.cur_fill = self._apply_colormode(args)
 
-    def linear_gradient_angle(self, *args, extend='pad'):
+    def _gradient_stops(self, stops):
+        return tuple((float(c[0]),) + tuple(self._apply_colormode((c[1],))) for c in stops)
+
+    def linear_gradient_angle(self, *args, extend='pad', units='user'):
         """Create a linear gradient fill.
 
         Can be called in two ways:
@@ -588,7 +1383,8 @@ class Canvas:
             - offset is between 0 and 1
             - color is a tuple (r, g, b[, a]) in current color mode
 
-
+        Gradients with the same arguments are cached, so the same gradient object is returned.
+        With `units='object'` the coordinates are relative to the bounding box of the filled shape (see `linear_gradient`).
         """
         if is_number(args[0]):
             x1, y1 = args[:2]
@@ -600,21 +1396,15 @@ class Canvas:
             args = args[3:]
 
         theta = self._to_radians(angle)
-        x2, y2 = x1+np.cos(theta)*length, x2+np.sin(theta)*length
+        x2, y2 = x1+np.cos(theta)*length, y1+np.sin(theta)*length
 
         if len(args) < 2:
             raise ValueError("You must provide at least 2 stops for creating a gradient")
 
-        stops = [np.concatenate([[c[0]], self._apply_colormode(c[1])]) for c in args]
-
-        return Gradient.linear(
-            (x1, y1),
-            (x2, y2),
-            stops,
-            extend=extend
-        )
+        geometry = tuple(float(v) for v in (x1, y1, x2, y2))
+        return cached_gradient('linear', geometry, self._gradient_stops(args), extend, units)
 
-    def linear_gradient(self, *args, extend='pad'):
+    def linear_gradient(self, *args, extend='pad', units='user'):
         """Create a linear gradient fill.
 
         Can be called in two ways:
@@ -627,6 +1417,11 @@ class Canvas:
             - offset is between 0 and 1
             - color is a tuple (r, g, b[, a]) in current color mode
 
+        Gradients with the same arguments are cached, so the same gradient object is returned,
+        and a gradient can also be created once (e.g. in `setup`) and reused with `fill`.
+        With `units='object'` the coordinates are relative to the bounding box of the filled shape,
+        e.g. `linear_gradient(0, 0, 1, 0, ...)` goes from the left to the right side of each shape.
+
         Example:
         ```
             fill(linear_gradient(0, 0, 200, 0,
@@ -645,16 +1440,10 @@ class Canvas:
         if len(args) < 2:
             raise ValueError("You must provide at least 2 stops for creating a gradient")
 
-        stops = [np.concatenate([[c[0]], self._apply_colormode(c[1])]) for c in args]
-
-        return Gradient.linear(
-            (x1, y1),
-            (x2, y2),
-            stops,
-            extend=extend
-        )
+        geometry = tuple(float(v) for v in (x1, y1, x2, y2))
+        return cached_gradient('linear', geometry, self._gradient_stops(args), extend, units)
 
-    def radial_gradient(self, *args, extend='pad'):
+    def radial_gradient(self, *args, extend='pad', units='user'):
         """Create a radial gradient fill.
 
         Can be called in two ways:
@@ -670,6 +1459,9 @@ class Canvas:
             - offset is between 0 and 1
             - color is a tuple (r, g, b[, a]) in current color mode
 
+        Gradients with the same arguments are cached (see `linear_gradient`).
+        With `units='object'` the coordinates are relative to the bounding box of the filled shape.
+
         Example:
         ```
             fill(radial_gradient((100, 100, 0), (100, 100, 80),
@@ -687,14 +1479,8 @@ class Canvas:
         if len(args) < 2:
             raise ValueError("You must provide at least 2 stops for creating a gradient")
 
-        stops = [np.concatenate([[c[0]], self._apply_colormode(c[1])]) for c in args]
-
-        return Gradient.radial(
-            (cx0, cy0, r0),
-            (cx1, cy1, r1),
-            stops,
-            extend=extend
-        )
+        geometry = tuple(float(v) for v in (cx0, cy0, r0, cx1, cy1, r1))
+        return cached_gradient('radial', geometry, self._gradient_stops(args), extend, units)
 
 
     def stroke(self, *args):
@@ -718,6 +1504,7 @@ class Canvas:
         Arguments:
         - The width in pixel of the stroke
         """
+        self._line_width = w
         self.ctx.set_line_width(w)
 
     def stroke_join(self, join):
@@ -728,17 +1515,13 @@ class Canvas:
         - `join` (string): can be one of "miter", "bevel" or "round"
         """
         join = join.lower()
-        joins = {
-            "miter": cairo.LINE_JOIN_MITER,
-            "bevel": cairo.LINE_JOIN_BEVEL,
-            "round": cairo.LINE_CAP_ROUND,
-        }
-        if join not in joins:
+        if join not in LINE_JOINS:
             print(str(join) + " not a valid line join")
-            print("Choose one of " + str(joins.keys()))
+            print("Choose one of " + str(LINE_JOINS.keys()))
             return
 
-        self.ctx.set_line_join(joins[join])
+        self._stroke_join = join
+        self.ctx.set_line_join(LINE_JOINS[join])
 
     line_join = stroke_join
 
@@ -768,43 +1551,12 @@ class Canvas:
           "dest", "dest_over", "dest_in", "dest_out", "dest_atop", "xor", "add", "saturate", "multiply", "screen", "overlay", "darken", "lighten", "color_dodge", "color_burn", "hard_light", "soft_light", "difference", "exclusion", "hsl_hue", "hsl_saturation", "hsl_color", "hsl_luminosity".
           See [Cairo Graphics Operators](https://www.cairographics.org/operators/) for a discussion on the different operators.
         """
-        blend_modes = {
-            "clear": cairo.OPERATOR_CLEAR,
-            "source": cairo.OPERATOR_SOURCE,
-            "over": cairo.OPERATOR_OVER,  # This is the default blend mode
-            "in": cairo.OPERATOR_IN,
-            "out": cairo.OPERATOR_OUT,
-            "atop": cairo.OPERATOR_ATOP,
-            "dest": cairo.OPERATOR_DEST,
-            "dest_over": cairo.OPERATOR_DEST_OVER,
-            "dest_in": cairo.OPERATOR_DEST_IN,
-            "dest_out": cairo.OPERATOR_DEST_OUT,
-            "dest_atop": cairo.OPERATOR_DEST_ATOP,
-            "xor": cairo.OPERATOR_XOR,
-            "add": cairo.OPERATOR_ADD,
-            "saturate": cairo.OPERATOR_SATURATE,
-            "multiply": cairo.OPERATOR_MULTIPLY,
-            "screen": cairo.OPERATOR_SCREEN,
-            "overlay": cairo.OPERATOR_OVERLAY,
-            "darken": cairo.OPERATOR_DARKEN,
-            "lighten": cairo.OPERATOR_LIGHTEN,
-            "color_dodge": cairo.OPERATOR_COLOR_DODGE,
-            "color_burn": cairo.OPERATOR_COLOR_BURN,
-            "hard_light": cairo.OPERATOR_HARD_LIGHT,
-            "soft_light": cairo.OPERATOR_SOFT_LIGHT,
-            "difference": cairo.OPERATOR_DIFFERENCE,
-            "exclusion": cairo.OPERATOR_EXCLUSION,
-            "hsl_hue": cairo.OPERATOR_HSL_HUE,
-            "hsl_saturation": cairo.OPERATOR_HSL_SATURATION,
-            "hsl_color": cairo.OPERATOR_HSL_COLOR,
-            "hsl_luminosity": cairo.OPERATOR_HSL_LUMINOSITY,
-        }
 
         mode = mode.lower()
 
         # Set the blend mode if it exists in the dictionary
-        if mode in blend_modes:
-            self.ctx.set_operator(blend_modes[mode])
+        if mode in BLEND_MODES:
+            self.ctx.set_operator(BLEND_MODES[mode])
         else:
             raise ValueError(f"Invalid blend mode: {mode}")
 
@@ -816,17 +1568,13 @@ class Canvas:
         - `cap` (string): can be one of "butt", "round" or "square"
         """
         cap = cap.lower()
-        caps = {
-            "square": cairo.LINE_CAP_BUTT,
-            "round": cairo.LINE_CAP_ROUND,
-            "project": cairo.LINE_CAP_SQUARE,
-        }
-        if cap not in caps:
+        if cap not in LINE_CAPS:
             print(str(cap) + " not a valid line cap")
-            print("Choose one of " + str(caps.keys()))
+            print("Choose one of " + str(LINE_CAPS.keys()))
             return
 
-        self.ctx.set_line_cap(caps[cap])
+        self._stroke_cap = cap
+        self.ctx.set_line_cap(LINE_CAPS[cap])
 
     line_cap = stroke_cap
 
@@ -937,16 +1685,8 @@ class Canvas:
         """
         Save the current transformation
         """
-        @contextmanager
-        def popmanager():
-            pass
-            try:
-                yield
-            finally:
-                self.pop_matrix()
-
         self.ctx.save()
-        return popmanager()
+        return self._pop_matrix_context
 
     def pop_matrix(self):
         """
@@ -954,53 +1694,91 @@ class Canvas:
         """
         self.ctx.restore()
 
+    def _push_state(self):
+        top = self._state_top + 1
+        if top == len(self.draw_states):
+            self.draw_states.append(CanvasState(self))
+        state = self.draw_states[top]
+        state.copy_from(self._state)
+        self._state_top = top
+        self._state = state
+
+    def _pop_state(self):
+        if self._state_top == 0:
+            raise IndexError("pop without a matching push")
+        old = self._state
+        self._state_top -= 1
+        self._state = self.draw_states[self._state_top]
+        return old
+
     def push_style(self):
         """
         Save the current drawing state
         """
-
-        @contextmanager
-        def popmanager():
-            pass
-            try:
-                yield
-            finally:
-                self.pop_style()
-
-        self.draw_states.append(copy.copy(self.draw_states[-1]))
-        return popmanager()
+        self._push_state()
+        return self._pop_style_context
 
     def pop_style(self):
         """
         Restore the previously pushed drawing state
         """
-        old = self.draw_states.pop()
-        self.draw_states[-1].set(old)
+        old = self._pop_state()
+        self._state.set(old)
 
     def push(self):
         """
         Save the current drawing state and transformations
         """
-
-        @contextmanager
-        def popmanager():
-            pass
-            try:
-                yield
-            finally:
-                self.pop()
-
         self.ctx.save()
-        self.draw_states.append(copy.copy(self.draw_states[-1]))
-        return popmanager()
+        self._push_state()
+        return self._pop_context
 
     def pop(self):
         """
         Restore the previously pushed drawing state and transformations
         """
         self.ctx.restore()
-        old = self.draw_states.pop()
-        self.draw_states[-1].set(old)
+        # The Cairo state (line width, caps, font size, quality...) is restored by `ctx.restore`
+        self._pop_state()
+
+    def clip(self, *args, close=True):
+        """Restrict drawing to a rectangle or a shape. Subsequent clips are intersected with the current one.
+        The clip region is saved and restored with `push` and `pop`, and it also applies to SVG/PDF output.
+        Drawing outside of the clip region has no effect, and batch functions such as `draw_instances`
+        and `draw_sprites` skip items that are fully outside of it.
+
+        Input arguments can be in the following formats:
+
+         - `x, y, w, h`: a rectangle with the top left corner and size
+         - `[x, y], [w, h]`: same as above
+         - `shape`: a polyline, a list of polylines (see `shape`) or a path created with `create_path`
+
+        Example:
+        ```
+        with push():
+            clip(100, 100, 200, 200)
+            draw_many_things()
+        ```
+        """
+        ctx = self.ctx
+        ctx.new_path()
+        if len(args) == 4:
+            ctx.rectangle(*[float(v) for v in args])
+        elif len(args) == 2:
+            (x, y), (w, h) = args
+            ctx.rectangle(float(x), float(y), float(w), float(h))
+        elif len(args) == 1:
+            if isinstance(args[0], cairo.Path):
+                ctx.append_path(args[0])
+            else:
+                ctx.append_path(self.create_path(args[0], close))
+        else:
+            raise ValueError("Wrong number of arguments for clip")
+        ctx.clip()
+
+    def no_clip(self):
+        """Remove any clip region set with `clip`"""
+        self.ctx.reset_clip()
 
     def translate(self, *args):
         """Translate by specifying `x` and `y` offset.
@@ -1076,7 +1854,13 @@ class Canvas:
 
     def _setfill(self):
         if isinstance(self.cur_fill, Gradient):
-            self.ctx.set_source(self.cur_fill.gradient)
+            grad = self.cur_fill.gradient
+            if self.cur_fill.units == 'object':
+                # Map the unit square to the bounding box of the current path
+                x1, y1, x2, y2 = self.ctx.fill_extents()
+                w, h = max(x2 - x1, 1e-9), max(y2 - y1, 1e-9)
+                grad.set_matrix(cairo.Matrix(1 / w, 0, 0, 1 / h, -x1 / w, -y1 / h))
+            self.ctx.set_source(grad)
         else:
             self.ctx.set_source_rgba(*self.cur_fill)
 
@@ -1743,12 +2527,76 @@ class Canvas:
         print("You created a turtle for the current canvas, it will not be valid if you create a new canvas!")
         return turtle.Turtle(pos, self, autodraw)
 
-    def create_graphics(self, w, h):
+    def create_graphics(self, w, h, recording=False, background=(200.0, 200.0, 200.0, 255.0), format="argb32"):
         """Create a new canvas with the specified width and height
         E.g. `c = create_graphics(128, 128)` will put a new canvas into
         the variable `c`. You can draw the contents of the canvas with the `image` function.
+
+        Canvases are taken from a pool when available, call `release()` on a canvas that is
+        not needed anymore (e.g. a scratch buffer created in `draw`) to return it to the pool.
+
+        Arguments:
+
+        - `w`, `h` (int): the size of the canvas
+        - `recording` (bool): if `True` the canvas also records drawing commands for SVG/PDF export (off by default)
+        - `background`: the initial background color, in the 0-255 range
+        - `format` (string): the pixel format, `"argb32"` (default), `"rgb24"` for opaque canvases
+          or `"a8"` for masks, which only store alpha (coverage) at a quarter of the memory
         """
-        return Canvas(w, h)
+        format = format_name(surface_format(format))
+        key = (int(w), int(h), format, bool(recording))
+        free = _graphics_pool.get(key)
+        if free:
+            c = free.pop()
+            c._recycle(background)
+        else:
+            c = Canvas(w, h, background=background, recording=recording, format=format)
+        c._pool_key = key
+        return c
+
+    def release(self):
+        """Return a canvas created with `create_graphics` to the pool, so it can be reused by a later call.
+        The canvas should not be used after releasing it."""
+        key = self._pool_key
+        if key is None:
+            return
+        self._pool_key = None
+        free = _graphics_pool.setdefault(key, [])
+        if len(free) < MAX_POOLED_GRAPHICS:
+            free.append(self)
+
+    def _recycle(self, background):
+        """Reset a pooled canvas to the state of a newly created one"""
+        ctx = self.ctx
+        ctx.reset()
+        if self.recording_surface is not None:
+            self.recording_surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
+            self.recording_context = cairo.Context(self.recording_surface)
+            ctx.push_context(self.recording_context)
+        ctx.set_fill_rule(cairo.FILL_RULE_WINDING)
+        ctx.set_line_join(cairo.LINE_JOIN_MITER)
+
+        self._color_mode = "rgb"
+        self.color_scale[:] = 255.0
+        self._color_scale_key = tuple(self.color_scale.tolist())
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_rgba(*self._apply_colormode(background))
+        ctx.paint()
+        ctx.set_operator(cairo.OPERATOR_OVER)
+        self.last_background = background
+        self._first_background = True
+
+        self._state_top = 0
+        self._state = self.draw_states[0]
+        CanvasState.__init__(self._state, self)
+        self._state.set()
+        self.no_draw = False
+        self._cur_point = []
+        self.tension = 0.5
+        self.layers = {}
+        self._layer_cache = None
+        self._layer_output = None
+        self._output_surf = None
 
     def image(self, img, *args, opacity=1.0):
         """Draw an image at position with (optional) size and (optional) opacity
@@ -1767,28 +2615,18 @@ class Canvas:
 
         """
 
-        if isinstance(img, Canvas):
-            img = img.surf
-        else:
-            if not isinstance(img, np.ndarray):
-                # This should take care of tensors and PIL Images
-                if img.mode == 'P':
-                    print("You are visualizing a quantized image, consider either converting it to 'L' or 'RGB' or 'RGBA' or using the indices")
-                    print("Converting it to RGBA.")
-                    img = img.convert('RGBA')
-                img = np.array(img)
-            img = numpy_to_surface(img)
+        img, img_size = image_to_surface(img)
         self.ctx.save()
         if len(args) == 0:
             pos = np.zeros(2)
-            size = [img.get_width(), img.get_height()]
+            size = img_size
         elif len(args) == 1:  # [x, y]
             pos = args[0]
-            size = [img.get_width(), img.get_height()]
+            size = img_size
         elif len(args) == 2:
             if is_number(args[0]):  # x, y
                 pos = args
-                size = [img.get_width(), img.get_height()]
+                size = img_size
             else:  # [x, y], [w, h]
                 pos, size = args
         elif len(args) == 4:  # x, y, w, h
@@ -1819,10 +2657,179 @@ class Canvas:
         self.ctx.paint_with_alpha(opacity)
         self.ctx.restore()
 
+    def draw_sprites(self, atlas, indices, positions, scales=1.0, rotations=0.0, opacities=1.0,
+                     anchor="center", filter="good"):
+        """Draw many instances of the images in a sprite atlas (see `create_atlas`) in a single call.
+        All the arguments except the atlas can be either single values or arrays with one entry per instance.
+
+        Arguments:
+
+        - `atlas` (SpriteAtlas): the atlas
+        - `indices` (int or array): index of the image in the atlas for each instance
+        - `positions` (array): a `(n, 2)` array of positions
+        - `scales` (float or array): scale of each instance, either a single value or an `(n, 2)` array for non-uniform scaling
+        - `rotations` (float or array): rotation of each instance (in the current angle mode)
+        - `opacities` (float or array): opacity of each instance, between 0 and 1
+        - `anchor`: the point of the image placed at each position, either `'center'`, `'corner'` or
+          a pair of coordinates relative to the image size (e.g. `[0.5, 1]` for the bottom center)
+        - `filter` (string): the filter used when scaling the images, one of `'nearest'`, `'fast'`, `'bilinear'`, `'good'` or `'best'`
+
+        Example:
+        ```
+        atlas = create_atlas([load_image('leaf.png'), load_image('petal.png')])
+
+        def draw():
+            background(255)
+            n = 1000
+            pos = np.random.uniform(0, 1, (n, 2)) * [width, height]
+            draw_sprites(atlas, np.arange(n) % 2, pos, 0.5, np.random.uniform(0, TWO_PI, n))
+        ```
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        n = len(positions)
+        if n == 0:
+            return
+        indices = np.broadcast_to(np.asarray(indices, dtype=int), (n,))
+        scales = np.asarray(scales, dtype=float)
+        if scales.ndim == 2:
+            scales = np.broadcast_to(scales, (n, 2))
+        else:
+            scales = np.broadcast_to(scales.reshape(-1, 1), (n, 2))
+        rotations = np.broadcast_to(np.asarray(rotations, dtype=float), (n,))
+        if self._angle_mode != "radians":
+            rotations = np.radians(rotations)
+        opacities = np.broadcast_to(np.asarray(opacities, dtype=float), (n,))
+
+        if isinstance(anchor, str):
+            anchor = (0.5, 0.5) if anchor == "center" else (0.0, 0.0)
+        anchor = np.asarray(anchor, dtype=float)
+        sizes = atlas.sizes[indices]
+
+        # Skip sprites outside of the clip region, using a bounding circle around each position
+        radii = np.hypot(*np.maximum(anchor, 1 - anchor)[:, np.newaxis] * sizes.T) * np.abs(scales).max(axis=1)
+        keep = self._cull(positions - radii[:, np.newaxis], positions + radii[:, np.newaxis])
+        if keep is not None:
+            positions, indices, scales = positions[keep], indices[keep], scales[keep]
+            rotations, opacities, sizes = rotations[keep], opacities[keep], sizes[keep]
+
+        k = atlas.pixel_scales[indices]
+        offset = sizes * anchor
+
+        # Inverse of T(pos) R(rot) S(scale) T(-offset) S(1/k), mapping user space to image pixels
+        cs, sn = np.cos(rotations), np.sin(rotations)
+        isx, isy = k[:, 0] / scales[:, 0], k[:, 1] / scales[:, 1]
+        xx, xy = cs * isx, sn * isx
+        yx, yy = -sn * isy, cs * isy
+        px, py = positions[:, 0], positions[:, 1]
+        x0 = -(xx * px + xy * py) + offset[:, 0] * k[:, 0]
+        y0 = -(yx * px + yy * py) + offset[:, 1] * k[:, 1]
+        matrices = np.stack([xx, yx, xy, yy, x0, y0], axis=1).tolist()
+
+        cairo_filter = IMAGE_FILTERS[filter]
+        patterns = atlas.patterns
+        for pattern in patterns:
+            pattern.set_filter(cairo_filter)
+
+        ctx = self.ctx
+        ctx.save()
+        for i, m, opacity in zip(indices.tolist(), matrices, opacities.tolist()):
+            if opacity <= 0:
+                continue
+            pattern = patterns[i]
+            pattern.set_matrix(cairo.Matrix(*m))
+            ctx.set_source(pattern)
+            if opacity < 1:
+                ctx.paint_with_alpha(opacity)
+            else:
+                ctx.paint()
+        ctx.restore()
+
+    def image_colormap(self, values, cmap="viridis", vmin=None, vmax=None, pos=None, size=None,
+                       filter="good", opacity=1.0, levels=256):
+        """Draw a 2d array of scalar values as an image, mapping values to colors with a colormap.
+        Faster than converting the values to colors with matplotlib and using `image`, since the
+        colormap is converted once to a lookup table and values are written directly to a surface.
+
+        Arguments:
+
+        - `values` (array): a 2d array of values
+        - `cmap`: the colormap, either a matplotlib colormap name (e.g. `'turbo'`), a matplotlib colormap
+          or an array of colors (with 3 or 4 components in the 0-1 range)
+        - `vmin`, `vmax` (float, optional): the range of values mapped to the colormap, defaults to the range of `values`
+        - `pos` (optional): the position of the image, defaults to `[0, 0]`
+        - `size` (optional): the size of the image, defaults to the size of `values`
+        - `filter` (string): the filter used when scaling the image, one of `'nearest'`, `'fast'`, `'bilinear'`, `'good'` or `'best'`
+        - `opacity` (float): the opacity of the image
+        - `levels` (int): number of entries in the lookup table, e.g. 256 or 4096
+
+        Example:
+        ```
+        img = np.random.uniform(0, 1, (height//4, width//4))
+        image_colormap(img, 'magma', 0, 1, [0, 0], [width, height])
+        ```
+        """
+        values = np.asarray(values)
+        if values.ndim != 2:
+            raise ValueError("image_colormap expects a 2d array of values")
+        h, w = values.shape
+        lut = colormap_lut(cmap, levels)
+
+        buffers = self._colormap_buffers
+        if buffers is None or buffers[0].get_width() != w or buffers[0].get_height() != h:
+            surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+            pixels = np.ndarray(shape=(h, surf.get_stride() // 4), dtype=np.uint32,
+                                buffer=surf.get_data())[:, :w]
+            buffers = (surf, pixels, np.empty((h, w), dtype=np.float32), np.empty((h, w), dtype=np.intp))
+            self._colormap_buffers = buffers
+        surf, pixels, t, index = buffers
+
+        if vmin is None:
+            vmin = np.nanmin(values)
+        if vmax is None:
+            vmax = np.nanmax(values)
+        n = len(lut)
+        scale = (n - 1) / (vmax - vmin) if vmax != vmin else 0.0
+        # Quantize values to table indices
+        np.subtract(values, vmin, out=t, casting="unsafe")
+        np.multiply(t, scale, out=t)
+        np.rint(t, out=t)
+        np.clip(t, 0, n - 1, out=t)
+        np.copyto(index, t, casting="unsafe")
+        # Detach any previous use of the surface (e.g. by a recording surface) before writing to it
+        surf.flush()
+        np.take(lut, index, out=pixels, mode="clip")
+        surf.mark_dirty()
+
+        if pos is None:
+            pos = (0, 0)
+        if size is None:
+            size = (w, h)
+        self.ctx.save()
+        self.ctx.translate(float(pos[0]), float(pos[1]))
+        self.ctx.scale(float(size[0]) / w, float(size[1]) / h)
+        self.ctx.set_source_surface(surf)
+        pattern = self.ctx.get_source()
+        pattern.set_filter(IMAGE_FILTERS[filter])
+        pattern.set_extend(cairo.EXTEND_PAD)
+        self.ctx.rectangle(0, 0, w, h)
+        self.ctx.clip()
+        if opacity < 1:
+            self.ctx.paint_with_alpha(opacity)
+        else:
+            self.ctx.paint()
+        self.ctx.restore()
+
     def shape(self, poly_list, close=False):
         """Draw a shape represented as a list of polylines, see the `polyline`
-        method for the format of each polyline. Also accepts a single polyline as an input
+        method for the format of each polyline. Also accepts a single polyline as an input,
+        or a `geom.ShapeBuffer`, which is added to the path in a single pass (contours flagged as closed are closed)
         """
+        from . import geom
+        if isinstance(poly_list, geom.ShapeBuffer):
+            self.begin_shape()
+            _append_shape_buffer(self.ctx, poly_list, close)
+            self.end_shape()
+            return
         if not is_compound(poly_list):
             poly_list = [poly_list]
         self.begin_shape()
@@ -1830,6 +2837,151 @@ class Canvas:
             self.polyline(P, close=close)
         self.end_shape()
 
+    def create_path(self, poly_list, close=False):
+        """Create a reusable path from a shape, see `draw_instances`.
+
+        Arguments:
+
+        - `poly_list`: a polyline, a list of polylines or a `geom.ShapeBuffer` (see `shape`)
+        - `close` (bool): if `True` the polylines are closed
+        """
+        from . import geom
+        ctx = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+        if isinstance(poly_list, geom.ShapeBuffer):
+            _append_shape_buffer(ctx, poly_list, close)
+            return ctx.copy_path()
+        if not is_compound(poly_list):
+            poly_list = [poly_list]
+        for P in poly_list:
+            P = np.asarray(P, dtype=float).tolist()
+            if not P:
+                continue
+            ctx.move_to(*P[0])
+            for p in P[1:]:
+                ctx.line_to(*p)
+            if close:
+                ctx.close_path()
+        return ctx.copy_path()
+
+    def draw_instances(self, shape, matrices, close=False, fills=None, strokes=None):
+        """Draw many copies of a shape, each transformed by an affine matrix.
+        All the copies are added to a single path, which is then filled and stroked once with the current style.
+        This is much faster than drawing each copy with `push`, `translate`, `rotate`, `shape` and `pop`.
+        Since the path is stroked once, the stroke weight is not affected by the instance transformations.
+
+        Arguments:
+
+        - `shape`: a polyline, a list of polylines (see `shape`) or a path created with `create_path`
+        - `matrices` (array): a `(n, 2, 3)` (or `(n, 3, 3)`) array of transformations, one for each copy
+        - `close` (bool): if `True` the polylines are closed (ignored if `shape` is a path)
+        - `fills` (optional): per instance fill colors, an `(n, k)` array in the current color mode (see `colors`)
+          or a list of colors. Instances with the same style are drawn as one path, so the drawing order between
+          different styles is not preserved
+        - `strokes` (optional): per instance stroke colors, as for `fills`
+
+        Example:
+        ```
+        n = 1000
+        theta = np.random.uniform(0, TWO_PI, n)
+        pos = np.random.uniform(0, 1, (n, 2)) * [width, height]
+        matrices = np.zeros((n, 2, 3))
+        matrices[:, 0, 0] = np.cos(theta)
+        matrices[:, 0, 1] = -np.sin(theta)
+        matrices[:, 1, 0] = np.sin(theta)
+        matrices[:, 1, 1] = np.cos(theta)
+        matrices[:, :, 2] = pos
+        draw_instances([[-10, -5], [10, 0], [-10, 5]], matrices, close=True)
+        ```
+        """
+        if isinstance(shape, cairo.Path):
+            path = shape
+        else:
+            path = self.create_path(shape, close)
+        matrices = np.asarray(matrices, dtype=float)
+        if len(matrices) == 0:
+            return
+
+        # Skip instances outside of the clip region
+        keep = self._cull_instances(path, matrices)
+        if keep is not None:
+            n = len(matrices)
+            matrices = matrices[keep]
+            if len(matrices) == 0:
+                return
+            fills = _select_instances(fills, keep, n)
+            strokes = _select_instances(strokes, keep, n)
+
+        # cairo.Matrix(xx, yx, xy, yy, x0, y0)
+        params = np.stack([matrices[:, 0, 0], matrices[:, 1, 0],
+                           matrices[:, 0, 1], matrices[:, 1, 1],
+                           matrices[:, 0, 2], matrices[:, 1, 2]], axis=1).tolist()
+
+        if fills is None and strokes is None:
+            self._append_instances(path, params)
+            self._fillstroke()
+            return
+
+        # Group instances by style, one path per unique fill/stroke pair
+        n = len(params)
+        style = []
+        if fills is not None and self.cur_fill is not None:
+            style.append(self._normalize_colors(fills, n))
+        if strokes is not None and self.cur_stroke is not None:
+            style.append(self._normalize_colors(strokes, n))
+        if not style:
+            self._append_instances(path, params)
+            self._fillstroke()
+            return
+        style = np.hstack(style)
+        unique, inverse = np.unique(style, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+
+        prev_fill, prev_stroke = self.cur_fill, self.cur_stroke
+        for i, row in enumerate(unique.tolist()):
+            if fills is not None and prev_fill is not None:
+                self.cur_fill = tuple(row[:4])
+                row = row[4:]
+            if strokes is not None and prev_stroke is not None:
+                self.cur_stroke = tuple(row[:4])
+            self._append_instances(path, [params[j] for j in order[bounds[i]:bounds[i + 1]]])
+            self._fillstroke()
+        self.cur_fill, self.cur_stroke = prev_fill, prev_stroke
+
+    def _cull(self, lo, hi):
+        """Returns the indices of the boxes (given by `(n, 2)` arrays of min and max corners)
+        that intersect the current clip region, or `None` if all of them do"""
+        x1, y1, x2, y2 = self.ctx.ctxs[0].clip_extents()
+        inside = (hi[:, 0] >= x1) & (lo[:, 0] <= x2) & (hi[:, 1] >= y1) & (lo[:, 1] <= y2)
+        if inside.all():
+            return None
+        return np.flatnonzero(inside)
+
+    def _cull_instances(self, path, matrices):
+        ctx = cairo.Context(cairo.ImageSurface(cairo.FORMAT_A8, 1, 1))
+        ctx.append_path(path)
+        x1, y1, x2, y2 = ctx.path_extents()
+        corners = np.array([[x1, x2, x2, x1], [y1, y1, y2, y2]])
+        pts = matrices[:, :2, :2] @ corners + matrices[:, :2, 2:]
+        lo, hi = pts.min(axis=2), pts.max(axis=2)
+        if self.cur_stroke is not None:
+            # Strokes are not transformed by the instance matrices, allow for miter joins
+            pad = self._line_width / 2
+            if self._stroke_join == "miter":
+                pad *= self.ctx.ctxs[0].get_miter_limit()
+            lo, hi = lo - pad, hi + pad
+        return self._cull(lo, hi)
+
+    def _append_instances(self, path, params):
+        ctx = self.ctx
+        base = ctx.get_matrix()
+        ctx.new_path()
+        for m in params:
+            ctx.set_matrix(cairo.Matrix(*m).multiply(base))
+            ctx.append_path(path)
+        ctx.set_matrix(base)
+
     def text(self, text, *args, align="", valign="", center=None, **kwargs):
         """Draw text at a given position
 
@@ -2153,21 +3305,106 @@ class Canvas:
         `copy(src_image, sx, sy, sw, sh, dx, dy, dw, dh)`
         or
         `copy(sx, sy, sw, sh, dx, dy, dw, dh)`
+
+        The source image can be a Canvas, a pyCairo surface, a numpy array or a PIL image.
+        Copies from a canvas or surface are done directly between surfaces, without converting to numpy.
         """
 
         if len(args) % 2 == 1:
-            img = np.array(args[0])
+            img = args[0]
             args = args[1:]
         else:
-            img = self.get_image_array()
+            img = None
 
-        if len(args) == 8:
-            sx, sy, sw, sh, dx, dy, dw, dh = args
+        if len(args) != 8:
+            raise ValueError("Unspported number of arguments for copy")
+        sx, sy, sw, sh, dx, dy, dw, dh = args
+        if sw == 0 or sh == 0:
+            return
+
+        if img is None:
+            # Copying the canvas onto itself, so take a snapshot of the source region first
+            s = self._render_scale
+            x, y = int(np.floor(sx * s)), int(np.floor(sy * s))
+            w, h = int(np.ceil((sx + sw) * s)) - x, int(np.ceil((sy + sh) * s)) - y
+            src = self._snapshot(x, y, w, h)
+            scale = s
+            ox, oy = sx * s - x, sy * s - y
         else:
-            ValueError("Unspported number of arguments for copy")
+            if isinstance(img, Canvas):
+                surf, scale = img.surf, img.render_scale
+            elif isinstance(img, cairo.Surface):
+                surf, scale = img, 1.0
+            else:
+                surf, scale = numpy_to_surface(np.array(img)), 1.0
+            src = surf.create_for_rectangle(sx * scale, sy * scale, sw * scale, sh * scale)
+            ox, oy = 0, 0
+
+        ctx = self.ctx
+        ctx.save()
+        ctx.rectangle(dx, dy, dw, dh)
+        ctx.clip()
+        ctx.translate(dx, dy)
+        ctx.scale(dw / (sw * scale), dh / (sh * scale))
+        ctx.set_source_surface(src, -ox, -oy)
+        ctx.get_source().set_extend(cairo.EXTEND_PAD)
+        ctx.paint()
+        ctx.restore()
+
+    def feedback(self, dx=0, dy=0, scale=1.0, rotation=0.0, opacity=1.0):
+        """Redraw the canvas onto itself with a transformation, for video feedback effects.
+        The transformation is applied around the center of the canvas and ignores the current
+        transformation. The result is composited with the current blend mode (see `blend_mode`).
+        The operation only affects the raster image of the canvas, not the SVG/PDF output.
+
+        Arguments:
 
-        img = img[sy : sy + sh, sx : sx + sw]
-        self.image(img, dx, dy, dw, dh)
+        - `dx`, `dy` (float): translation in pixels
+        - `scale` (float): scaling factor, values larger than one zoom in
+        - `rotation` (float): rotation in radians
+        - `opacity` (float): opacity between 0 and 1 of the transformed image
+
+        Example:
+        ```
+        def draw():
+            feedback(scale=1.01, rotation=0.01, opacity=0.95)
+            circle(mouse_x, mouse_y, 10)
+        ```
+        """
+        src = self._snapshot()
+        s = self._render_scale
+        ctx = self.ctx.ctxs[0]
+        ctx.save()
+        # Work in device space
+        ctx.identity_matrix()
+        cx, cy = src.get_width() / 2, src.get_height() / 2
+        ctx.translate(cx + dx * s, cy + dy * s)
+        ctx.rotate(rotation)
+        ctx.scale(scale, scale)
+        ctx.translate(-cx, -cy)
+        ctx.set_source_surface(src)
+        if opacity < 1:
+            ctx.paint_with_alpha(opacity)
+        else:
+            ctx.paint()
+        ctx.restore()
+        self.ctx.dirty = True
+
+    def _snapshot(self, x=0, y=0, w=None, h=None):
+        """Copy a region (in surface pixels) of the canvas into a reusable scratch surface"""
+        if w is None:
+            w, h = self.surf.get_width(), self.surf.get_height()
+        scratch = self._scratch
+        fmt = self.surf.get_format()
+        if scratch is None or scratch.get_width() != w or scratch.get_height() != h or scratch.get_format() != fmt:
+            scratch = cairo.ImageSurface(fmt, w, h)
+            self._scratch = scratch
+        ctx = cairo.Context(scratch)
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_surface(self.surf, -x, -y)
+        ctx.paint()
+        scratch.flush()
+        return scratch
 
     def background(self, *args):
         """Clear the canvas with a given color
@@ -2217,26 +3454,164 @@ class Canvas:
         # ctx.fill()
         # self.pop()
 
+    def filter(self, kind, param=None, region=None, workers=None):
+        """Apply a filter to the canvas image, in place.
+        The filter only affects the raster image of the canvas, not the SVG/PDF output.
+
+        Arguments:
+
+        - `kind` (string): one of the filter constants:
+            - `BLUR = "blur"` - Gaussian blur, `param` is the blur radius (default 1)
+            - `THRESHOLD = "threshold"` - Pixels become black or white, `param` is the threshold between 0 and 1 (default 0.5)
+            - `GRAY = "gray"` - Convert to grayscale
+            - `INVERT = "invert"` - Invert colors
+            - `POSTERIZE = "posterize"` - Limit each channel to `param` levels (default 4)
+            - `ERODE = "erode"` - Shrink light areas, `param` is the number of pixels (default 1)
+            - `DILATE = "dilate"` - Grow light areas, `param` is the number of pixels (default 1)
+            - `OPAQUE = "opaque"` - Set alpha to fully opaque
+        - `param` (optional): the filter parameter (see above)
+        - `region` (optional): a rectangle `[x, y, w, h]` (or `[[x, y], [w, h]]`) limiting the filter to a part of the canvas
+        - `workers` (int, optional): number of threads used to process the image in bands,
+          by default it depends on the image size. Use `1` to disable threading
+
+        Example:
+        ```
+        def draw():
+            background(0)
+            circle(mouse_x, mouse_y, 50)
+            filter(BLUR, 4)
+        ```
+        """
+        if callable(kind):
+            # The global `filter` hides Python's builtin in sketches
+            return builtins.filter(kind, param)
+
+        if self.surf.get_format() == cairo.FORMAT_A8:
+            raise ValueError("filter requires an argb32 or rgb24 canvas")
+        self.surf.flush()
+        pixels = pixel_view(self.surf)
+        h, w = pixels.shape[:2]
+        if self.surf.get_format() == cairo.FORMAT_RGB24:
+            # The unused byte is undefined, the filters treat it as alpha
+            pixels[:, :, 3] = 255
+        if region is not None:
+            region = np.array(region, dtype=float).ravel() * self._render_scale
+            x0, y0 = [max(0, int(np.floor(v))) for v in region[:2]]
+            x1 = min(w, int(np.ceil(region[0] + region[2])))
+            y1 = min(h, int(np.ceil(region[1] + region[3])))
+            if x1 <= x0 or y1 <= y0:
+                return
+            pixels = pixels[y0:y1, x0:x1]
+        filters.apply_filter(pixels, kind, param, workers)
+        self.surf.mark_dirty()
+        self.ctx.dirty = True
+
     def get_buffer(self):
         return self.surf.get_data()
 
-    def get_image_array(self):
-        """Get canvas image as a numpy array"""
-        img = np.ndarray(
-            shape=(self.height, self.width, 4),
-            dtype=np.uint8,
-            buffer=self.surf.get_data(),
-        )[:, :, :3].copy()
-        img = img[:, :, ::-1]
-        return img
+    def get_image_array(self, layers=False):
+        """Get canvas image as a numpy array, with shape `(height, width, 3)` (RGB)
+        or `(height, width)` (alpha) for canvases with the `"a8"` format.
+        With `layers=True` the image includes the layers as of the last `composite_layers`"""
+        surf = self._output_image_surface(layers)
+        surf.flush()
+        pixels = pixel_view(surf)
+        if pixels.ndim == 2:
+            return pixels.copy()
+        # Swap BGR to RGB while copying
+        return pixels[:, :, 2::-1].copy()
 
     def get_grayscale_array(self):
-        """Get grayscale image of canvas contents as float numpy array (0 to 1 range)"""
-        return np.mean(self.get_image_array() / 255, axis=-1)
+        """Get grayscale image of canvas contents as float numpy array (0 to 1 range).
+        For canvases with the `"a8"` format this is the alpha channel"""
+        self.surf.flush()
+        pixels = pixel_view(self.surf)
+        if pixels.ndim == 2:
+            return pixels * (1.0 / 255)
+        total = pixels[:, :, 0].astype(np.uint16)
+        total += pixels[:, :, 1]
+        total += pixels[:, :, 2]
+        return total * (1.0 / (3 * 255))
+
+    def read_downsampled(self, size, channels="gray", dtype=np.float32, out=None):
+        """Read the canvas pixels reduced by an integer factor, averaging blocks of pixels (box filter).
+        This avoids converting the full size image and is useful e.g. to compare renders with a target image in optimization loops.
 
-    def get_image(self):
-        """Get canvas as a PIL image"""
-        return Image.fromarray(self.get_image_array())
+        Arguments:
+
+        - `size`: either an integer factor, or the output size `(width, height)`.
+          In the second case each output pixel averages `surface_width // width` by `surface_height // height` surface pixels
+          and the remaining pixels at the right and bottom are ignored
+        - `channels` (string): `"gray"` (the average of the RGB channels, or alpha for `"a8"` canvases) or `"rgb"`
+        - `dtype`: the output type, floating point types give values in the 0-1 range, integer types in the 0-255 range
+        - `out` (array, optional): an array of the output shape and type that receives the result
+
+        Returns an array of shape `(height, width)` for `"gray"` or `(height, width, 3)` for `"rgb"`
+
+        Example:
+        ```
+        target = np.array(load_image('target.png').convert('L').resize((128, 128))) / 255
+        error = np.sum((read_downsampled((128, 128)) - target)**2)
+        ```
+        """
+        self.surf.flush()
+        pixels = pixel_view(self.surf)
+        h, w = pixels.shape[:2]
+        if np.isscalar(size):
+            fx = fy = int(size)
+            tw, th = w // fx, h // fy
+        else:
+            tw, th = [int(v) for v in size]
+            fx, fy = w // tw, h // th
+        if fx < 1 or fy < 1 or tw < 1 or th < 1:
+            raise ValueError("read_downsampled: the output cannot be larger than the canvas surface")
+        if channels not in ("gray", "rgb"):
+            raise ValueError("read_downsampled: channels must be 'gray' or 'rgb'")
+
+        # Split the rows and columns into blocks, this is a view of the surface data
+        pixels = pixels[: th * fy, : tw * fx]
+        count = fx * fy
+        if pixels.ndim == 2:
+            blocks = pixels.reshape(th, fy, tw, fx)
+            axes = (1, 3)
+            if channels == "rgb":
+                blocks = blocks[:, :, :, :, np.newaxis]
+        else:
+            blocks = pixels.reshape(th, fy, tw, fx, 4)
+            if channels == "gray":
+                blocks = blocks[:, :, :, :, :3]
+                axes = (1, 3, 4)
+                count *= 3
+            else:
+                blocks = blocks[:, :, :, :, 2::-1]
+                axes = (1, 3)
+        shape = (th, tw) if channels == "gray" else (th, tw, 3)
+
+        # Integer sums accumulated in a buffer that is kept between calls
+        acc = self._downsample_buffers.get(shape)
+        if acc is None:
+            acc = np.empty(shape, dtype=np.uint32)
+            self._downsample_buffers[shape] = acc
+        if blocks.shape[-1] == 1 and channels == "rgb":
+            np.sum(blocks, axis=axes, dtype=np.uint32, out=acc[:, :, :1])
+            acc[:, :, 1:] = acc[:, :, :1]
+        else:
+            np.sum(blocks, axis=axes, dtype=np.uint32, out=acc)
+
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif out.shape != shape:
+            raise ValueError("read_downsampled: out must have shape " + str(shape))
+        if np.issubdtype(out.dtype, np.floating):
+            np.multiply(acc, 1.0 / (count * 255), out=out, casting="unsafe")
+        else:
+            acc += count // 2
+            np.floor_divide(acc, count, out=out, casting="unsafe")
+        return out
+
+    def get_image(self, layers=False):
+        """Get canvas as a PIL image, with `layers=True` the image includes the layers (see `get_image_array`)"""
+        return Image.fromarray(self.get_image_array(layers))
         # img = np.ndarray (shape=(self.height, self.width, 4), dtype=np.uint8, buffer=self.surf.get_data())[:,:,:3].copy()
         # img = img[:,:,::-1]
         # return img
@@ -2248,22 +3623,26 @@ class Canvas:
         # img = np.sum(img, axis=-1)/3
         # return img/255
 
-    def save_image(self, path):
+    def save_image(self, path, layers=False):
         """Save the canvas to an image
 
         Arguments:
 
         - The path where to save
+        - `layers` (bool): if `True` the image includes the layers as of the last `composite_layers`
 
         """
-        self.surf.write_to_png(path)
+        self._output_image_surface(layers).write_to_png(path)
 
-    def save_svg(self, path):
+    def save_svg(self, path, precision=None, optimize=False, merge_tol=0.0):
         """Save the canvas to an svg file
 
         Arguments:
 
-        - The path where to save
+        - The path where to save, a `.svgz` extension saves a compressed file
+        - `precision` (int, optional): number of decimals used for coordinates, reduces the file size
+        - `optimize` (bool): reorder the stroked polylines to reduce pen-up travel when plotting (see `optimize_svg_paths`)
+        - `merge_tol` (float): with `optimize`, polylines with endpoints closer than this are merged, `None` disables merging
 
         """
         if self.recording_surface is None:
@@ -2272,8 +3651,11 @@ class Canvas:
         ctx = cairo.Context(surf)
         ctx.set_source_surface(self.recording_surface)
         ctx.paint()
+        self._paint_layers_to(ctx)
         surf.finish()
-        fix_clip_path(path, path)
+        if optimize:
+            optimize_svg_paths(path, path, merge_tol)
+        fix_clip_path(path, path, precision)
 
     def save_pdf(self, path):
         """Save the canvas to an svg file
@@ -2289,6 +3671,7 @@ class Canvas:
         ctx = cairo.Context(surf)
         ctx.set_source_surface(self.recording_surface)
         ctx.paint()
+        self._paint_layers_to(ctx)
         surf.finish()
 
     def Image(self):
@@ -2359,24 +3742,7 @@ class Canvas:
         plt.show()
 
     def _convert_html_color(self, html_color):
-        # Remove '#' if present
-        if html_color.startswith("#"):
-            html_color = html_color[1:]
-
-        # Extract RGB or RGBA components
-        if len(html_color) == 6:
-            r = int(html_color[:2], 16) / 255.0
-            g = int(html_color[2:4], 16) / 255.0
-            b = int(html_color[4:6], 16) / 255.0
-            return np.array([r, g, b, 1.0])
-        elif len(html_color) == 8:
-            r = int(html_color[:2], 16) / 255.0
-            g = int(html_color[2:4], 16) / 255.0
-            b = int(html_color[4:6], 16) / 255.0
-            a = int(html_color[6:8], 16) / 255.0
-            return np.array([r, g, b, a])
-        else:
-            raise ValueError("Invalid HTML color format")
+        return np.array(html_to_rgba(html_color))
 
     # def _convert_rgb(self, x):
     #     # DEPRECATED
@@ -2391,58 +3757,126 @@ class Canvas:
     #             x[2]/self.color_scale[2])
 
     def _scale_color(self, x):
-        if len(x) == 1:
-            if type(x[0]) == str:
-                return self._convert_html_color(x[0])
-            elif not is_number(x[0]):  # array like input
-                return self._scale_color(*x)
-                # return np.array(x[0])/self.color_scale[:len(x[0])]
-            if self._is_hsv():
-                # HSV sets value
-                return (0, 0, x[0] / self.color_scale[2], 1.0)
-            else:
-                return (
-                    x[0] / self.color_scale[0],
-                    x[0] / self.color_scale[0],
-                    x[0] / self.color_scale[0],
-                    1.0,
-                )
-        elif len(x) == 3:
-            return (
-                x[0] / self.color_scale[0],
-                x[1] / self.color_scale[1],
-                x[2] / self.color_scale[2],
-                1.0,
-            )
-        elif len(x) == 2:
-            if type(x[0]) == str:
-                clr = self._convert_html_color(x[0])
-                clr[-1] = x[1] / self.color_scale[-1]
-                return clr
-            elif not is_number(x[0]):
-                # (r, g, b), alpha case
-                if len(x[0]) != 3:
-                    raise ValueError("Need 3 components for color")
-                clr = x[0]
-                return (clr[0] / self.color_scale[0],
-                        clr[1] / self.color_scale[1],
-                        clr[2] / self.color_scale[2],
-                        x[1] / self.color_scale[3])
-            if self._is_hsv():
-                return (0, 0, x[0] / self.color_scale[2], x[1] / self.color_scale[3])
-            else:
-                return (
-                    x[0] / self.color_scale[0],
-                    x[0] / self.color_scale[0],
-                    x[0] / self.color_scale[0],
-                    x[1] / self.color_scale[3],
-                )
-        return (
-            x[0] / self.color_scale[0],
-            x[1] / self.color_scale[1],
-            x[2] / self.color_scale[2],
-            x[3] / self.color_scale[3],
-        )
+        return scale_color(x, self._is_hsv(), self.color_scale)
+
+
+class Layer(Canvas):
+    """An offscreen canvas with the same size as its parent canvas, see `Canvas.create_layer`.
+    A layer can be drawn to with the same methods as a canvas, e.g. `layer.circle(100, 100, 50)`.
+
+    Attributes:
+
+    - `name` (string): the name of the layer
+    - `visible` (bool): if `False` the layer is not composited
+    - `opacity` (float): the opacity (between 0 and 1) used when compositing the layer
+    """
+
+    def __init__(self, parent, name, draw=None):
+        # Layers keep their whole drawing history only if the parent canvas does
+        super().__init__(parent.width, parent.height,
+                         background=(0, 0, 0, 0),
+                         recording=parent.recording_surface is not None,
+                         save_background=False,
+                         render_scale=parent.render_scale)
+        self.name = name
+        self.draw_callback = draw
+        self.needs_redraw = True
+        self._visible = True
+        self._opacity = 1.0
+
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, value):
+        self._visible = value
+        self.ctx.dirty = True
+
+    @property
+    def opacity(self):
+        return self._opacity
+
+    @opacity.setter
+    def opacity(self, value):
+        self._opacity = value
+        self.ctx.dirty = True
+
+    @property
+    def dirty(self):
+        """`True` if the layer has been drawn to since it was last composited"""
+        return self.ctx.dirty
+
+    def invalidate(self):
+        """Request the layer draw function to be called before the next composite"""
+        self.needs_redraw = True
+
+    def clear(self):
+        """Clear the layer to transparent, also discarding its recorded drawing commands.
+        This cannot be called between `push` and `pop` (or the other push/pop pairs)"""
+        if self.ctx._shadow_stack:
+            raise ValueError("Layer.clear cannot be called between push and pop")
+        ctx = self.ctx.ctxs[0]
+        ctx.save()
+        ctx.set_operator(cairo.OPERATOR_CLEAR)
+        ctx.paint()
+        ctx.restore()
+        self._reset_recording()
+        self.ctx.dirty = True
+
+
+def surface_format(format):
+    """The cairo format corresponding to a format name (`"argb32"`, `"rgb24"` or `"a8"`) or a cairo format"""
+    if isinstance(format, str):
+        try:
+            return SURFACE_FORMATS[format.lower()]
+        except KeyError:
+            raise ValueError("Unsupported surface format " + format)
+    if format not in SURFACE_FORMATS.values():
+        raise ValueError("Unsupported surface format " + str(format))
+    return format
+
+
+def format_name(format):
+    """The name of a cairo surface format"""
+    for name, value in SURFACE_FORMATS.items():
+        if value == format:
+            return name
+    return str(format)
+
+
+def pixel_view(surf):
+    """Writable numpy view of the pixels of an image surface, excluding the row padding.
+    The result has shape `(height, width)` for A8 surfaces and `(height, width, 4)` (BGRA or BGRX byte order) otherwise.
+    Call `surf.flush()` before reading and `surf.mark_dirty()` after writing."""
+    w, h = surf.get_width(), surf.get_height()
+    stride = surf.get_stride()
+    if surf.get_format() == cairo.FORMAT_A8:
+        return np.ndarray(shape=(h, stride), dtype=np.uint8, buffer=surf.get_data())[:, :w]
+    return np.ndarray(shape=(h, stride // 4, 4), dtype=np.uint8, buffer=surf.get_data())[:, :w]
+
+
+def surface_size(width, height, render_scale=1.0):
+    """Size in pixels of a raster surface for a canvas of a given size and render scale"""
+    return (max(1, int(round(width * render_scale))),
+            max(1, int(round(height * render_scale))))
+
+
+def copy_context_state(src, dst):
+    """Copy the graphics state of a cairo context (excluding the transformation and clip) to another context"""
+    dst.set_source(src.get_source())
+    dst.set_operator(src.get_operator())
+    dst.set_line_width(src.get_line_width())
+    dst.set_line_cap(src.get_line_cap())
+    dst.set_line_join(src.get_line_join())
+    dst.set_miter_limit(src.get_miter_limit())
+    dst.set_dash(*src.get_dash())
+    dst.set_fill_rule(src.get_fill_rule())
+    dst.set_tolerance(src.get_tolerance())
+    dst.set_antialias(src.get_antialias())
+    dst.set_font_face(src.get_font_face())
+    dst.set_font_matrix(src.get_font_matrix())
+    dst.set_font_options(src.get_font_options())
 
 
 def radians(x):
@@ -2459,6 +3893,24 @@ import numpy as np
 import cairo
 
 
+def image_to_surface(img):
+    """Convert an image (PIL image, numpy array, Canvas or pyCairo surface) to a pycairo surface.
+    Returns the surface and the image size, which for a Canvas is its size rather than the (possibly scaled) surface size
+    """
+    if isinstance(img, Canvas):
+        return img.surf, [img.width, img.height]
+    if not isinstance(img, cairo.Surface):
+        if not isinstance(img, np.ndarray):
+            # This should take care of tensors and PIL Images
+            if img.mode == 'P':
+                print("You are visualizing a quantized image, consider either converting it to 'L' or 'RGB' or 'RGBA' or using the indices")
+                print("Converting it to RGBA.")
+                img = img.convert('RGBA')
+            img = np.array(img)
+        img = numpy_to_surface(img)
+    return img, [img.get_width(), img.get_height()]
+
+
 def numpy_to_surface(arr):
     """Convert numpy array to a pycairo surface"""
     # Get the shape and data type of the numpy array
@@ -2504,6 +3956,48 @@ def numpy_to_surface(arr):
     return surf
 
 
+_colormap_luts = {}
+
+
+def colormap_lut(cmap, levels=256):
+    """Returns a lookup table with `levels` colors of a colormap, as premultiplied ARGB32 pixels (uint32).
+    Tables for named colormaps are cached.
+
+    Arguments:
+
+    - `cmap`: a matplotlib colormap name, a matplotlib colormap or an array of colors (with 3 or 4 components in the 0-1 range)
+    - `levels` (int): number of entries in the table
+    """
+    key = None
+    if isinstance(cmap, str):
+        key = (cmap, levels)
+    elif not isinstance(cmap, np.ndarray):
+        # Keep a reference to the colormap so the id remains valid
+        key = (id(cmap), levels)
+    if key is not None and key in _colormap_luts:
+        return _colormap_luts[key][0]
+
+    t = np.linspace(0, 1, levels)
+    if isinstance(cmap, str):
+        import matplotlib
+        colors = matplotlib.colormaps[cmap](t)
+    elif callable(cmap):
+        colors = cmap(t)
+    else:
+        cmap = np.asarray(cmap, dtype=float)
+        src = np.linspace(0, 1, len(cmap))
+        colors = np.stack([np.interp(t, src, cmap[:, i]) for i in range(cmap.shape[1])], axis=-1)
+    colors = np.clip(np.asarray(colors, dtype=float), 0, 1)
+    if colors.shape[1] == 3:
+        colors = np.hstack([colors, np.ones((levels, 1))])
+    colors[:, :3] *= colors[:, 3:4]  # premultiply alpha
+    rgba = np.round(colors * 255).astype(np.uint32)
+    lut = (rgba[:, 3] << 24) | (rgba[:, 0] << 16) | (rgba[:, 1] << 8) | rgba[:, 2]
+    if key is not None:
+        _colormap_luts[key] = (lut, cmap)
+    return lut
+
+
 def create_font(name, size=None, style=None):
     """Create a font from a file or from system fonts
     Arguments:
@@ -2524,6 +4018,17 @@ def create_font(name, size=None, style=None):
     return Font(font, size, style)
 
 
+def create_atlas(images, padding=1):
+    """Create a sprite atlas from a list of images, to be used with `draw_sprites`
+
+    Arguments:
+
+    - `images` (list): a list of images (PIL images, numpy arrays, Canvas objects or pyCairo surfaces)
+    - `padding` (int): spacing in pixels between images in the atlas
+    """
+    return SpriteAtlas(images, padding)
+
+
 def show_image(im, size=None, title="", cmap="gray"):
     """Display a (numpy) image"""
     import matplotlib.pyplot as plt
@@ -2560,59 +4065,202 @@ def show_images(images, ncols, size=None, title="", cmap="gray"):
     plt.show()
 
 
-def hsv_to_rgb(hsva):
-    h, s, v = hsva[:3]
-    a = 1
-    if len(hsva) > 3:
-        a = hsva[3]
-
-    if s == 0.0:
-        r = g = b = v
+@functools.lru_cache(maxsize=256)
+def html_to_rgba(html_color):
+    """Convert an HTML color string (e.g. `'#ff0000'` or `'#ff000080'`) to an RGBA tuple in the 0-1 range"""
+    # Remove '#' if present
+    if html_color.startswith("#"):
+        html_color = html_color[1:]
+
+    # Extract RGB or RGBA components
+    if len(html_color) == 6:
+        r = int(html_color[:2], 16) / 255.0
+        g = int(html_color[2:4], 16) / 255.0
+        b = int(html_color[4:6], 16) / 255.0
+        return (r, g, b, 1.0)
+    elif len(html_color) == 8:
+        r = int(html_color[:2], 16) / 255.0
+        g = int(html_color[2:4], 16) / 255.0
+        b = int(html_color[4:6], 16) / 255.0
+        a = int(html_color[6:8], 16) / 255.0
+        return (r, g, b, a)
     else:
-        h = fmod(h, 1) / (60.0 / 360.0)
-        i = int(h)
-        f = h - i
-        p = v * (1.0 - s)
-        q = v * (1.0 - s * f)
-        t = v * (1.0 - s * (1.0 - f))
+        raise ValueError("Invalid HTML color format")
+
+
+def scale_color(x, hsv, scale):
+    """Convert color arguments to a tuple with components in the 0-1 range, without color mode conversion
 
-        if i == 0:
-            r, g, b = v, t, p
-        elif i == 1:
-            r, g, b = q, v, p
-        elif i == 2:
-            r, g, b = p, v, t
-        elif i == 3:
-            r, g, b = p, q, v
-        elif i == 4:
-            r, g, b = t, p, v
+    Arguments:
+
+    - `x`: a sequence of color arguments, as passed to `fill` or `stroke`
+    - `hsv` (bool): `True` if the color mode is HSV/HSB
+    - `scale`: the color scale for each component
+    """
+    if len(x) == 1:
+        if isinstance(x[0], str):
+            return html_to_rgba(x[0])
+        elif not is_number(x[0]):  # array like input
+            return scale_color(x[0], hsv, scale)
+        if hsv:
+            # HSV sets value
+            return (0, 0, x[0] / scale[2], 1.0)
+        else:
+            return (
+                x[0] / scale[0],
+                x[0] / scale[0],
+                x[0] / scale[0],
+                1.0,
+            )
+    elif len(x) == 3:
+        return (
+            x[0] / scale[0],
+            x[1] / scale[1],
+            x[2] / scale[2],
+            1.0,
+        )
+    elif len(x) == 2:
+        if isinstance(x[0], str):
+            r, g, b, _ = html_to_rgba(x[0])
+            return (r, g, b, x[1] / scale[-1])
+        elif not is_number(x[0]):
+            # (r, g, b), alpha case
+            if len(x[0]) != 3:
+                raise ValueError("Need 3 components for color")
+            clr = x[0]
+            return (clr[0] / scale[0],
+                    clr[1] / scale[1],
+                    clr[2] / scale[2],
+                    x[1] / scale[3])
+        if hsv:
+            return (0, 0, x[0] / scale[2], x[1] / scale[3])
         else:
-            r, g, b = v, p, q
+            return (
+                x[0] / scale[0],
+                x[0] / scale[0],
+                x[0] / scale[0],
+                x[1] / scale[3],
+            )
+    return (
+        x[0] / scale[0],
+        x[1] / scale[1],
+        x[2] / scale[2],
+        x[3] / scale[3],
+    )
 
-    return np.array([r, g, b, a])[: len(hsva)]
 
+def normalize_color(x, hsv, scale):
+    """Convert color arguments to a normalized RGBA tuple, applying the color mode (see `scale_color`)"""
+    col = scale_color(x, hsv, scale)
+    # Strings are always RGB, otherwise check if it needs HSV conversion
+    if hsv and not isinstance(x[0], str):
+        col = hsv_to_rgb(np.array(col, dtype=float))
+    return tuple([float(v) for v in col])
+
+
+def color_key(x):
+    """Returns a hashable version of color arguments, or `None` if they cannot be cached"""
+    key = []
+    for v in x:
+        if isinstance(v, (str, numbers.Number)):
+            key.append(v)
+        elif isinstance(v, np.ndarray):
+            if v.ndim != 1:
+                return None
+            key.append(tuple(v.tolist()))
+        elif isinstance(v, (tuple, list)):
+            if not all(isinstance(c, numbers.Number) for c in v):
+                return None
+            key.append(tuple(v))
+        else:
+            return None
+    return tuple(key)
 
-def rgb_to_hsv(rgba):
-    r, g, b = rgba[:3]
-    a = 1
-    if len(rgba) > 3:
-        a = rgba[-1]
 
-    K = 0
-    if g < b:
-        g, b = b, g
-        K = -1
+@functools.lru_cache(maxsize=4096)
+def cached_color(key, hsv, scale):
+    """Cached `normalize_color` for hashable arguments (see `color_key`) and color scale tuple"""
+    return normalize_color(key, hsv, scale)
+
+
+def hsv_to_rgb(hsva):
+    """Convert HSV(A) colors to RGB(A), all components in the 0-1 range.
+    Accepts a single color or an `(n, 3)` or `(n, 4)` array of colors, and returns the same shape"""
+    x = np.asarray(hsva, dtype=float)
+    single = x.ndim == 1
+    x = np.atleast_2d(x)
+    h = np.mod(x[:, 0], 1.0) * 6.0
+    s, v = x[:, 1], x[:, 2]
+    i = np.floor(h)
+    f = h - i
+    i = i.astype(int) % 6
+    p = v * (1.0 - s)
+    q = v * (1.0 - s * f)
+    t = v * (1.0 - s * (1.0 - f))
+
+    res = np.empty_like(x)
+    res[:, 0] = np.choose(i, [v, q, p, p, t, v])
+    res[:, 1] = np.choose(i, [t, v, v, q, p, p])
+    res[:, 2] = np.choose(i, [p, p, t, v, v, q])
+    res[:, 3:] = x[:, 3:]
+    return res[0] if single else res
 
-    if r < g:
-        r, g = g, r
-        K = -2 / 6 - K
 
-    chroma = r - g if g < b else r - b #r - (g < b ? g : b);
-    h = abs(K + (g - b) / (6 * chroma + 1e-20))
-    s = chroma / (r + 1e-20)
-    v = r
+def rgb_to_hsv(rgba):
+    """Convert RGB(A) colors to HSV(A), all components in the 0-1 range.
+    Accepts a single color or an `(n, 3)` or `(n, 4)` array of colors, and returns the same shape"""
+    x = np.asarray(rgba, dtype=float)
+    single = x.ndim == 1
+    x = np.atleast_2d(x)
+    r, g, b = x[:, 0], x[:, 1], x[:, 2]
+    v = np.max(x[:, :3], axis=1)
+    chroma = v - np.min(x[:, :3], axis=1)
+    safe = chroma + 1e-20
+
+    h = np.where(v == r, np.mod((g - b) / safe, 6.0),
+                 np.where(v == g, (b - r) / safe + 2.0, (r - g) / safe + 4.0))
+    h = np.where(chroma > 0, h / 6.0, 0.0)
+
+    res = np.empty_like(x)
+    res[:, 0] = h
+    res[:, 1] = chroma / (v + 1e-20)
+    res[:, 2] = v
+    res[:, 3:] = x[:, 3:]
+    return res[0] if single else res
+
+
+def normalize_colors(values, hsv, scale):
+    """Vectorized version of `normalize_color`, converts an array of colors to normalized RGBA.
 
-    return np.array([h, s, v, a])[:len(rgba)]
+    Arguments:
+
+    - `values` (array): an `(n, k)` array with one color per row, with `k` between 1 and 4 components
+      (grayscale, grayscale and alpha, color, color and alpha)
+    - `hsv` (bool): `True` if the colors are HSV/HSB
+    - `scale`: the color scale for each component
+
+    Returns an `(n, 4)` array with RGBA components in the 0-1 range
+    """
+    x = np.asarray(values, dtype=float)
+    if x.ndim == 1:
+        x = x[:, np.newaxis]
+    scale = np.asarray(scale, dtype=float)
+    n, k = x.shape
+    res = np.ones((n, 4))
+    if k <= 2:
+        if hsv:
+            # A single value sets the HSV value
+            res[:, :2] = 0
+            res[:, 2] = x[:, 0] / scale[2]
+        else:
+            res[:, :3] = x[:, :1] / scale[:3]
+        if k == 2:
+            res[:, 3] = x[:, 1] / scale[3]
+    else:
+        res[:, :k] = x / scale[:k]
+    if hsv:
+        res = hsv_to_rgb(res)
+    return res
 
 
 def cardinal_spline(Q, c, closed=False):
@@ -2688,29 +4336,206 @@ def fix_namespace(xml_content):
     return xml_content.replace("ns1:", "xlink:").replace(":ns1", ":xlink")
 
 
-def fix_clip_path(file_path, out_path):
+def fix_clip_path(file_path, out_path, precision=None, compress=None):
+    """Remove the clip path that cairo adds to the first group of an SVG file, so the drawing is not clipped to the page.
+    The file is processed in a single streaming pass, so this works with very large files (e.g. for plotters).
+
+    Arguments:
+
+    - `file_path` (string): the input SVG file
+    - `out_path` (string): the output file, can be the same as the input
+    - `precision` (int, optional): if specified, decimal numbers after the `<svg>` tag are rounded to this number of decimals
+    - `compress` (bool, optional): write gzip compressed SVG (svgz), by default if `out_path` ends with `.svgz`
+    """
+    import gzip
+
+    if compress is None:
+        compress = out_path.lower().endswith(".svgz")
+    tmp_path = out_path + ".tmp"
+    chunk_size = 1 << 20
+    with open(file_path, "rb") as src, (gzip.open(tmp_path, "wb", compresslevel=6) if compress
+                                        else open(tmp_path, "wb")) as dst:
+        # Read until the end of the first <g> start tag
+        head = b""
+        tag = None
+        while True:
+            data = src.read(chunk_size)
+            head += data
+            m = re.search(rb"<g[\s>/]", head)
+            if m is not None:
+                tag_end = head.find(b">", m.start())
+                if tag_end >= 0:
+                    tag = (m.start(), tag_end + 1)
+                    break
+            if not data:
+                break
+        if tag is not None:
+            g_tag = re.sub(rb"\s+clip-path=(\"[^\"]*\"|'[^']*')", b"", head[tag[0]:tag[1]])
+            head = head[:tag[0]] + g_tag + head[tag[1]:]
+
+        if precision is None:
+            dst.write(head)
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                dst.write(data)
+        else:
+            # Leave the XML declaration and <svg> attributes (e.g. version) unchanged
+            svg_start = head.find(b"<svg")
+            svg_end = head.find(b">", svg_start) + 1 if svg_start >= 0 else 0
+            dst.write(head[:svg_end])
+            rest = head[svg_end:]
+            while True:
+                data = src.read(chunk_size)
+                rest += data
+                if not data:
+                    dst.write(round_svg_numbers(rest, precision))
+                    break
+                # Numbers do not contain these characters, so it is safe to split there
+                cut = max(rest.rfind(b" "), rest.rfind(b'"'), rest.rfind(b">"), rest.rfind(b","))
+                if cut >= 0:
+                    dst.write(round_svg_numbers(rest[:cut], precision))
+                    rest = rest[cut:]
+    os.replace(tmp_path, out_path)
+
+
+def optimize_svg_paths(file_path, out_path, merge_tol=0.0, two_opt=0):
+    """Reorder the stroked polylines of an SVG file to reduce the pen-up travel when plotting (see `geom.optimize_paths`).
+
+    Runs of consecutive `<path>` elements that are not filled (with a `fill` attribute or style),
+    made only of straight segments and with the same attributes (stroke color, width, transform, etc.)
+    are reordered, reversed and merged together. Paths ending where they start are written as closed.
+    Other elements keep their position, so the drawing order between different styles is preserved.
+
+    Arguments:
+
+    - `file_path` (string): the input SVG file
+    - `out_path` (string): the output file, can be the same as the input
+    - `merge_tol` (float): polylines with endpoints closer than this are merged, default 0 (touching endpoints), `None` disables merging
+    - `two_opt` (int): window of the 2-opt refinement, 0 (default) disables it
+    """
     import xml.etree.ElementTree as ET
+    from . import geom
 
-    # Load the SVG file
+    ET.register_namespace("", "http://www.w3.org/2000/svg")
+    ET.register_namespace("xlink", "http://www.w3.org/1999/xlink")
     tree = ET.parse(file_path)
-    root = tree.getroot()
-    # Define the namespace
-    namespace = {"svg": "http://www.w3.org/2000/svg"}
-
-    # Find the first <g> tag
-    g_tag = root.find(".//svg:g", namespace)
-
-    # Remove the 'clip-path' attribute if it exists
-    if "clip-path" in g_tag.attrib:
-        del g_tag.attrib["clip-path"]
-    res = ET.tostring(root, encoding="unicode")
-    # Save and then apply fixes
-    tree.write(out_path, encoding="UTF-8", xml_declaration=True, default_namespace="")
-    with open(out_path, "r") as f:
-        # Fix namepace
-        txt = fix_namespace(f.read())
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write(txt)
+
+    def flush(run, children):
+        if not run:
+            return
+        polylines = []
+        for el in run:
+            polylines += _svg_polylines(el.attrib["d"])
+        for P in geom.optimize_paths(polylines, merge_tol, two_opt=two_opt, start=(0, 0)):
+            el = ET.Element(run[0].tag, run[0].attrib)
+            # Keep the join at the closing vertex of closed contours
+            closed = len(P) > 2 and np.array_equal(P[0], P[-1])
+            if closed:
+                P = P[:-1]
+            d = "M " + " L ".join("%s %s" % (_svg_float(x), _svg_float(y)) for x, y in P[:, :2])
+            el.set("d", d + (" Z " if closed else " "))
+            el.tail = "\n"
+            children.append(el)
+
+    for parent in list(tree.iter()):
+        children = []
+        run, run_key = [], None
+        for child in list(parent):
+            key = _svg_polyline_key(child)
+            if key is not None and key == run_key:
+                run.append(child)
+                continue
+            flush(run, children)
+            run, run_key = ([child], key) if key is not None else ([], None)
+            if key is None:
+                children.append(child)
+        flush(run, children)
+        parent[:] = children
+    tree.write(out_path, encoding="UTF-8", xml_declaration=True)
+
+
+_svg_polyline_data = re.compile(r"^[MLZ0-9eE.,\s+-]*$")
+_svg_path_tokens = re.compile(r"[MLZ]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def _svg_polyline_key(el):
+    """Attributes identifying the style of a stroked polyline path element, `None` for other elements"""
+    if not el.tag.endswith("path") or len(el):
+        return None
+    # Older Cairo versions write the fill in the style attribute
+    fill = _svg_style(el).get("fill", el.get("fill"))
+    if fill != "none":
+        return None
+    d = el.get("d", "")
+    if not _svg_polyline_data.match(d):
+        return None
+    return tuple(sorted((k, v) for k, v in el.attrib.items() if k != "d"))
+
+
+def _svg_style(el):
+    """The properties in the `style` attribute of an SVG element, as a dictionary"""
+    style = {}
+    for item in el.get("style", "").split(";"):
+        if ":" in item:
+            k, v = item.split(":", 1)
+            style[k.strip()] = v.strip()
+    return style
+
+
+def _svg_polylines(d):
+    """Parse the data of a path with only `M`, `L` and `Z` commands into polylines"""
+    tokens = _svg_path_tokens.findall(d)
+    polylines = []
+    P = []
+    cmd = "M"
+    i = 0
+    while i < len(tokens):
+        t = tokens[i]
+        if t in "MLZ":
+            cmd = t
+            i += 1
+            if t == "Z" and P:
+                P.append(P[0])
+                polylines.append(P)
+                # A following segment starts from the start of the closed subpath
+                P = [P[0]]
+            continue
+        pt = (float(t), float(tokens[i + 1]))
+        i += 2
+        if cmd == "M":
+            if len(P) > 1:
+                polylines.append(P)
+            P = [pt]
+            cmd = "L"
+        else:
+            P.append(pt)
+    if len(P) > 1:
+        polylines.append(P)
+    return [np.array(P) for P in polylines]
+
+
+def _svg_float(v):
+    return ("%f" % v).rstrip("0").rstrip(".")
+
+
+_svg_number = re.compile(rb"-?\d*\.\d+(?:[eE][-+]?\d+)?")
+
+
+def round_svg_numbers(data, precision):
+    """Round the decimal numbers in a bytes string to `precision` decimals, removing trailing zeros"""
+    fmt = "%%.%df" % precision
+
+    def repl(m):
+        v = fmt % float(m.group())
+        if "." in v:
+            v = v.rstrip("0").rstrip(".")
+        if v == "-0":
+            v = "0"
+        return v.encode("ascii")
+
+    return _svg_number.sub(repl, data)
 
 
 def is_compound(S):
@@ -2733,6 +4558,22 @@ def is_compound(S):
     return False
 
 
+def _append_shape_buffer(ctx, S, close=False):
+    """Add the contours of a `geom.ShapeBuffer` to the current path of a Cairo context"""
+    points = S.points[:, :2].tolist()
+    closed = (S.closed | bool(close)).tolist()
+    offsets = S.offsets.tolist()
+    move_to, line_to, close_path = ctx.move_to, ctx.line_to, ctx.close_path
+    for i, (a, b) in enumerate(zip(offsets[:-1], offsets[1:])):
+        if a == b:
+            continue
+        move_to(*points[a])
+        for p in points[a + 1:b]:
+            line_to(*p)
+        if closed[i]:
+            close_path()
+
+
 
 # Code adapted from https://www.cairographics.org/cookbook/freetypepython/
 
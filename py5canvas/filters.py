@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+'''
+Image filters operating in place on the pixels of a canvas surface (see `Canvas.filter`).
+
+The pixels are expected as a `(height, width, 4)` uint8 array in Cairo's ARGB32 layout,
+i.e. premultiplied BGRA on little endian machines. All the filters use integer arithmetic
+and separable kernels where possible. Large images can be split into horizontal bands
+that are processed in a thread pool (NumPy releases the GIL for most of the operations used here).
+'''
+
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+BLUR = 'blur'
+THRESHOLD = 'threshold'
+GRAY = 'gray'
+INVERT = 'invert'
+POSTERIZE = 'posterize'
+ERODE = 'erode'
+DILATE = 'dilate'
+OPAQUE = 'opaque'
+
+# Images with less pixels than this are processed in a single band unless requested otherwise
+MIN_PIXELS_PER_BAND = 256*256
+
+_pool = None
+_pool_size = 0
+
+
+def apply_filter(pixels, kind, param=None, workers=None):
+    ''' Apply a filter in place to a premultiplied BGRA pixel array
+
+    Arguments:
+
+    - `pixels` (array): a `(height, width, 4)` uint8 array, usually a view of a Cairo surface
+    - `kind` (string): one of `'blur'`, `'threshold'`, `'gray'`, `'invert'`, `'posterize'`, `'erode'`, `'dilate'`, `'opaque'`
+    - `param` (optional): the filter parameter, blur radius for `'blur'` (default 1),
+      threshold between 0 and 1 for `'threshold'` (default 0.5),
+      number of levels for `'posterize'` (default 4), number of iterations for `'erode'` and `'dilate'` (default 1)
+    - `workers` (int, optional): number of threads, if `None` it is chosen depending on the image size
+    '''
+    h, w = pixels.shape[:2]
+    if h == 0 or w == 0:
+        return
+    if workers is None:
+        workers = min(os.cpu_count() or 1, max(1, (w*h)//MIN_PIXELS_PER_BAND))
+    workers = max(1, min(workers, h))
+
+    kind = kind.lower()
+    if kind == BLUR:
+        radius = 1.0 if param is None else float(param)
+        radii = [r for r in box_radii(radius) if r > 0]
+        if radii:
+            _separable(pixels, lambda a, axis: _box_passes(a, radii, axis), sum(radii), workers)
+    elif kind in (ERODE, DILATE):
+        iterations = 1 if param is None else int(param)
+        if iterations > 0:
+            op = np.minimum if kind == ERODE else np.maximum
+            _separable(pixels, lambda a, axis: _rank(a, iterations, axis, op), iterations, workers)
+    elif kind == GRAY:
+        _bands(lambda y0, y1: _gray(pixels[y0:y1]), h, workers)
+    elif kind == INVERT:
+        _bands(lambda y0, y1: _invert(pixels[y0:y1]), h, workers)
+    elif kind == THRESHOLD:
+        level = 0.5 if param is None else float(param)
+        _bands(lambda y0, y1: _threshold(pixels[y0:y1], level), h, workers)
+    elif kind == POSTERIZE:
+        levels = 4 if param is None else int(param)
+        if levels < 2 or levels > 255:
+            raise ValueError("posterize requires a number of levels between 2 and 255")
+        lut = posterize_lut(levels)
+        _bands(lambda y0, y1: _apply_lut(pixels[y0:y1], lut), h, workers)
+    elif kind == OPAQUE:
+        _bands(lambda y0, y1: _opaque(pixels[y0:y1]), h, workers)
+    else:
+        raise ValueError("Unknown filter " + str(kind))
+
+
+def box_radii(sigma, n=3):
+    ''' Radii of `n` successive box filters approximating a Gaussian with standard deviation `sigma`'''
+    if sigma <= 0:
+        return []
+    ideal = np.sqrt(12*sigma*sigma/n + 1)
+    wl = int(np.floor(ideal))
+    if wl % 2 == 0:
+        wl -= 1
+    m = round((12*sigma*sigma - n*wl*wl - 4*n*wl - 3*n)/(-4*wl - 4))
+    return [(wl if i < m else wl + 2)//2 for i in range(n)]
+
+
+def posterize_lut(levels):
+    ''' Lookup table quantizing 0-255 values to a number of levels'''
+    v = np.arange(256, dtype=np.int32)
+    q = (v*(levels - 1) + 127)//255
+    return ((q*255 + (levels - 1)//2)//(levels - 1)).astype(np.uint8)
+
+
+def _get_pool(workers):
+    global _pool, _pool_size
+    if _pool is None or _pool_size < workers:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+        _pool = ThreadPoolExecutor(max_workers=workers)
+        _pool_size = workers
+    return _pool
+
+
+def _bands(func, h, workers):
+    ''' Call `func(y0, y1)` for horizontal bands covering `h` rows'''
+    if workers <= 1:
+        func(0, h)
+        return
+    edges = np.linspace(0, h, workers + 1).astype(int)
+    pool = _get_pool(workers)
+    futures = [pool.submit(func, y0, y1) for y0, y1 in zip(edges[:-1], edges[1:]) if y1 > y0]
+    for f in futures:
+        f.result()
+
+
+def _separable(pixels, func, halo, workers):
+    ''' Apply a separable filter `func(array, axis)` horizontally and then vertically.
+    The vertical pass of each band reads `halo` extra rows above and below the band'''
+    h = pixels.shape[0]
+
+    def horizontal(y0, y1):
+        pixels[y0:y1] = func(pixels[y0:y1], 1)
+    _bands(horizontal, h, workers)
+
+    # The vertical pass writes to the pixels, so bands read their neighborhood from a copy
+    src = pixels.copy() if workers > 1 else pixels
+
+    def vertical(y0, y1):
+        e0, e1 = max(0, y0 - halo), min(h, y1 + halo)
+        res = func(src[e0:e1], 0)
+        pixels[y0:y1] = res[y0 - e0:y1 - e0]
+    _bands(vertical, h, workers)
+
+
+def _padded(a, r, axis):
+    pad = [(0, 0)]*a.ndim
+    pad[axis] = (r, r)
+    return np.pad(a, pad, mode='edge')
+
+
+def _window(a, start, n, axis):
+    index = [slice(None)]*a.ndim
+    index[axis] = slice(start, start + n)
+    return a[tuple(index)]
+
+
+def _box_passes(a, radii, axis):
+    ''' Successive box filters along an axis, with integer sums and rounding'''
+    n = a.shape[axis]
+    for r in radii:
+        size = 2*r + 1
+        p = _padded(a, r, axis)
+        c = np.cumsum(p, axis=axis, dtype=np.uint32)
+        # Window sums, the first window has no preceding element in the cumulative sum
+        s = _window(c, size - 1, n, axis).copy()
+        s_tail = _window(s, 1, n - 1, axis)
+        s_tail -= _window(c, 0, n - 1, axis)
+        s += size//2
+        s //= size
+        a = s.astype(np.uint8)
+    return a
+
+
+def _rank(a, iterations, axis, op):
+    ''' Min or max filter with a window of radius `iterations` along an axis'''
+    n = a.shape[axis]
+    p = _padded(a, iterations, axis)
+    res = _window(p, 0, n, axis).copy()
+    for k in range(1, 2*iterations + 1):
+        op(res, _window(p, k, n, axis), out=res)
+    return res
+
+
+def _luminance(px):
+    # Rec. 601 weights scaled to 256, channels are in BGR order
+    return (px[:, :, 2].astype(np.uint16)*77 +
+            px[:, :, 1].astype(np.uint16)*150 +
+            px[:, :, 0].astype(np.uint16)*29) >> 8
+
+
+def _gray(px):
+    # Luminance is linear so it can be computed directly on premultiplied values
+    l = _luminance(px).astype(np.uint8)
+    px[:, :, 0] = l
+    px[:, :, 1] = l
+    px[:, :, 2] = l
+
+
+def _invert(px):
+    # With premultiplied alpha, 1 - c becomes alpha - c
+    a = px[:, :, 3:4]
+    np.subtract(a, px[:, :, :3], out=px[:, :, :3])
+
+
+def _threshold(px, level):
+    a = px[:, :, 3]
+    # Compare the unpremultiplied luminance without dividing
+    on = _luminance(px).astype(np.uint32)*255 >= np.round(level*255)*a.astype(np.uint32)
+    v = np.where(on, a, 0).astype(np.uint8)
+    px[:, :, 0] = v
+    px[:, :, 1] = v
+    px[:, :, 2] = v
+
+
+def _opaque(px):
+    # Unpremultiply the colors before setting alpha to 255, fully transparent pixels become black
+    a = px[:, :, 3]
+    partial = (a > 0) & (a < 255)
+    if np.any(partial):
+        a32 = a[partial][:, np.newaxis].astype(np.uint32)
+        c = px[partial][:, :3].astype(np.uint32)
+        px[partial, :3] = np.minimum((c*255 + a32//2)//a32, 255)
+    a[:] = 255
+
+
+def _apply_lut(px, lut):
+    a = px[:, :, 3]
+    if np.all(a == 255):
+        np.take(lut, px[:, :, :3], out=px[:, :, :3])
+        return
+    # Unpremultiply, apply the table and premultiply again
+    a32 = a[:, :, np.newaxis].astype(np.uint32)
+    c = px[:, :, :3].astype(np.uint32)
+    c = (c*255 + a32//2)//np.maximum(a32, 1)
+    c = lut[np.minimum(c, 255)].astype(np.uint32)
+    px[:, :, :3] = (c*a32 + 127)//255
@@ -61,6 +61,71 @@ def is_empty(S):
     return False
 
 
+class ShapeBuffer:
+    ''' A shape (a list of polylines) packed into a single `(N, dim)` array of points.
+        Contour `i` is `points[offsets[i]:offsets[i+1]]`, and `closed[i]` tells if it is closed.
+        Transformations, bounds and point containment operate on all the points at once'''
+    def __init__(self, points, offsets, closed=False):
+        self.points = np.asarray(points, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        n = max(len(self.offsets) - 1, 0)
+        self.closed = np.array(np.broadcast_to(closed, (n,)), dtype=bool)
+
+    @staticmethod
+    def from_list(S, closed=False, dim=None):
+        ''' Pack a polyline or a list of polylines, `closed` can be a single flag or one per contour'''
+        if isinstance(S, ShapeBuffer):
+            return S
+        if not is_compound(S):
+            S = [S]
+        S = [np.asarray(P, dtype=float) for P in S]
+        if dim is None:
+            dim = next((P.shape[1] for P in S if P.ndim == 2), 2)
+        S = [P.reshape(-1, dim) for P in S]
+        offsets = np.zeros(len(S) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(P) for P in S])
+        points = np.concatenate(S) if S else np.zeros((0, dim))
+        return ShapeBuffer(points, offsets, closed)
+
+    def to_list(self):
+        ''' Unpack into a list of `(n, dim)` arrays, one per contour'''
+        return [self.points[a:b].copy() for a, b in zip(self.offsets[:-1], self.offsets[1:])]
+
+    @property
+    def dim(self):
+        return self.points.shape[1]
+
+    def lengths(self):
+        ''' Number of points in each contour'''
+        return np.diff(self.offsets)
+
+    def contour_index(self):
+        ''' Index of the contour of each point'''
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+    def copy(self):
+        return ShapeBuffer(self.points.copy(), self.offsets.copy(), self.closed.copy())
+
+    def with_points(self, points):
+        ''' A buffer with the same contours and new points'''
+        return ShapeBuffer(points, self.offsets, self.closed)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.points[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for a, b in zip(self.offsets[:-1], self.offsets[1:]):
+            yield self.points[a:b]
+
+    def __repr__(self):
+        return 'ShapeBuffer(%d contours, %d points)'%(len(self), len(self.points))
+
+
 def vec(*args):
     return np.array(args)
 
@@ -231,6 +296,10 @@ def ray_segment_intersection( a1, a2, b1, b2 ):
 def bounding_box(S, padding=0):
     ''' Axis ligned bounding box of one or more contours (any dimension)
         Returns [min,max] list'''
+    if isinstance(S, ShapeBuffer):
+        if not len(S.points):
+            return np.array([0, 0]), np.array([0, 0])
+        return [np.min(S.points, axis=0) - padding, np.max(S.points, axis=0) + padding]
     if not is_compound(S):
         S = [S]
     if not S:
@@ -474,9 +543,13 @@ def _affine_transform_polyline(mat, P):
     dim = P[0].size
     P = np.vstack([np.array(P).T, np.ones(len(P))])
     P = mat@P
-    return list(P[:dim,:].T)
+    return P[:dim,:].T
 
 def affine_transform(mat, data):
+    if isinstance(data, ShapeBuffer):
+        mat = np.asarray(mat)
+        dim = data.dim
+        return data.with_points(data.points @ mat[:dim, :dim].T + mat[:dim, dim])
     if is_empty(data):
         # print('Empty data to affine_transform!')
         return data
@@ -501,6 +574,11 @@ tsm = affine_transform
 
 
 def projection(mat, data):
+    if isinstance(data, ShapeBuffer):
+        mat = np.asarray(mat)
+        dim = data.dim
+        P = data.points @ mat[:, :dim].T + mat[:, dim]
+        return data.with_points(P[:, :dim] / P[:, -1:])
     if is_empty(data):
         return data
     if is_polyline(data):
@@ -867,6 +945,8 @@ def is_point_in_shape(p, S, get_flags=False):
     ''' Even odd point in shape test'''
     if p is None:
         return False
+    if isinstance(S, ShapeBuffer):
+        return _is_point_in_shape_buffer(p, S, get_flags)
     c = 0
     flags = []
     for P in S:
@@ -882,3 +962,554 @@ def is_point_in_shape(p, S, get_flags=False):
     if get_flags:
         return res, flags
     return res
+
+def _is_point_in_shape_buffer(p, S, get_flags):
+    # Crossings of a horizontal ray for all the edges of all the contours at once,
+    # the first point of each contour connects to its last one
+    n = len(S)
+    lengths = S.lengths()
+    prev = np.arange(len(S.points)) - 1
+    prev[S.offsets[:-1][lengths > 0]] = S.offsets[1:][lengths > 0] - 1
+    a = S.points[:, :2]
+    b = a[prev]
+    cross = (a[:, 1] > p[1]) != (b[:, 1] > p[1])
+    ia = a[cross]
+    ib = b[cross]
+    x = (ib[:, 0] - ia[:, 0])*(p[1] - ia[:, 1])/(ib[:, 1] - ia[:, 1]) + ia[:, 0]
+    cross[cross] = p[0] < x
+    counts = np.bincount(S.contour_index()[cross], minlength=n)
+    flags = (counts%2 == 1) & (lengths >= 3)
+    res = (np.count_nonzero(flags)%2) == 1
+    if get_flags:
+        return res, flags.tolist()
+    return res
+
+def points_in_polygon(points, P, prefilter=True, grid=None):
+    ''' Boolean mask of the points (an `(n, 2)` array) that are inside a polygon,
+        see `points_in_shape`'''
+    return points_in_shape(points, [P], prefilter=prefilter, grid=grid)
+
+def points_in_shape(points, S, rule='evenodd', prefilter=True, grid=None):
+    ''' Boolean mask of the points (an `(n, 2)` array) that are inside a shape
+        (a polyline, a list of polylines or a `ShapeBuffer`), with contours implicitly closed.
+        `rule` is the fill rule, `'evenodd'` or `'nonzero'`.
+        If `prefilter` is True, points outside the bounding box of the shape are discarded first.
+        `grid` is the number of horizontal bands the edges are sorted into, so each point is only tested
+        against the edges that span its band. By default this is chosen from the number of edges, `0` disables it'''
+    rule = rule.lower()
+    if rule not in ('evenodd', 'nonzero'):
+        raise ValueError("Unknown fill rule " + str(rule))
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    S = ShapeBuffer.from_list(S)
+    inside = np.zeros(len(points), dtype=bool)
+    if not len(points) or len(S.points) < 2:
+        return inside
+
+    # Edges from each point to the next one, the first point of each contour connects to its last one
+    lengths = S.lengths()
+    nxt = np.arange(1, len(S.points) + 1)
+    nxt[S.offsets[1:][lengths > 0] - 1] = S.offsets[:-1][lengths > 0]
+    a = S.points[:, :2]
+    b = a[nxt]
+    keep = a[:, 1] != b[:, 1] # horizontal edges are never crossed
+    a, b = a[keep], b[keep]
+    sign = np.where(b[:, 1] > a[:, 1], 1, -1).astype(np.int32)
+
+    idx = np.arange(len(points))
+    if prefilter:
+        bmin, bmax = S.points[:, :2].min(axis=0), S.points[:, :2].max(axis=0)
+        idx = idx[np.all((points >= bmin) & (points <= bmax), axis=1)]
+    if not len(idx) or not len(a):
+        return inside
+
+    if grid is None:
+        grid = int(np.sqrt(len(a))) if len(a) > 64 else 0
+    if grid > 1:
+        winding = _banded_winding(points[idx], a, b, sign, grid)
+    else:
+        winding = _winding(points[idx], a, b, sign)
+    if rule == 'evenodd':
+        inside[idx] = winding%2 != 0
+    else:
+        inside[idx] = winding != 0
+    return inside
+
+def _winding(p, a, b, sign, max_block=1<<20):
+    ''' Signed ray crossings between points and edges, in blocks of points to bound memory'''
+    res = np.zeros(len(p), dtype=np.int32)
+    step = max(1, max_block//len(a))
+    dx = (b[:, 0] - a[:, 0])/(b[:, 1] - a[:, 1])
+    for i in range(0, len(p), step):
+        x = p[i:i + step, 0:1]
+        y = p[i:i + step, 1:2]
+        cross = (a[:, 1] > y) != (b[:, 1] > y)
+        cross &= x < (y - a[:, 1])*dx + a[:, 0]
+        res[i:i + step] = cross@sign
+    return res
+
+def _banded_winding(p, a, b, sign, bands):
+    ''' Same as `_winding`, with the edges bucketed by the horizontal bands they span'''
+    ymin = min(a[:, 1].min(), p[:, 1].min())
+    h = (max(a[:, 1].max(), p[:, 1].max()) - ymin)/bands or 1.
+    lo = np.clip(((np.minimum(a[:, 1], b[:, 1]) - ymin)/h).astype(int), 0, bands - 1)
+    hi = np.clip(((np.maximum(a[:, 1], b[:, 1]) - ymin)/h).astype(int), 0, bands - 1)
+    # One entry for each band spanned by each edge, sorted by band
+    counts = hi - lo + 1
+    edge = np.repeat(np.arange(len(a)), counts)
+    band = np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts) + lo[edge]
+    edge = edge[np.argsort(band, kind='stable')]
+    edge_start = np.searchsorted(np.sort(band), np.arange(bands + 1))
+
+    pband = np.clip(((p[:, 1] - ymin)/h).astype(int), 0, bands - 1)
+    order = np.argsort(pband, kind='stable')
+    point_start = np.searchsorted(pband[order], np.arange(bands + 1))
+    res = np.zeros(len(p), dtype=np.int32)
+    for k in range(bands):
+        pi = order[point_start[k]:point_start[k + 1]]
+        ei = edge[edge_start[k]:edge_start[k + 1]]
+        if len(pi) and len(ei):
+            res[pi] = _winding(p[pi], a[ei], b[ei], sign[ei])
+    return res
+
+
+# Path ordering for pen plotters
+def travel_distance(paths, start=None):
+    ''' Total distance traveled between the end of each polyline and the start of the next one
+        (the pen-up travel when plotting), starting from `start` if specified'''
+    paths = [np.asarray(P, dtype=float) for P in paths if len(P)]
+    if not paths:
+        return 0.
+    S = np.array([P[0, :2] for P in paths])
+    E = np.array([P[-1, :2] for P in paths])
+    d = np.sum(np.sqrt(np.sum((S[1:] - E[:-1])**2, axis=1)))
+    if start is not None:
+        d += np.sqrt(np.sum((S[0] - np.asarray(start, dtype=float)[:2])**2))
+    return d
+
+
+def optimize_paths(paths, merge_tol=0., reverse=True, two_opt=0, start=(0, 0)):
+    ''' Reorder a list of polylines to reduce the pen-up travel distance when plotting.
+
+    The paths are first ordered greedily, each time moving to the nearest unvisited endpoint (using a kd-tree),
+    then optionally refined with 2-opt moves that reverse short runs of consecutive paths.
+
+    Arguments:
+
+    - `paths`: a list of polylines (lists of points or arrays with one point per row)
+    - `merge_tol` (float): consecutive paths whose endpoints are closer than this are joined into one, default 0 (touching endpoints).
+      `None` (or a negative value) disables merging
+    - `reverse` (bool): allow paths to be drawn in the opposite direction, default True
+    - `two_opt` (int): the maximum number of consecutive paths reversed by a 2-opt move, 0 (default) disables the refinement.
+      Requires `reverse=True`
+    - `start`: the initial pen position, default `(0, 0)`
+
+    Returns the reordered (and possibly reversed and merged) list of polylines, as arrays
+    '''
+    from scipy.spatial import cKDTree
+
+    paths = [np.asarray(P, dtype=float) for P in paths if len(P)]
+    n = len(paths)
+    if n == 0:
+        return []
+    S = np.array([P[0, :2] for P in paths])
+    E = np.array([P[-1, :2] for P in paths])
+    start = np.asarray(start, dtype=float)[:2]
+
+    # Greedy nearest neighbor. Endpoint ids are path indices for starts and n + index for ends.
+    # The nearest endpoints to the exit point of each path are computed at once, and a kd-tree of the
+    # remaining endpoints is only queried when all of these have been visited
+    # (the loop uses Python lists, which are faster than arrays for single element access)
+    points = np.vstack([S, E]) if reverse else S
+    tree = cKDTree(points)
+    k = min(16, len(points))
+    from_end = tree.query(E, k)[1].reshape(n, k).tolist()
+    from_start = tree.query(S, k)[1].reshape(n, k).tolist() if reverse else None
+    visited = [False]*n
+    ids = None
+    num_indexed = 0
+    visited_since_build = 0
+    order = []
+    flipped = []
+    pos = start
+    candidates = np.reshape(tree.query(start, k)[1], -1).tolist()
+    for step in range(n):
+        endpoint = -1
+        for j in candidates:
+            if not visited[j % n]:
+                endpoint = j
+                break
+        if endpoint < 0:
+            # Rebuild the tree of remaining endpoints when most of the indexed ones have been visited
+            if ids is None or visited_since_build*2 > num_indexed:
+                remaining = [j for j in range(n) if not visited[j]]
+                ids = remaining + [j + n for j in remaining] if reverse else remaining
+                live = cKDTree(points[ids])
+                num_indexed = len(remaining)
+                visited_since_build = 0
+            m = min(k, len(ids))
+            while endpoint < 0:
+                for j in np.reshape(live.query(pos, m)[1], -1).tolist():
+                    if not visited[ids[j] % n]:
+                        endpoint = ids[j]
+                        break
+                m = min(m*4, len(ids))
+        i = endpoint % n
+        flip = endpoint >= n
+        visited[i] = True
+        visited_since_build += 1
+        order.append(i)
+        flipped.append(flip)
+        if flip:
+            pos, candidates = S[i], from_start[i]
+        else:
+            pos, candidates = E[i], from_end[i]
+    order = np.array(order, dtype=int)
+    flipped = np.array(flipped, dtype=bool)
+
+    if two_opt > 0 and reverse:
+        order, flipped = _two_opt_paths(S, E, order, flipped, start, two_opt)
+
+    # Join runs of paths that touch
+    A = np.where(flipped[:, None], E[order], S[order])
+    B = np.where(flipped[:, None], S[order], E[order])
+    if merge_tol is None or merge_tol < 0:
+        join = np.zeros(n - 1, dtype=bool)
+    else:
+        join = np.sum((A[1:] - B[:-1])**2, axis=1) <= merge_tol**2
+    result = []
+    run = []
+    for k, (i, flip) in enumerate(zip(order.tolist(), flipped.tolist())):
+        P = paths[i][::-1] if flip else paths[i]
+        if run and join[k - 1]:
+            # Skip the first point if it is the same as the last one
+            if np.array_equal(run[-1][-1], P[0]):
+                P = P[1:]
+            if len(P):
+                run.append(P)
+            continue
+        if run:
+            result.append(run[0] if len(run) == 1 else np.vstack(run))
+        run = [P]
+    result.append(run[0] if len(run) == 1 else np.vstack(run))
+    return result
+
+
+def _two_opt_paths(S, E, order, flipped, start, window, max_passes=5):
+    ''' Windowed 2-opt on a sequence of oriented paths. Reversing the run of paths i+1..j
+        replaces the travel b_i -> a_i+1 and b_j -> a_j+1 with b_i -> b_j and a_i+1 -> a_j+1,
+        where a and b are the start and end of the oriented paths'''
+    # A fixed first element at the start position
+    order = np.concatenate([[-1], order])
+    flipped = np.concatenate([[False], flipped])
+    m = len(order)
+
+    def endpoints():
+        A = np.where(flipped[1:, None], E[order[1:]], S[order[1:]])
+        B = np.where(flipped[1:, None], S[order[1:]], E[order[1:]])
+        return np.vstack([start, A]), np.vstack([start, B])
+
+    def dist(P, Q):
+        return np.sqrt(np.sum((P - Q)**2, axis=1))
+
+    for it in range(max_passes):
+        improved = False
+        for d in range(1, window + 1):
+            if d + 2 > m:
+                break
+            A, B = endpoints()
+            i = np.arange(0, m - d - 1)
+            j = i + d
+            gain = (dist(B[i], A[i+1]) + dist(B[j], A[j+1]) -
+                    dist(B[i], B[j]) - dist(A[i+1], A[j+1]))
+            candidates = np.nonzero(gain > 1e-9)[0]
+            if not len(candidates):
+                continue
+            # Apply the best non overlapping moves
+            occupied = np.zeros(m, dtype=bool)
+            for c in candidates[np.argsort(-gain[candidates])]:
+                a, b = i[c], j[c] + 1
+                if occupied[a:b + 1].any():
+                    continue
+                occupied[a:b + 1] = True
+                order[a + 1:b] = order[a + 1:b][::-1]
+                flipped[a + 1:b] = ~flipped[a + 1:b][::-1]
+                improved = True
+        if not improved:
+            break
+    return order[1:], flipped[1:]
+
+
+# Spatial indexing for neighbor queries
+# Radius queries of both indices return packed results: the neighbors of query `i` are
+# `indices[offsets[i]:offsets[i+1]]` (and the same range of `distances` if requested)
+class HashGrid:
+    ''' Uniform grid of cells of size `cell_size`, stored in a hash table, supporting
+        insertion and removal of points. Best suited to dynamic points (e.g. flocking) and to radius
+        queries with a radius close to the cell size. Points are identified by the id returned by `insert`
+        (or their index for `build`), which stays valid until the next `build` or `clear`'''
+    def __init__(self, cell_size, points=None):
+        self.cell_size = float(cell_size)
+        self.clear()
+        if points is not None:
+            self.build(points)
+
+    def clear(self):
+        self.points = np.zeros((0, 2))
+        self.alive = np.zeros(0, dtype=bool)
+        self._n = 0
+        self._num_indexed = 0
+        self._num_removed = 0
+        self._num_removed_indexed = 0
+
+    def build(self, points):
+        ''' Replace the contents of the grid with an `(n, dim)` array of points'''
+        self.clear()
+        points = np.array(points, dtype=float, ndmin=2)
+        self.points = points
+        self.alive = np.ones(len(points), dtype=bool)
+        self._n = len(points)
+        self._reindex()
+
+    def insert(self, points):
+        ''' Add one point or an `(n, dim)` array of points and return their ids'''
+        points = np.array(points, dtype=float, ndmin=2)
+        if not self._n:
+            self.points = np.zeros((0, points.shape[1]))
+        n = self._n + len(points)
+        if n > len(self.points):
+            # Grow the storage geometrically, so repeated single insertions are cheap
+            cap = max(n, 2*len(self.points), 64)
+            self.points = np.resize(self.points, (cap, points.shape[1]))
+            self.alive = np.resize(self.alive, cap)
+        ids = np.arange(self._n, n)
+        self.points[ids] = points
+        self.alive[ids] = True
+        self._n = n
+        return ids
+
+    def remove(self, ids):
+        ''' Remove the points with the given ids'''
+        ids = np.unique(np.asarray(ids, dtype=int).reshape(-1))
+        ids = ids[self.alive[ids]]
+        self._num_removed += len(ids)
+        self._num_removed_indexed += np.count_nonzero(ids < self._num_indexed)
+        self.alive[ids] = False
+
+    def __len__(self):
+        return self._n - self._num_removed
+
+    def query_radius(self, points, r, sort=False, return_distance=False):
+        ''' Points within distance `r` of each query point (one point or an `(m, dim)` array).
+            Returns the packed `(indices, offsets)`, or `(indices, offsets, distances)` if `return_distance` is True.
+            If `sort` is True the neighbors of each query are sorted by distance'''
+        Q = np.array(points, dtype=float, ndmin=2)
+        pending = self._n - self._num_indexed
+        if pending and (pending > max(256, self._num_indexed//16) or len(Q)*pending > 1<<22):
+            self._reindex()
+            pending = 0
+        r2 = float(r)**2
+        qs, ids, d2s = [], [], []
+        if self._num_indexed and len(Q):
+            cells = np.floor(Q/self.cell_size).astype(np.int64) - self._cell_min
+            dim = Q.shape[1]
+            m = int(np.ceil(r/self.cell_size))
+            steps = np.stack(np.meshgrid(*[np.arange(-m, m + 1)]*dim, indexing='ij'), -1).reshape(-1, dim)
+            # Visit the queries in cell order, so consecutive queries read the same points
+            qorder = np.argsort(cells@self._radix, kind='stable')
+            block = max(1, (1<<18)//len(steps))
+            for a in range(0, len(Q), block):
+                qi = qorder[a:a + block]
+                c = (cells[qi, np.newaxis] + steps).reshape(-1, dim)
+                valid = np.all((c >= 0) & (c < self._span), axis=1)
+                q = np.repeat(qi, len(steps))[valid]
+                key = c[valid]@self._radix
+                slot = self._slot(key)
+                s = self._start[slot]
+                count = self._start[slot + 1] - s
+                # Position of each candidate in the sorted points
+                first = np.cumsum(count) - count
+                j = np.arange(first[-1] + count[-1] if len(count) else 0) - np.repeat(first - s, count)
+                q = np.repeat(q, count)
+                if not self._direct:
+                    # Different cells can share a slot of the hash table
+                    same = self._keys[j] == np.repeat(key, count)
+                    q, j = q[same], j[same]
+                d2 = np.sum((self._sorted_points[j] - Q[q])**2, axis=1)
+                keep = d2 <= r2
+                q, j, d2 = q[keep], self._order[j[keep]], d2[keep]
+                if self._num_removed_indexed:
+                    keep = self.alive[j]
+                    q, j, d2 = q[keep], j[keep], d2[keep]
+                qs.append(q); ids.append(j); d2s.append(d2)
+        if pending:
+            # Points inserted since the grid was last indexed are tested directly
+            j = np.arange(self._num_indexed, self._n)
+            j = j[self.alive[j]]
+            d2 = np.sum((Q[:, np.newaxis] - self.points[j])**2, axis=2)
+            q, k = np.nonzero(d2 <= r2)
+            qs.append(q); ids.append(j[k]); d2s.append(d2[q, k])
+        return _pack_neighbors(len(Q), qs, ids, d2s, sort, return_distance)
+
+    def query_knn(self, points, k):
+        ''' The `k` nearest neighbors of each query point (one point or an `(m, dim)` array).
+            Returns `(indices, distances)`, two `(m, k)` arrays sorted by distance.
+            Missing neighbors (if there are less than `k` points) have index -1 and infinite distance'''
+        Q = np.array(points, dtype=float, ndmin=2)
+        indices = np.full((len(Q), k), -1)
+        distances = np.full((len(Q), k), np.inf)
+        alive = np.nonzero(self.alive[:self._n])[0]
+        if not len(alive) or not k:
+            return indices, distances
+        # All the points are within this distance of each query
+        P = self.points[alive]
+        far = norm(np.maximum(np.abs(Q - P.min(axis=0)), np.abs(Q - P.max(axis=0))), axis=1)
+        # Grow the search radius until enough neighbors are found
+        todo = np.arange(len(Q))
+        r = self.cell_size
+        while len(todo) and r <= 8*self.cell_size:
+            ind, off, d = self.query_radius(Q[todo], r, sort=True, return_distance=True)
+            count = np.diff(off)
+            done = (count >= k) | (far[todo] <= r)
+            _fill_knn(indices, distances, todo[done], ind, d, off[:-1][done], np.minimum(count[done], k))
+            todo = todo[~done]
+            r *= 2
+        if len(todo):
+            # Isolated queries, search all the points
+            ind, d = _brute_knn(Q[todo], P, k)
+            indices[todo] = np.where(ind >= 0, alive[np.maximum(ind, 0)], -1)
+            distances[todo] = d
+        return indices, distances
+
+    def _slot(self, key):
+        if self._direct:
+            return key
+        # Fibonacci hashing of the cell keys
+        h = key.astype(np.uint64)*np.uint64(0x9E3779B97F4A7C15)
+        return (h >> np.uint64(64 - self._table_bits)).astype(np.int64)
+
+    def _reindex(self):
+        ''' Sort the points by cell, the points of table slot `i` are `_order[_start[i]:_start[i+1]]`.
+            Cells are identified by an integer key, and the table is indexed directly by the key
+            if there are not too many cells, otherwise it is a hash table'''
+        ids = np.nonzero(self.alive[:self._n])[0]
+        dim = self.points.shape[1]
+        cells = np.floor(self.points[ids]/self.cell_size).astype(np.int64)
+        if len(ids):
+            self._cell_min = cells.min(axis=0)
+            self._span = cells.max(axis=0) - self._cell_min + 1
+        else:
+            self._cell_min = np.zeros(dim, dtype=np.int64)
+            self._span = np.ones(dim, dtype=np.int64)
+        num_cells = 1
+        for v in self._span:
+            num_cells *= int(v)
+        if num_cells >= 1<<62:
+            raise ValueError("HashGrid: too many cells, the cell size is too small for the extent of the points")
+        self._radix = np.concatenate([[1], np.cumprod(self._span[:-1])]).astype(np.int64)
+        keys = (cells - self._cell_min)@self._radix
+        self._direct = num_cells <= max(4*len(ids), 1<<16)
+        if self._direct:
+            size = num_cells
+        else:
+            self._table_bits = max(10, int(np.ceil(np.log2(max(len(ids), 1)))) + 1)
+            size = 1 << self._table_bits
+        slots = self._slot(keys)
+        order = np.argsort(slots, kind='stable')
+        self._order = ids[order]
+        self._keys = keys[order]
+        self._sorted_points = self.points[self._order]
+        self._start = np.searchsorted(slots[order], np.arange(size + 1))
+        self._num_indexed = self._n
+        self._num_removed_indexed = 0
+
+
+
+class KDTree:
+    ''' Static KD-tree (built with `scipy.spatial.cKDTree`) with the same queries as `HashGrid`.
+        Faster to query than a grid when the points are not uniformly distributed or
+        the query radius varies, but it must be rebuilt when the points change'''
+    def __init__(self, points=None, leafsize=16):
+        self.leafsize = leafsize
+        self.tree = None
+        if points is not None:
+            self.build(points)
+
+    def build(self, points):
+        ''' Build the tree for an `(n, dim)` array of points'''
+        from scipy.spatial import cKDTree
+        self.points = np.array(points, dtype=float, ndmin=2)
+        self.tree = cKDTree(self.points, leafsize=self.leafsize)
+
+    def __len__(self):
+        return 0 if self.tree is None else len(self.points)
+
+    def query_radius(self, points, r, sort=False, return_distance=False):
+        ''' Points within distance `r` of each query point, see `HashGrid.query_radius`'''
+        from scipy.spatial import cKDTree
+        Q = np.array(points, dtype=float, ndmin=2)
+        if not len(self) or not len(Q):
+            return _pack_neighbors(len(Q), [], [], [], sort, return_distance)
+        pairs = self.tree.sparse_distance_matrix(cKDTree(Q, leafsize=self.leafsize), r, output_type='ndarray')
+        return _pack_neighbors(len(Q), [pairs['j']], [pairs['i']], [pairs['v']**2], sort, return_distance)
+
+    def query_knn(self, points, k):
+        ''' The `k` nearest neighbors of each query point, see `HashGrid.query_knn`'''
+        Q = np.array(points, dtype=float, ndmin=2)
+        if not len(self) or not k:
+            return np.full((len(Q), k), -1), np.full((len(Q), k), np.inf)
+        d, ind = self.tree.query(Q, k)
+        d, ind = d.reshape(len(Q), k), ind.reshape(len(Q), k)
+        ind[ind >= len(self.points)] = -1
+        return ind, d
+
+
+def _pack_neighbors(n, qs, ids, d2s, sort, return_distance):
+    ''' Group (query, point, squared distance) pairs by query'''
+    if qs:
+        q, ids, d2 = np.concatenate(qs), np.concatenate(ids), np.concatenate(d2s)
+    else:
+        q, ids, d2 = np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    order = np.argsort(q, kind='stable')
+    q, ids, d2 = q[order], ids[order], d2[order]
+    counts = np.bincount(q, minlength=n)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if sort and len(q):
+        width = counts.max()
+        if n*width <= 4*len(q) + (1<<16):
+            # Sort the rows of a padded (queries, neighbors) array, much faster than a lexsort
+            col = np.arange(len(q)) - offsets[q]
+            padded = np.full((n, width), np.inf)
+            padded[q, col] = d2
+            order = (offsets[:-1, np.newaxis] + np.argsort(padded, axis=1))[np.arange(width) < counts[:, np.newaxis]]
+        else:
+            order = np.lexsort((d2, q))
+        ids, d2 = ids[order], d2[order]
+    if return_distance:
+        return ids, offsets, np.sqrt(d2)
+    return ids, offsets
+
+
+def _fill_knn(indices, distances, rows, ind, d, start, count):
+    ''' Copy the first `count` packed neighbors of each query to the rows of the k-NN result'''
+    r = np.repeat(np.arange(len(rows)), count)
+    col = np.arange(len(r)) - np.repeat(np.cumsum(count) - count, count)
+    src = start[r] + col
+    indices[rows[r], col] = ind[src]
+    distances[rows[r], col] = d[src]
+
+
+def _brute_knn(Q, P, k, max_block=1<<22):
+    ''' k nearest neighbors by exhaustive search, in blocks of queries'''
+    kk = min(k, len(P))
+    indices = np.full((len(Q), k), -1)
+    distances = np.full((len(Q), k), np.inf)
+    step = max(1, max_block//len(P))
+    for a in range(0, len(Q), step):
+        d2 = np.sum((Q[a:a + step, np.newaxis] - P)**2, axis=2)
+        ind = np.argpartition(d2, kk - 1, axis=1)[:, :kk]
+        dk = np.take_along_axis(d2, ind, axis=1)
+        o = np.argsort(dk, axis=1)
+        indices[a:a + step, :kk] = np.take_along_axis(ind, o, axis=1)
+        distances[a:a + step, :kk] = np.sqrt(np.take_along_axis(dk, o, axis=1))
+    return indices, distances
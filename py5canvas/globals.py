@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import numpy as np
 from . import canvas
+from . import parallel
 from math import hypot, comb
 import os
 from PIL import Image, ImageChops, ImageFilter, ImageOps
@@ -37,6 +38,22 @@ PROJECT = 'project'
 DEGREES = "degrees"
 RADIANS = "radians"
 
+# Antialias modes (see `quality`)
+NONE = "none"
+FAST = "fast"
+GOOD = "good"
+BEST = "best"
+
+# Filters (see `filter`)
+BLUR = "blur"
+THRESHOLD = "threshold"
+GRAY = "gray"
+INVERT = "invert"
+POSTERIZE = "posterize"
+ERODE = "erode"
+DILATE = "dilate"
+OPAQUE = "opaque"
+
 # Blend modes
 BLEND = "over"
 REPLACE = "source"
@@ -78,6 +95,8 @@ degrees = canvas.degrees
 constrain = np.clip
 
 create_font = canvas.create_font
+create_atlas = canvas.create_atlas
+evaluate_population = parallel.evaluate_population
 
 dragging = None
 mouse_is_pressed = None
@@ -114,26 +133,15 @@ def is_number(x):
     return isinstance(x, numbers.Number)
 
 def color(*args):
-    ''' Create a cector with components specified as comma-separated values.
-    :returns: A NumPy array representing the specified color components.
+    ''' Create a color with components specified as comma-separated values.
+    :returns: An immutable `Color`, a NumPy array representing the specified color components.
     This returns either a 3d (RGB) array if 3 or 1 (luminosity) components are specified,
     or a 4d (RGBA) array if 4 or 2 components are specified.
+    Colors are converted to the canvas color mode once and cached, so reusing them with `fill` and `stroke` is fast.
     '''
-    if len(args) == 1:
-        if is_number(args[0]):
-            # Assume this is Luminosity and convert to RGB
-            return np.ones(3, dtype=np.float32)*args[0]
-        else:
-            # Assume this is either RGB or RGBA
-            return np.array(args).astype(np.float32)
-    else:
-        if len(args) == 2:
-            # Assume this is Luminosity and Alpha
-            return np.concatenate([np.ones(3)*args[0], [args[1]]]).astype(np.float32)
-        else:
-            return np.array(args).astype(np.float32)
+    return canvas.Color(*args)
 
-Color = color
+Color = canvas.Color
 
 def vector(*args):
     ''' Create a vector with components specified as comma-separated values
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+'''
+Parallel rendering of many candidate drawings, e.g. the members of a population in an evolutionary sketch
+(see `evaluate_population`).
+
+Each worker process keeps its own private `Canvas` (one per size and format) for the lifetime of the pool,
+so the only data moving between processes are the genomes, the scores and, when requested,
+the downsampled images, which are written directly into shared memory.
+'''
+
+import numpy as np
+import os
+import pickle
+import sys
+import atexit
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from . import canvas
+
+_pool = None
+_pool_workers = 0
+_shared = None
+
+# On Linux the workers are forked, and inherit the render and score functions from the parent
+# instead of receiving them pickled. This also works for functions defined in a sketch
+_fork = sys.platform.startswith('linux')
+_pool_functions = None
+
+# Canvases private to the current process, by (width, height, format)
+_canvases = {}
+
+
+def evaluate_population(render_fn, genomes, size, score_fn=None, workers=None, downsample=None,
+                        channels='gray', background=255, format='argb32', args=()):
+    ''' Render a list of genomes in parallel and score them or read back their (downsampled) images
+
+    Arguments:
+
+    - `render_fn`: a function `render_fn(c, genome, *args)` drawing a genome into the canvas `c`,
+      e.g. `c.rect(...)`. The drawing state is restored after each call
+    - `genomes`: a list (or array) of genomes, any picklable objects
+    - `size`: the canvas size `(width, height)`
+    - `score_fn` (optional): a function `score_fn(c, genome, *args)` returning a number for the rendered canvas,
+      e.g. comparing `c.read_downsampled(...)` with a target image
+    - `workers` (int, optional): the number of processes, by default the number of CPUs. With `1` the genomes are rendered in the calling process
+    - `downsample` (optional): factor or output size passed to `read_downsampled` when no `score_fn` is given, default `1`
+    - `channels` (string): `'gray'` or `'rgb'`, the channels of the returned images
+    - `background` (optional): the color the canvas is cleared with before each render, `None` to skip clearing
+    - `format` (string): the canvas surface format, e.g. `'a8'` for masks
+    - `args` (tuple): extra arguments passed to `render_fn` and `score_fn`, e.g. a target image.
+      These are sent to the workers with each call
+
+    Returns an array with one score per genome if `score_fn` is given,
+    otherwise a float32 array of shape `(len(genomes), height, width)` (or `(..., 3)` for `'rgb'`) with the images in the 0-1 range.
+
+    The worker pool is kept alive between calls, use `close_pool` to stop it.
+    On Linux the workers are forked and inherit `render_fn` and `score_fn`, the pool is restarted if these change.
+    On other platforms they are sent to the workers, so they must be picklable (e.g. defined at the top level of a module),
+    otherwise (e.g. for functions defined in a sketch) the genomes are rendered in the calling process.
+    In both cases the workers do not see later changes to global variables, so any data that can change
+    between calls must be passed with `args` rather than read from globals.
+
+    Example:
+    ```
+    def render(c, dna, target):
+        c.no_stroke()
+        for x, y, r in dna.reshape(-1, 3):
+            c.circle(x * c.width, y * c.height, r * 20)
+
+    def score(c, dna, target):
+        return -np.sum((c.read_downsampled(4) - target)**2)
+
+    fitness = evaluate_population(render, population, (512, 512), score, args=(target,))
+    ```
+    '''
+    n = len(genomes)
+    size = (int(size[0]), int(size[1]))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, n))
+    if score_fn is None and downsample is None:
+        downsample = 1
+    if workers > 1 and not _fork and not _picklable((render_fn, score_fn)):
+        workers = 1
+
+    if score_fn is not None:
+        shape = (n,)
+    else:
+        shape = (n,) + _downsampled_shape(size, downsample, channels)
+    if n == 0:
+        return np.zeros(shape, dtype=np.float32)
+
+    # Scores in double precision, images in single precision
+    dtype = np.float64 if score_fn is not None else np.float32
+    if workers == 1:
+        result = np.empty(shape, dtype=dtype)
+        _render_into(result, render_fn, score_fn, genomes, 0, size, format, background, downsample, channels, args)
+        return result
+
+    functions = (render_fn, score_fn)
+    pool = _get_pool(workers, functions)
+    if _fork:
+        functions = None
+    shm = _shared_block(int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    # Contiguous chunks, a few per worker to balance uneven render times
+    edges = np.linspace(0, n, min(n, workers * 4) + 1).astype(int)
+    args = tuple(args)
+    tasks = [(functions, args, genomes[a:b], a, size, format, background, downsample, channels, shm.name, shape, dtype)
+             for a, b in zip(edges[:-1], edges[1:]) if b > a]
+    pool.map(_render_task, tasks)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+
+
+def close_pool():
+    ''' Stop the worker processes used by `evaluate_population` and release the shared memory'''
+    global _pool, _pool_workers, _shared
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+        _pool_workers = 0
+    if _shared is not None:
+        _shared.close()
+        _shared.unlink()
+        _shared = None
+
+
+atexit.register(close_pool)
+
+
+def _picklable(functions):
+    ''' True if the functions can be sent to spawned workers'''
+    for func in functions:
+        # Functions defined in a sketch live in an executed namespace, which the workers cannot import
+        if func is not None and getattr(func, '__globals__', {}).get('__loaded_py5sketch__', False):
+            return False
+    try:
+        pickle.dumps(functions)
+    except Exception:
+        return False
+    return True
+
+
+def _get_pool(workers, functions):
+    global _pool, _pool_workers, _pool_functions
+    if _pool is None or _pool_workers != workers or (_fork and _pool_functions != functions):
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+        # The workers must share the resource tracker of the parent, which owns the shared memory
+        resource_tracker.ensure_running()
+        if _fork:
+            # Set before forking, so the workers see the functions
+            _pool_functions = functions
+            _pool = multiprocessing.get_context('fork').Pool(workers)
+        else:
+            _pool = multiprocessing.Pool(workers)
+        _pool_workers = workers
+    return _pool
+
+
+def _shared_block(nbytes):
+    ''' Shared memory receiving the results, reused while large enough'''
+    global _shared
+    if _shared is None or _shared.size < nbytes:
+        if _shared is not None:
+            _shared.close()
+            _shared.unlink()
+        _shared = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+    return _shared
+
+
+def _downsampled_shape(size, downsample, channels):
+    w, h = size
+    if np.isscalar(downsample):
+        shape = (h // int(downsample), w // int(downsample))
+    else:
+        shape = (int(downsample[1]), int(downsample[0]))
+    if channels == 'rgb':
+        shape = shape + (3,)
+    return shape
+
+
+def _canvas(size, format):
+    key = size + (format,)
+    c = _canvases.get(key)
+    if c is None:
+        c = canvas.Canvas(*size, recording=False, format=format)
+        _canvases[key] = c
+    return c
+
+
+def _render_into(result, render_fn, score_fn, genomes, start, size, format, background, downsample, channels, args):
+    c = _canvas(size, format)
+    for i, genome in enumerate(genomes):
+        if background is not None:
+            c.background(background)
+        c.push()
+        try:
+            render_fn(c, genome, *args)
+        finally:
+            c.pop()
+        if score_fn is not None:
+            result[start + i] = score_fn(c, genome, *args)
+        else:
+            c.read_downsampled(downsample, channels, out=result[start + i])
+
+
+def _attach(name):
+    ''' Open the shared memory created by the parent process, which remains responsible for releasing it'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 the block is registered again, with the resource tracker shared with the parent
+        return shared_memory.SharedMemory(name=name)
+
+
+def _render_task(args):
+    (functions, fn_args, genomes, start, size, format, background, downsample, channels, name, shape, dtype) = args
+    render_fn, score_fn = _pool_functions if functions is None else functions
+    shm = _attach(name)
+    try:
+        result = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _render_into(result, render_fn, score_fn, genomes, start, size, format, background, downsample, channels, fn_args)
+        del result
+    finally:
+        shm.close()
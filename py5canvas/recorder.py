@@ -0,0 +1,461 @@
+#!/usr/bin/env python3
+'''
+Recording of the drawing commands issued to a canvas into a compact binary file, and replay.
+
+Unlike a Cairo recording surface, the recorded stream can be saved, inspected and replayed later,
+e.g. to preview a sketch live at low resolution and render the final frames at print resolution,
+or as vector files.
+
+File layout: a header (magic, version, compression flag, canvas size) followed by chunks. Each chunk starts with a 4 byte tag
+and two uint32 values, the size of the (optionally zlib compressed) payload and the size of the uncompressed data.
+`NAME` chunks extend the table of command names, `FRAM` chunks hold the commands of one frame.
+A command is a uint16 index into the name table, followed by its positional and keyword arguments.
+Numeric sequences and NumPy arrays are stored as packed arrays.
+'''
+
+import numpy as np
+import os
+import struct
+import zlib
+import dataclasses
+from PIL import Image
+from . import canvas
+
+MAGIC = b'P5CMDS'
+VERSION = 1
+
+# Canvas methods that are recorded, calls made by these methods to other canvas methods are not
+RECORDED_METHODS = [
+    # State
+    'no_fill', 'no_stroke', 'fill_rule', 'quality', 'angle_mode', 'color_mode', 'fill', 'stroke',
+    'stroke_weight', 'stroke_join', 'stroke_cap', 'blend_mode', 'text_align', 'text_size', 'text_leading',
+    'text_font', 'text_style', 'rect_mode', 'ellipse_mode', 'curve_tightness', 'set_color_scale', 'set_render_scale',
+    'push_matrix', 'pop_matrix', 'push_style', 'pop_style', 'push', 'pop', 'clip', 'no_clip',
+    'translate', 'scale', 'rotate', 'rotate_deg', 'apply_matrix', 'identity', 'reset_matrix',
+    # Drawing
+    'background', 'rectangle', 'square', 'rect', 'quad', 'line', 'point', 'arrow', 'triangle', 'circle',
+    'ellipse', 'arc', 'begin_shape', 'end_shape', 'begin_contour', 'end_contour', 'vertex', 'curve_vertex',
+    'bezier_vertex', 'cubic', 'quadratic', 'bezier', 'curve', 'polygon', 'polyline', 'shape', 'draw_instances',
+    'text', 'image', 'image_colormap', 'copy', 'feedback', 'filter',
+]
+
+# Canvas methods whose effect cannot be recorded, these raise a `TypeError` while recording
+UNRECORDABLE_METHODS = [
+    'draw_sprites', # sprite atlases are not stored
+    'create_layer', 'get_layer', # layers are separate canvases
+]
+
+_HEADER = struct.Struct('<6sHBdd')
+_CHUNK = struct.Struct('<4sII')
+
+
+class CommandRecorder:
+    ''' Records the drawing commands issued to a canvas into a file.
+
+    While recording, the methods listed in `RECORDED_METHODS` are replaced on the canvas instance
+    by versions that log their arguments, so this also records the calls made through sketch globals.
+    Call `frame()` at the end of each frame and `close()` when done (or use the recorder in a `with` block).
+    The commands issued before the first call to `frame()` (e.g. in `setup`) form frame 0.
+
+    Arguments:
+
+    - `c` (Canvas): the canvas to record
+    - `path` (string): the output file
+    - `compress` (bool): compress the frames with zlib, default: True
+
+    Class level aliases of these methods (e.g. `line_join` for `stroke_join`) are recorded with the name of the method.
+    Arguments that cannot be stored (e.g. cairo paths or fonts loaded from an object) raise a `TypeError`,
+    as do the methods listed in `UNRECORDABLE_METHODS` (e.g. `draw_sprites` and layers).
+    Images are stored as pixels.
+    '''
+    def __init__(self, c, path, compress=True):
+        self.canvas = c
+        self.path = path
+        self.compress = compress
+        self.num_frames = 0
+        self._names = {}
+        self._new_names = []
+        self._buf = bytearray()
+        self._depth = 0
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, int(compress), c.width, c.height))
+
+        self._originals = {}
+        for name, recorded in _recorded_attributes(type(c)).items():
+            self._originals[name] = c.__dict__.get(name)
+            if recorded is None:
+                setattr(c, name, _unrecordable(name))
+            else:
+                setattr(c, name, self._wrap(recorded, getattr(c, name)))
+        # The context managers returned by `push` methods must call the recorded versions
+        self._pop_contexts = (c._pop_context, c._pop_style_context, c._pop_matrix_context)
+        c._pop_context = canvas._PopContext(c.pop)
+        c._pop_style_context = canvas._PopContext(c.pop_style)
+        c._pop_matrix_context = canvas._PopContext(c.pop_matrix)
+
+    def _wrap(self, name, method):
+        ''' A version of a method that records its calls under `name`'''
+        def recorded(*args, **kwargs):
+            # The `filter` global also replaces Python's builtin, e.g. `filter(fn, items)`, which does not draw
+            builtin = name == 'filter' and args and callable(args[0])
+            if self._depth == 0 and not builtin:
+                self._record(name, args, kwargs)
+            self._depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._depth -= 1
+        recorded.__name__ = name
+        recorded.__doc__ = method.__doc__
+        return recorded
+
+    def _record(self, name, args, kwargs):
+        index = self._names.get(name)
+        if index is None:
+            index = len(self._names)
+            self._names[name] = index
+            self._new_names.append(name)
+        buf = self._buf
+        size = len(buf)
+        try:
+            buf += struct.pack('<H', index)
+            _encode(buf, args)
+            _encode(buf, kwargs)
+        except TypeError:
+            del buf[size:]
+            raise
+
+    def frame(self):
+        ''' End the current frame and write its commands to the file'''
+        if self._new_names:
+            self._write_chunk(b'NAME', '\n'.join(self._new_names).encode('utf-8'))
+            self._new_names = []
+        self._write_chunk(b'FRAM', bytes(self._buf))
+        self._buf = bytearray()
+        self.num_frames += 1
+
+    def _write_chunk(self, tag, data):
+        payload = zlib.compress(data, 1) if self.compress else data
+        self._file.write(_CHUNK.pack(tag, len(payload), len(data)))
+        self._file.write(payload)
+
+    def close(self):
+        ''' Write the pending commands (if any) as a last frame, restore the canvas methods and close the file'''
+        if self._file is None:
+            return
+        if self._buf or self.num_frames == 0:
+            self.frame()
+        self._file.close()
+        self._file = None
+        c = self.canvas
+        for name, original in self._originals.items():
+            if original is None:
+                delattr(c, name)
+            else:
+                setattr(c, name, original)
+        c._pop_context, c._pop_style_context, c._pop_matrix_context = self._pop_contexts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _recorded_attributes(cls):
+    ''' The attributes of a canvas class to replace while recording, mapped to the name of the recorded
+    method, or to `None` for methods that cannot be recorded. Includes the aliases of these methods'''
+    names = {}
+    for name in RECORDED_METHODS:
+        if hasattr(cls, name):
+            names[id(getattr(cls, name))] = name
+    for name in UNRECORDABLE_METHODS:
+        if hasattr(cls, name):
+            names[id(getattr(cls, name))] = None
+    result = {}
+    for klass in reversed(cls.__mro__):
+        for name, value in vars(klass).items():
+            if not name.startswith('_') and callable(value) and id(value) in names:
+                result[name] = names[id(value)]
+    return result
+
+
+def _unrecordable(name):
+    def unrecordable(*args, **kwargs):
+        raise TypeError("Cannot record calls to " + name)
+    unrecordable.__name__ = name
+    return unrecordable
+
+
+class CommandReader:
+    ''' Reads a file written by `CommandRecorder`
+
+    Arguments:
+
+    - `path` (string): the file path
+
+    Attributes:
+
+    - `width`, `height`: the size of the recorded canvas
+    - `num_frames`: the number of frames in the file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self._frames = []
+        with open(path, 'rb') as f:
+            magic, version, self.compressed, self.width, self.height = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(path + " is not a command recording")
+            if version > VERSION:
+                raise ValueError("Unsupported command recording version %d" % version)
+            # Index the frames, only the command names are decoded
+            while True:
+                head = f.read(_CHUNK.size)
+                if len(head) < _CHUNK.size:
+                    break
+                tag, size, raw_size = _CHUNK.unpack(head)
+                if tag == b'NAME':
+                    self.names += self._decompress(f.read(size)).decode('utf-8').split('\n')
+                else:
+                    if tag == b'FRAM':
+                        self._frames.append((f.tell(), size, raw_size))
+                    f.seek(size, os.SEEK_CUR)
+
+    @property
+    def num_frames(self):
+        return len(self._frames)
+
+    def commands(self, index):
+        ''' The commands of a frame, as a list of `(name, args, kwargs)` tuples'''
+        offset, size, raw_size = self._frames[index]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            data = memoryview(self._decompress(f.read(size)))
+        result = []
+        pos = 0
+        while pos < len(data):
+            (name,) = struct.unpack_from('<H', data, pos)
+            args, pos = _decode(data, pos + 2)
+            kwargs, pos = _decode(data, pos)
+            result.append((self.names[name], args, kwargs))
+        return result
+
+    def _decompress(self, data):
+        return zlib.decompress(data) if self.compressed else data
+
+    def replay(self, c, index, scale=1.0):
+        ''' Issue the commands of a frame to the canvas `c`.
+        Render scales set with `set_render_scale` are multiplied by `scale`'''
+        for name, args, kwargs in self.commands(index):
+            if name == 'set_render_scale':
+                args = (args[0]*scale,) + tuple(args[1:])
+            getattr(c, name)(*args, **kwargs)
+
+    def create_canvas(self, scale=1.0, vector=False):
+        ''' A canvas with the size of the recording, rasterized at `scale` times its size.
+        With `vector=True` the canvas also records for SVG/PDF output'''
+        return canvas.Canvas(self.width, self.height, recording=vector, render_scale=scale)
+
+
+def render_frames(path, output, frames=None, scale=1.0, independent=False, workers=1):
+    ''' Render the frames of a command recording to files.
+
+    Arguments:
+
+    - `path` (string): the recording
+    - `output` (string): the output path, with a format for the frame number when rendering more than one frame,
+      e.g. `'frames/frame_%05d.png'`. The extension (`.png`, `.svg` or `.pdf`) selects the output format
+    - `frames` (optional): the indices of the frames to render, by default all of them
+    - `scale` (float): the resolution of PNG output relative to the recorded canvas size, e.g. `4` for print
+    - `independent` (bool): if `True`, each frame is rendered on a new canvas after replaying frame 0 (the commands issued in `setup`).
+      This is valid when each frame draws its own background and sets the state it uses, and allows rendering in parallel.
+      Otherwise the frames are replayed in sequence, so that content and state carry over as when recording
+    - `workers` (int): the number of processes used with `independent=True`
+
+    Returns the list of files written.
+    '''
+    reader = CommandReader(path)
+    if frames is None:
+        frames = range(reader.num_frames)
+    frames = sorted(set(frames))
+    if independent and workers > 1 and len(frames) > 1:
+        import multiprocessing
+        chunks = [frames[i::workers] for i in range(workers)]
+        with multiprocessing.Pool(min(workers, len(frames))) as pool:
+            written = pool.map(_render_independent, [(path, output, chunk, scale) for chunk in chunks if chunk])
+        return sorted(sum(written, []))
+    if independent:
+        return _render_independent((path, output, frames, scale))
+
+    vector = _is_vector(output)
+    c = reader.create_canvas(scale, vector)
+    wanted = set(frames)
+    written = []
+    for i in range(frames[-1] + 1):
+        reader.replay(c, i, scale)
+        if i in wanted:
+            written.append(_save(c, output, i))
+    return written
+
+
+def _render_independent(args):
+    path, output, frames, scale = args
+    reader = CommandReader(path)
+    vector = _is_vector(output)
+    written = []
+    for i in frames:
+        c = reader.create_canvas(scale, vector)
+        if i > 0:
+            reader.replay(c, 0, scale)
+        reader.replay(c, i, scale)
+        written.append(_save(c, output, i))
+    return written
+
+
+def _is_vector(output):
+    return os.path.splitext(output)[1].lower() in ('.svg', '.pdf')
+
+
+def _save(c, output, index):
+    path = output % index if '%' in output else output
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.svg':
+        c.save_svg(path)
+    elif ext == '.pdf':
+        c.save_pdf(path)
+    else:
+        c.get_image().save(path)
+    return path
+
+
+def _encode(buf, v):
+    ''' Append a value to a bytearray, with a one byte type tag'''
+    if v is None:
+        buf += b'N'
+    elif v is True or v is False or isinstance(v, np.bool_):
+        buf += b'T' if v else b'F'
+    elif isinstance(v, (int, np.integer)):
+        if -2**63 <= v < 2**63:
+            buf += struct.pack('<cq', b'i', int(v))
+        else:
+            buf += struct.pack('<cd', b'd', float(v))
+    elif isinstance(v, (float, np.floating)):
+        buf += struct.pack('<cd', b'd', float(v))
+    elif isinstance(v, str):
+        data = v.encode('utf-8')
+        buf += struct.pack('<cI', b's', len(data))
+        buf += data
+    elif isinstance(v, np.ndarray):
+        if v.dtype.hasobject:
+            _encode(buf, v.tolist())
+            return
+        dtype = v.dtype.str.encode('ascii')
+        buf += struct.pack('<cBB', b'a', len(dtype), v.ndim)
+        buf += dtype
+        buf += struct.pack('<%dI' % v.ndim, *v.shape)
+        buf += np.ascontiguousarray(v).tobytes()
+    elif isinstance(v, (list, tuple)):
+        # Sequences of numbers are packed, lists and tuples are kept distinct
+        packed = _packed_numbers(v)
+        if packed is not None:
+            tag, arr = packed
+            buf += struct.pack('<cI', tag if isinstance(v, list) else tag.upper(), len(v))
+            buf += arr.tobytes()
+        else:
+            buf += struct.pack('<cI', b'l' if isinstance(v, list) else b't', len(v))
+            for item in v:
+                _encode(buf, item)
+    elif isinstance(v, dict):
+        buf += struct.pack('<cI', b'k', len(v))
+        for key, item in v.items():
+            _encode(buf, str(key))
+            _encode(buf, item)
+    elif isinstance(v, canvas.Gradient):
+        buf += b'g'
+        _encode(buf, v.kind)
+        _encode(buf, v.params)
+    elif isinstance(v, canvas.Font):
+        if not isinstance(v.obj, str):
+            raise TypeError("Only fonts created from a file or font name can be recorded")
+        buf += b'f'
+        _encode(buf, dataclasses.astuple(v))
+    elif isinstance(v, canvas.Canvas):
+        _encode(buf, np.array(v.get_image()))
+    elif isinstance(v, Image.Image):
+        _encode(buf, np.array(v.convert('RGBA') if v.mode == 'P' else v))
+    else:
+        raise TypeError("Cannot record an argument of type " + type(v).__name__)
+
+
+def _packed_numbers(v):
+    if not v:
+        return None
+    if all(type(x) is int for x in v):
+        if all(-2**63 <= x < 2**63 for x in v):
+            return b'j', np.array(v, dtype='<i8')
+        return None
+    if all(type(x) is float or type(x) is int for x in v):
+        return b'e', np.array(v, dtype='<f8')
+    return None
+
+
+def _decode(data, pos):
+    ''' Decode a value from a buffer, returns the value and the position after it'''
+    tag = data[pos:pos + 1].tobytes()
+    pos += 1
+    if tag == b'N':
+        return None, pos
+    if tag == b'T':
+        return True, pos
+    if tag == b'F':
+        return False, pos
+    if tag == b'i':
+        return struct.unpack_from('<q', data, pos)[0], pos + 8
+    if tag == b'd':
+        return struct.unpack_from('<d', data, pos)[0], pos + 8
+    if tag == b's':
+        (n,) = struct.unpack_from('<I', data, pos)
+        pos += 4
+        return data[pos:pos + n].tobytes().decode('utf-8'), pos + n
+    if tag == b'a':
+        n, ndim = struct.unpack_from('<BB', data, pos)
+        pos += 2
+        dtype = np.dtype(data[pos:pos + n].tobytes().decode('ascii'))
+        pos += n
+        shape = struct.unpack_from('<%dI' % ndim, data, pos)
+        pos += 4 * ndim
+        count = int(np.prod(shape))
+        arr = np.frombuffer(data, dtype=dtype, count=count, offset=pos).reshape(shape).copy()
+        return arr, pos + count * dtype.itemsize
+    if tag in b'jJeE':
+        (n,) = struct.unpack_from('<I', data, pos)
+        pos += 4
+        dtype = '<i8' if tag in b'jJ' else '<f8'
+        values = np.frombuffer(data, dtype=dtype, count=n, offset=pos).tolist()
+        return (values if tag in b'je' else tuple(values)), pos + 8 * n
+    if tag in b'lt':
+        (n,) = struct.unpack_from('<I', data, pos)
+        pos += 4
+        items = []
+        for i in range(n):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return (items if tag == b'l' else tuple(items)), pos
+    if tag == b'k':
+        (n,) = struct.unpack_from('<I', data, pos)
+        pos += 4
+        result = {}
+        for i in range(n):
+            key, pos = _decode(data, pos)
+            result[key], pos = _decode(data, pos)
+        return result, pos
+    if tag == b'g':
+        kind, pos = _decode(data, pos)
+        params, pos = _decode(data, pos)
+        return canvas.Gradient(kind, **params), pos
+    if tag == b'f':
+        fields, pos = _decode(data, pos)
+        return canvas.Font(*fields), pos
+    raise ValueError("Corrupt command recording, unknown tag %r" % tag)
@@ -23,7 +23,7 @@ It will probably be significantly slow when using a large canvas size
 # from pyglet.window import key
 import numpy as np
 import os, sys, time
-from py5canvas import canvas, sketch_params
+from py5canvas import canvas, sketch_params, recorder
 from py5canvas.sketch_params import load_json, save_json
 from PIL import Image
 from py5canvas import globals as glob
@@ -179,6 +179,14 @@ def wrap_canvas_method(sketch, func):
 
 ASYNC_BG = True
 
+# Texture components and swizzle for each canvas surface format.
+# A8 masks are shown as grayscale, RGB24 ignores the unused fourth byte
+CANVAS_TEXTURE_LAYOUTS = {
+    'argb32': (4, 'BGRA'),
+    'rgb24': (4, 'BGR1'),
+    'a8': (1, 'RRR1'),
+}
+
 class Sketch:
     def create_glcontext(self):
         glfw.make_context_current(self.window)
@@ -330,6 +338,10 @@ class Sketch:
         # Saving window position for fullscreen toggle
         self.last_window_pos = None
 
+        # Render scale of the canvas, either a number or 'adaptive'
+        self.render_scale_mode = 1.0
+        self.adaptive_scale = None
+
         self.create_canvas(self.width, self.height)
         # self.frame_rate(60)
         self.startup_error = False
@@ -347,8 +359,22 @@ class Sketch:
         self.video_gamma = 1.0
         self._grab_frames = []
 
+        # Drawing command recording (see `record_commands`)
+        self.command_recorder = None
+        self._command_recording = None
+        self._num_command_frames = 0
+
         # SVG/PDF saving
         self.saving_to_file = ''
+        self._save_optimize = (False, 0.0)
+        # SVG/PDF frame grabbing (see `grab_pdf` and `grab_svg_sequence`)
+        self.vector_grabbing = ''
+        self._vector_kind = ''
+        self._vector_surface = None
+        self._vector_ctx = None
+        self._vector_frame = 0
+        self._vector_num_frames = 0
+        self._vector_setup = False
         self.recording_context = None
         self.recording_surface = None
         self.done_saving = False
@@ -579,7 +605,14 @@ class Sketch:
         #print('End dialog')
         return res
 
-    def _create_canvas(self, w, h, canvas_size=None, fullscreen=False, screen=None, save_background=True):
+    def _create_canvas(self, w, h, canvas_size=None, fullscreen=False, screen=None, save_background=True,
+                       format='argb32'):
+        render_scale = self.render_scale_mode
+        if render_scale == 'adaptive':
+            self.adaptive_scale = AdaptiveRenderScale()
+            render_scale = self.adaptive_scale.max_scale
+        else:
+            self.adaptive_scale = None
         self.is_fullscreen = fullscreen
         glfw.swap_interval(0)
         #if screen is not None:
@@ -613,7 +646,8 @@ class Sketch:
         if canvas_size is None:
             canvas_size = (w, h)
         self.width, self.height = canvas_size # TODO fixme
-        self.canvas = canvas.Canvas(*canvas_size, recording=False, save_background=save_background) #, clear_callback=self.clear_callback)
+        self.canvas = canvas.Canvas(*canvas_size, recording=False, save_background=save_background,
+                                    render_scale=render_scale, format=format) #, clear_callback=self.clear_callback)
         # When createing a canvas we create a recording surface
         # This will enable recording of drawing commands that are called in setup, if any,
         # and then we can pass these into a svg if we want to save one
@@ -621,6 +655,10 @@ class Sketch:
         self.recording_surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
         self.recording_context = cairo.Context(self.recording_surface)
         self.canvas.ctx.push_context(self.recording_context)
+        # A new canvas ends the current command recording, or starts a requested one
+        self.stop_recording_commands()
+        if self._command_recording is not None:
+            self._start_recording_commands()
         # self.setup_surface = cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None)
         # self.setup_ctx = cairo.Context(self.setup_surface)
         #self.canvas.ctx.push_context(self.setup_ctx)
@@ -631,30 +669,62 @@ class Sketch:
         if self.var_context:
             self.update_globals()
 
-        if self.canvas_tex is not None:
-            print('Releasing old canvas texture')
-            self.canvas_tex.release()
-        self.canvas_tex = self.glctx.texture(canvas_size, 4, self.canvas.get_buffer())
-        self.canvas_tex.swizzle = 'BGRA' # Internal Cairo format
+        self._create_canvas_texture()
 
         # # Create image and copy initial canvas buffer to it
         # buf = self.canvas.get_buffer()
         # buf = (pyglet.gl.GLubyte * len(buf))(*buf)
         # self.image = pyglet.image.ImageData(*canvas_size, "BGRA", buf)
 
-    def create_canvas(self, w, h, gui_width=300, fullscreen=False, with_gui=True, screen=None, save_background=True):
+    def _create_canvas_texture(self):
+        if self.canvas_tex is not None:
+            print('Releasing old canvas texture')
+            self.canvas_tex.release()
+        # The surface may be smaller than the canvas if the render scale is not 1,
+        # in which case the texture is upscaled when rendering the canvas quad
+        # Cairo rows are padded to 4 bytes, which only matters for single channel (A8) surfaces
+        components, swizzle = CANVAS_TEXTURE_LAYOUTS[self.canvas.surface_format]
+        self.canvas_tex = self.glctx.texture(self.canvas.surface_size, components, self.canvas.get_buffer(),
+                                             alignment=4)
+        self.canvas_tex.swizzle = swizzle # Internal Cairo format
+        self.canvas_tex.filter = (mgl.LINEAR, mgl.LINEAR)
+
+    def render_scale(self, scale, min_scale=0.25):
+        ''' Sets the resolution at which the canvas is rasterized, relative to the canvas size.
+        Drawing coordinates are not affected and the canvas is upscaled when displayed.
+
+        Arguments:
+        - `scale` (float or string), the render scale (e.g. `0.5` for half resolution),
+          or `'adaptive'` to automatically lower the scale when the frame time exceeds the frame rate budget
+          and increase it again when there is headroom
+        - `min_scale` (float), the minimum scale used in adaptive mode, default: 0.25
+        '''
+        self.render_scale_mode = scale
+        if scale == 'adaptive':
+            self.adaptive_scale = AdaptiveRenderScale(min_scale=min_scale)
+        else:
+            self.adaptive_scale = None
+            self.canvas.set_render_scale(scale)
+
+    def create_canvas(self, w, h, gui_width=300, fullscreen=False, with_gui=True, screen=None, save_background=True,
+                      render_scale=None, format='argb32'):
         print("Creating canvas with size", w, h, "fullscreen:", fullscreen, "gui_width:", gui_width, "with_gui:", with_gui)
+        if render_scale is not None:
+            self.render_scale_mode = render_scale
         if imgui is None or not with_gui:
             print("Creating canvas no gui")
-            self._create_canvas(w, h, (w, h), fullscreen=fullscreen, screen=screen, save_background=save_background)
+            self._create_canvas(w, h, (w, h), fullscreen=fullscreen, screen=screen, save_background=save_background,
+                                format=format)
             return
         has_gui = 'gui' in self.var_context and callable(self.var_context['gui'])
         if self.params or self.gui_callback is not None or has_gui:
             print("Creating GUI window/canvas")
-            self.create_canvas_gui(w, h, gui_width, fullscreen, screen=screen, save_background=save_background)
+            self.create_canvas_gui(w, h, gui_width, fullscreen, screen=screen, save_background=save_background,
+                                   format=format)
         else:
             self.gui = sketch_params.SketchGui(gui_width)
-            self._create_canvas(w, h + self.toolbar_height, (w, h), fullscreen, screen=screen, save_background=save_background)
+            self._create_canvas(w, h + self.toolbar_height, (w, h), fullscreen, screen=screen, save_background=save_background,
+                                format=format)
 
 
     @property
@@ -676,22 +746,31 @@ class Sketch:
     def create_canvas_gui(self, w, h, width=300,
                           fullscreen=False,
                           screen=None,
-                          save_background=False):
+                          save_background=False,
+                          format='argb32'):
         if imgui is None:
             print('Install ImGui to run UI')
-            return self.create_canvas(w, h, fullscreen)
+            return self.create_canvas(w, h, fullscreen, format=format)
         self.gui = sketch_params.SketchGui(width)
         self._create_canvas(w + self.gui.width, h + self.toolbar_height, (w, h), fullscreen,
                             screen=screen,
-                            save_background=save_background)
+                            save_background=save_background,
+                            format=format)
 
     def get_pixel_ratio(self):
         return 1
 
-    def save_canvas(self, path):
-        ''' Tells the sketch to dump the next frame to an SVG file '''
+    def save_canvas(self, path, optimize=False, merge_tol=0.0):
+        ''' Tells the sketch to dump the next frame to an SVG file
+
+        Arguments:
+        - `path` (string), the output file, its extension gives the format (svg, pdf, png)
+        - `optimize` (bool), for SVG, reorder the stroked polylines to reduce pen-up travel when plotting, default: False
+        - `merge_tol` (float), with `optimize`, polylines with endpoints closer than this are merged, `None` disables merging
+        '''
         if '~' in path:
             path = os.path.expanduser(path)
+        self._save_optimize = (optimize, merge_tol)
         self.saving_to_file = os.path.abspath(path)
         print('saving file to', self.saving_to_file)
         # Since this can be called in frame, we need to make sure we don't save svg righ after
@@ -861,8 +940,130 @@ class Sketch:
         self.video_fps = framerate
         print('Saving video to ' + path)
 
+    def record_commands(self, path, num_frames=0, reload=True):
+        ''' Records the drawing commands of each frame to a compact binary file,
+        which can later be replayed at any resolution or to SVG/PDF (see `recorder.render_frames`).
+        By default this will reload the current script, so the recording includes `setup`.
+
+        Arguments:
+        - `path` (string), the file where to save the commands
+        - `num_frames` (int), the number of frames to record, 0 (default) records until `stop_recording_commands` is called or the sketch is closed
+        - `reload` (bool), whether to reload the sketch, default: True
+        '''
+        if '~' in path:
+            path = os.path.expanduser(path)
+        self._command_recording = (os.path.abspath(path), num_frames)
+        if reload:
+            self.must_reload = True
+        else:
+            self.stop_recording_commands()
+            self._start_recording_commands()
+            # There is no setup to record, frame 0 is empty
+            self.command_recorder.frame()
+
+    def _start_recording_commands(self):
+        path, self._num_command_frames = self._command_recording
+        self._command_recording = None
+        print('Recording drawing commands to ' + path)
+        self.command_recorder = recorder.CommandRecorder(self.canvas, path)
+
+    def stop_recording_commands(self):
+        ''' Stops recording drawing commands and closes the file'''
+        if self.command_recorder is not None:
+            self.command_recorder.close()
+            print('Recorded %d frames to %s'%(self.command_recorder.num_frames, self.command_recorder.path))
+            self.command_recorder = None
+
+    def grab_pdf(self, path, num_frames=0, reload=True):
+        ''' Saves a number of frames as the pages of a single PDF file.
+        Each frame is drawn directly into its page, which is written to the file when the frame ends.
+        By default this will reload the current script, and the first page also includes the drawing done in `setup`.
+
+        Arguments:
+        - `path` (string), the PDF file path
+        - `num_frames` (int), the number of frames to save, 0 (default) saves until `stop_grabbing` is called or the sketch is closed
+        - `reload` (bool), whether to reload the sketch, default: True
+        '''
+        self._start_vector_grab(path, 'pdf', num_frames, reload)
+
+    def grab_svg_sequence(self, path, num_frames=0, reload=True):
+        ''' Saves a sequence of SVG files to a directory, one for each frame.
+        By default this will reload the current script, and the first file also includes the drawing done in `setup`.
+
+        Arguments:
+        - `path` (string), the directory where to save the files
+        - `num_frames` (int), the number of frames to save, 0 (default) saves until `stop_grabbing` is called or the sketch is closed
+        - `reload` (bool), whether to reload the sketch, default: True
+        '''
+        if '~' in path:
+            path = os.path.expanduser(path)
+        os.makedirs(path, exist_ok=True)
+        self._start_vector_grab(path, 'svg', num_frames, reload)
+
+    def _start_vector_grab(self, path, kind, num_frames, reload):
+        self.finalize_vector_grab()
+        if '~' in path:
+            path = os.path.expanduser(path)
+        self.vector_grabbing = os.path.abspath(path)
+        self._vector_kind = kind
+        self._vector_num_frames = num_frames
+        self._vector_frame = 0
+        self._vector_setup = reload
+        self.must_reload = reload
+        print('Saving frames to ' + self.vector_grabbing)
+
+    def _begin_vector_frame(self):
+        # The frame is drawn to a context on the output surface alongside the canvas,
+        # so nothing is kept in memory once the page or file is done
+        w, h = self.canvas.width, self.canvas.height
+        if self._vector_kind == 'pdf':
+            if self._vector_surface is None:
+                self._vector_surface = cairo.PDFSurface(self.vector_grabbing, w, h)
+            surf = self._vector_surface
+        else:
+            surf = cairo.SVGSurface(self._vector_frame_path(), w, h)
+        ctx = cairo.Context(surf)
+        if self._vector_setup and self._vector_frame == 0 and self.recording_surface is not None:
+            ctx.set_source_surface(self.recording_surface)
+            ctx.paint()
+        self.canvas.ctx.push_context(ctx)
+        self._vector_ctx = ctx
+
+    def _end_vector_frame(self):
+        ctx = self._vector_ctx
+        self._vector_ctx = None
+        self.canvas.ctx.remove_context(ctx)
+        self.canvas._paint_layers_to(ctx)
+        surf = ctx.get_target()
+        if self._vector_kind == 'pdf':
+            surf.show_page()
+        else:
+            surf.finish()
+            canvas.fix_clip_path(self._vector_frame_path(), self._vector_frame_path())
+        self._vector_frame += 1
+        print('Saving frame %d of %d' % (self._vector_frame, self._vector_num_frames))
+        if 0 < self._vector_num_frames <= self._vector_frame:
+            self.finalize_vector_grab()
+            print("Stopping grab")
+
+    def _vector_frame_path(self):
+        return os.path.join(self.vector_grabbing, '%d.svg'%(self._vector_frame+1))
+
+    def finalize_vector_grab(self):
+        if not self.vector_grabbing:
+            return
+        if self._vector_ctx is not None:
+            # Interrupted frame
+            self.canvas.ctx.remove_context(self._vector_ctx)
+            self._vector_ctx = None
+        if self._vector_surface is not None:
+            self._vector_surface.finish()
+            self._vector_surface = None
+        self.vector_grabbing = ''
+
     def stop_grabbing(self):
-        self.settings['num_movie_frames'] = self.current_grab_frame
+        self.settings['num_movie_frames'] = self.cur_grab_frame
+        self.finalize_vector_grab()
 
     def grab(self):
         if not self.grabbing:
@@ -870,13 +1071,6 @@ class Sketch:
 
         if 'mp4' in self.grabbing:
             # Grap mp4 frame
-            if self.video_writer is None:
-                print('Creating video writer')
-                import cv2
-                fmt = cv2.VideoWriter_fourcc(*'mp4v') #cv2.cv.CV_FOURCC(*'mp4v')
-                self.video_writer = cv2.VideoWriter(self.grabbing, fmt, self.video_fps, (self.canvas.width,
-                                                                        self.canvas.height))
-
             # GL active: use context
             if 'draw_gl' in self.var_context:
                 ctx = self.glctx
@@ -895,20 +1089,28 @@ class Sketch:
                     img = adjust_gamma(img[::-1,:,::-1], self.video_gamma)
             else:
                 # Just use canvas image
-                img = self.canvas.get_image()
+                img = self.canvas.get_image(layers=True)
                 img = np.array(img)[:, :, ::-1]
             #img = srgb2lin(img[:,:,::-1])
             #img = lin2srgb(img[:,:,::-1])
 
+            if self.video_writer is None:
+                print('Creating video writer')
+                import cv2
+                fmt = cv2.VideoWriter_fourcc(*'mp4v') #cv2.cv.CV_FOURCC(*'mp4v')
+                # Use the size of the grabbed image, since it may differ from the canvas size
+                # (e.g. with a render scale or when grabbing the GL framebuffer)
+                self.video_writer = cv2.VideoWriter(self.grabbing, fmt, self.video_fps, (img.shape[1],
+                                                                                          img.shape[0]))
             self.video_writer.write(img)
         elif 'gif' in self.grabbing:
-            img = self.canvas.get_image().convert("P", palette=Image.ADAPTIVE, colors=self.settings['gif']['colors'], dither=Image.FLOYDSTEINBERG)
+            img = self.canvas.get_image(layers=True).convert("P", palette=Image.ADAPTIVE, colors=self.settings['gif']['colors'], dither=Image.FLOYDSTEINBERG)
             #img = adjust_gamma(img[::-1,:,::-1], self.video_gamma)
             self._grab_frames.append(img)
         else:
             # Grab png frame
             path = self.grabbing
-            self.canvas.save_image(os.path.join(path, '%d.png'%(self.cur_grab_frame+1)))
+            self.canvas.save_image(os.path.join(path, '%d.png'%(self.cur_grab_frame+1)), layers=True)
         print('Saving frame %d of %d' % (self.cur_grab_frame+1, self.settings['num_movie_frames']))
         self.cur_grab_frame += 1
         if self.cur_grab_frame >= self.settings['num_movie_frames']:
@@ -1009,6 +1211,7 @@ class Sketch:
         self.gui_callback = None
         self._no_loop = False
         self.desc = ''
+        self.render_scale_mode = 1.0
 
         # Set current directory to script dir
         if self.path:
@@ -1109,13 +1312,18 @@ class Sketch:
                                 'grab_movie',
                                 'param_changed',
                                 'grab_image_sequence',
+                                'grab_pdf',
+                                'grab_svg_sequence',
+                                'record_commands',
+                                'stop_recording_commands',
                                 'fullscreen',
                                 'show_gui',
                                 'toggle_gui',
                                 'toggle_fullscreen',
                                 'open_file_dialog',
                                 'save_file_dialog',
-                                'open_folder_dialog']
+                                'open_folder_dialog',
+                                'render_scale']
                 for method in export_methods:
                     #if method not in var_context:
                     var_context[method] = wrap_method(self, method)
@@ -1166,6 +1374,16 @@ class Sketch:
             self.startup_error = True
             #self.error_label.text = str(e)
             print_traceback()
+        # Show the layers drawn in setup, also for sketches without a draw function
+        try:
+            self.canvas.composite_layers()
+        except Exception as e:
+            print('Error compositing layers')
+            print(e)
+            print_traceback()
+        # Close frame 0 of a command recording with the commands issued in setup
+        if self.command_recorder is not None and self.command_recorder.num_frames == 0:
+            self.command_recorder.frame()
         # create_canvas created and added a recording context so pop it in case (if no error)
         if len(self.canvas.ctx.ctxs) > 1:
             print('Removing setup recording context')
@@ -1299,13 +1517,15 @@ class Sketch:
                 #self.gui_focus = imgui.core.is_window_hovered()
                 #print('gui focus', self.gui_focus)
         did_draw = False
-        with perf_timer('update'):
+        with perf_timer('update') as draw_timer:
             if self._clicked:
                 pass
 
             if not self.runtime_error or self._frame_count==0:
                 try:
                     if 'draw' in self.var_context and draw_frame:
+                        if self.vector_grabbing and not self.must_reload:
+                            self._begin_vector_frame()
                         self.canvas.blend_mode('over')
                         self.canvas.identity()
                         # Draw background before drawing if specified
@@ -1315,7 +1535,16 @@ class Sketch:
                         self._async_background = False
                         self.var_context['draw']()
                         self._async_background = True
+                        self.canvas.composite_layers()
                         did_draw = True
+                        if self._vector_ctx is not None:
+                            self._end_vector_frame()
+                        if self.command_recorder is not None:
+                            self.command_recorder.frame()
+                            # Frame 0 holds the commands from setup, the following ones one draw each
+                            num_draws = self.command_recorder.num_frames - 1
+                            if 0 < self._num_command_frames <= num_draws:
+                                self.stop_recording_commands()
                         if self._clicked:
                             self._clicked = False
                     else:
@@ -1328,11 +1557,14 @@ class Sketch:
                     #self.error_label.text = str(e)
                     self.runtime_error = True
                     print_traceback()
+                    # Keep what was drawn, so pages and files match the frames
+                    if self._vector_ctx is not None:
+                        self._end_vector_frame()
 
         # Copy canvas image and visualize
         pitch = self.width * 4
         with perf_timer('get buffer'):
-            buf = self.canvas.get_buffer()
+            buf = self.canvas.get_output_buffer()
 
         # with perf_timer('update image'):
         #     # https://stackoverflow.com/questions/9035712/numpy-array-is-shown-incorrect-with-pyglet
@@ -1348,9 +1580,18 @@ class Sketch:
         # if self.grabbing and not self.must_reload and draw_frame:
         #     self.grab()
 
+        # Adapt the render scale to the time taken by draw
+        if did_draw and self.adaptive_scale is not None:
+            budget = 1000.0 / (self._fps if self._fps > 0 else 60)
+            scale = self.adaptive_scale.update(self.canvas.render_scale, draw_timer.elapsed, budget)
+            if scale != self.canvas.render_scale:
+                self.canvas.set_render_scale(scale)
+
         # Update timers and copy to texture
         if draw_frame:
-            self.canvas_tex.write(self.canvas.get_buffer())
+            if self.canvas_tex.size != self.canvas.surface_size:
+                self._create_canvas_texture()
+            self.canvas_tex.write(self.canvas.get_output_buffer())
             self._frame_count += 1
 
         # Finalize gui visualization
@@ -1382,7 +1623,9 @@ class Sketch:
 
         if self.saving_to_file and self.done_saving:
             print('saving to ', self.saving_to_file)
-            if ('.png' in self.saving_to_file or '.jpg' in self.saving_to_file):
+            if '.png' in self.saving_to_file:
+                self.canvas.save_image(self.saving_to_file, layers=True)
+            elif '.jpg' in self.saving_to_file:
                 self.canvas.save(self.saving_to_file)
             else:
                 if '.svg' in self.saving_to_file:
@@ -1397,11 +1640,16 @@ class Sketch:
                 # ctx.paint()
                 ctx.set_source_surface(self.recording_surface)
                 ctx.paint()
+                if surf is not self.canvas.surf:
+                    self.canvas._paint_layers_to(ctx)
                 surf.finish()
 
                 # Apply svg fix
                 try:
                     if '.svg' in self.saving_to_file:
+                        optimize, merge_tol = self._save_optimize
+                        if optimize:
+                            canvas.optimize_svg_paths(self.saving_to_file, self.saving_to_file, merge_tol)
                         canvas.fix_clip_path(self.saving_to_file, self.saving_to_file)
                 except AttributeError as e:
                     print(e)
@@ -1505,6 +1753,48 @@ class Sketch:
             self.params.save()
         print("End cleanup")
 
+class AdaptiveRenderScale:
+    """Lowers the render scale of the canvas when the draw time exceeds the frame budget
+    and raises it again when there is enough headroom.
+    Changes are quantized to `step` and spaced by `cooldown` frames to avoid reallocating the canvas too often.
+    """
+    def __init__(self, min_scale=0.25, max_scale=1.0, step=0.125, cooldown=30, headroom=0.6, smoothing=0.1):
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.step = step
+        self.cooldown = cooldown
+        self.headroom = headroom
+        self.smoothing = smoothing
+        self.avg_time = None
+        self.frames_since_change = 0
+
+    def update(self, scale, elapsed, budget):
+        ''' Returns the new render scale given the current scale, the draw time and the frame budget (in ms)'''
+        if self.avg_time is None:
+            self.avg_time = elapsed
+        self.avg_time += (elapsed - self.avg_time)*self.smoothing
+        self.frames_since_change += 1
+        if self.frames_since_change < self.cooldown:
+            return scale
+
+        if self.avg_time > budget:
+            # Cost is roughly proportional to the number of pixels
+            target = scale*np.sqrt(budget / self.avg_time)
+            target = np.floor(target / self.step)*self.step
+            target = min(target, scale - self.step)
+        elif self.avg_time < budget*self.headroom:
+            target = scale + self.step
+        else:
+            return scale
+
+        target = float(np.clip(target, self.min_scale, self.max_scale))
+        if target != scale:
+            self.frames_since_change = 0
+            # Restart averaging at the new scale
+            self.avg_time = None
+        return target
+
+
 def drain_glerrors(ctx, tag):
     had = False
     while True:
@@ -1881,6 +2171,8 @@ def main(path='', fps=0, inject=True, show_toolbar=False):
     def close():
         # Stop grabbing and finalize
         sketch.finalize_grab()
+        sketch.finalize_vector_grab()
+        sketch.stop_recording_commands()
 
         # Save params if they exist
         if sketch.params is not None and not sketch.has_error():